@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Load test the asyncio HTTP front end with many idle long-polls.
+
+Parks POLLERS clients on /events (a fifth of them filtered to one zone),
+then pushes one event for that zone and one other event, and times how
+long it takes for every poller to get its answer. The server and the
+clients share one event loop, pinned to a single CPU where the platform
+allows it, so the whole test runs on one core.
+
+Run from the top of the tree:
+
+  PYTHONPATH=. python benchmarks/bench_async_api.py [POLLERS]
+
+Each poller needs two file descriptors, so the open file limit is
+raised as far as the hard limit allows.
+"""
+import asyncio
+import os
+import resource
+import sys
+import threading
+import time
+from unittest import mock
+
+from nx584 import api
+from nx584 import async_api
+from nx584 import event_queue
+
+POLLERS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+async def poll(port, target):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(('GET %s HTTP/1.1\r\nHost: bench\r\n\r\n' %
+                  target).encode())
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    length = int(head.lower().split(b'content-length:')[1].split()[0])
+    await reader.readexactly(length)
+    writer.close()
+    return time.time()
+
+
+async def main():
+    ctrl = mock.MagicMock()
+    ctrl.event_queue = event_queue.EventQueue(100)
+    api.CONTROLLER = ctrl
+    server = async_api.Server()
+    await server.start('127.0.0.1', 0)
+
+    before = rss_kb()
+    start = time.time()
+    polls = []
+    for i in range(POLLERS):
+        target = '/events?index=0&timeout=300'
+        if i % 5 == 0:
+            target += '&zone=7'
+        polls.append(asyncio.ensure_future(poll(server.port, target)))
+        if i % 500 == 499:
+            # Don't overrun the listen backlog
+            await asyncio.sleep(0)
+    while server.waiting < POLLERS:
+        await asyncio.sleep(0.05)
+    parked = time.time() - start
+    print('Parked %i pollers in %.2fs, %i threads, %.1f KiB each' % (
+        POLLERS, parked, threading.active_count(),
+        (rss_kb() - before) / POLLERS))
+
+    # Let the loop go idle, and measure how busy it is doing nothing
+    cpu = time.process_time()
+    await asyncio.sleep(2)
+    print('CPU while idle: %.1f%%' % (
+        (time.process_time() - cpu) / 2 * 100))
+
+    start = time.time()
+    ctrl.event_queue.push({'type': 'zone_status', 'zone': 3})
+    done = await asyncio.gather(*[p for i, p in enumerate(polls)
+                                  if i % 5])
+    print('Woke %i unfiltered pollers in %.2fs (%i still waiting)' % (
+        len(done), max(done) - start, server.waiting))
+    start = time.time()
+    ctrl.event_queue.push({'type': 'zone_status', 'zone': 7})
+    done = await asyncio.gather(*polls[::5])
+    print('Woke %i zone 7 pollers in %.2fs' % (len(done),
+                                               max(done) - start))
+    await server.close()
+
+
+if __name__ == '__main__':
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {min(os.sched_getaffinity(0))})
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    want = POLLERS * 2 + 100
+    if soft < want:
+        resource.setrlimit(resource.RLIMIT_NOFILE,
+                           (min(want, hard) if hard > 0 else want, hard))
+    asyncio.run(main())
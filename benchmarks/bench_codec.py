@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Compare the protocol codec against the original per-frame helpers.
+
+Run from the top of the tree:
+
+  PYTHONPATH=. python benchmarks/bench_codec.py
+"""
+import timeit
+
+from nx584 import codec
+
+
+# The implementations nx584.controller used before nx584.codec existed
+def legacy_fletcher(data, k=16):
+    nbytes = k // 16
+    mod = 2 ** (8 * nbytes) - 1
+    s = s2 = 0
+    for t in data:
+        s += t
+        s2 += s
+    cksum = s % mod + (mod + 1) * (s2 % mod)
+    return cksum & 0xFF, (cksum & 0xFF00) >> 8
+
+
+def legacy_parse_ascii(data):
+    data_bytes = []
+    for i in range(0, len(data), 2):
+        data_bytes.append(int(data[i:i + 2], 16))
+    return data_bytes
+
+
+def legacy_make_ascii(data):
+    data_chars = []
+    for b in data:
+        data_chars.append('%02X' % b)
+    return ''.join(data_chars)
+
+
+def legacy_binary_frame(data):
+    data = [len(data)] + data
+    data += legacy_fletcher(data)
+    bytestuff = [i for i, x in enumerate(data) if x == 0x7d]
+    for i, index in reversed(list(enumerate(bytestuff))):
+        data[index:index+1] = [0x7d, 0x5d]
+    bytestuff = [i for i, x in enumerate(data) if x == 0x7e]
+    for i, index in reversed(list(enumerate(bytestuff))):
+        data[index:index+1] = [0x7d, 0x5e]
+    data.insert(0, 0x7e)
+    return bytes(data)
+
+
+def legacy_ascii_frame(data):
+    data = [len(data)] + data
+    data += legacy_fletcher(data)
+    return ('\n%s\r' % legacy_make_ascii(data)).encode()
+
+
+# A Partition Status message, one of the largest the panel sends
+MESSAGE = [0x06, 0x00, 0x68, 0x00, 0xE0, 0x40, 0x62, 0x04, 0x82, 0x7e, 0x07]
+FRAME = bytes([len(MESSAGE)] + MESSAGE)
+HEXFRAME = legacy_make_ascii(FRAME)
+
+CASES = [
+    ('fletcher', lambda: legacy_fletcher(FRAME),
+     lambda: codec.fletcher16(FRAME)),
+    ('hex decode', lambda: legacy_parse_ascii(HEXFRAME),
+     lambda: codec.decode_hex(HEXFRAME)),
+    ('hex encode', lambda: legacy_make_ascii(FRAME),
+     lambda: codec.encode_hex(FRAME)),
+    ('ascii frame', lambda: legacy_ascii_frame(MESSAGE),
+     lambda: codec.encode_ascii_frame(MESSAGE)),
+    ('binary frame', lambda: legacy_binary_frame(MESSAGE),
+     lambda: codec.encode_binary_frame(MESSAGE)),
+]
+
+
+def main(number=100000):
+    assert legacy_binary_frame(MESSAGE) == codec.encode_binary_frame(MESSAGE)
+    assert legacy_ascii_frame(MESSAGE) == codec.encode_ascii_frame(MESSAGE)
+
+    print('%-14s %12s %12s %8s' % ('operation', 'legacy us', 'codec us',
+                                   'speedup'))
+    for name, legacy, new in CASES:
+        t_legacy = min(timeit.repeat(legacy, number=number, repeat=3))
+        t_new = min(timeit.repeat(new, number=number, repeat=3))
+        print('%-14s %12.3f %12.3f %7.1fx' % (
+            name, t_legacy * 1e6 / number, t_new * 1e6 / number,
+            t_legacy / t_new))
+
+
+if __name__ == '__main__':
+    main()
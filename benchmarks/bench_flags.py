@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Compare table-driven flag decoding against the original bit loops.
+
+Decodes the flag bytes of a full-panel status burst (192 zone status,
+8 partition status and 1 system status messages), as seen at startup
+on a fully populated NX-8E.
+
+Run from the top of the tree:
+
+  PYTHONPATH=. python benchmarks/bench_flags.py
+"""
+import random
+import timeit
+
+from nx584 import model
+
+
+# The loops nx584.controller used before the flag tables existed
+def legacy_zone(condition, types):
+    condition_flags = []
+    for index, string in enumerate(model.Zone.STATUS_FLAGS):
+        if condition & (1 << index):
+            condition_flags.append(string)
+    type_flags = []
+    for byte, flags in enumerate(model.Zone.TYPE_FLAGS):
+        for bit, name in enumerate(flags):
+            if types[byte] & (1 << bit):
+                type_flags.append(name)
+    return condition_flags, type_flags
+
+
+def legacy_bytes(all_flags, data):
+    result = []
+    for byte, flags in enumerate(all_flags):
+        for bit, name in enumerate(flags):
+            if data[byte] & (1 << bit):
+                result.append(name)
+    return result
+
+
+# What nx584.controller does now: the flag bytes are kept as an integer,
+# and decoded with the tables when the names are wanted
+def table_zone(condition, types):
+    return (model.Zone.condition_flags.names(condition),
+            model.Zone.type_flags.names(int.from_bytes(types, 'little')))
+
+
+def table_bytes(field, data):
+    return field.names(int.from_bytes(data, 'little'))
+
+
+rand = random.Random(584)
+ZONES = [(rand.randrange(128), bytes(rand.randrange(256) for i in range(3)))
+         for zone in range(192)]
+PARTITIONS = [bytes(rand.randrange(256) for i in range(6)) for p in range(8)]
+SYSTEM = bytes(rand.randrange(256) for i in range(9))
+
+
+def legacy_burst():
+    for condition, types in ZONES:
+        legacy_zone(condition, types)
+    for data in PARTITIONS:
+        legacy_bytes(model.Partition.CONDITION_FLAGS, data)
+    legacy_bytes(model.System.STATUS_FLAGS, SYSTEM)
+
+
+def table_burst():
+    for condition, types in ZONES:
+        table_zone(condition, types)
+    for data in PARTITIONS:
+        table_bytes(model.Partition.condition_flags, data)
+    table_bytes(model.System.status_flags, SYSTEM)
+
+
+def main(number=200):
+    for condition, types in ZONES:
+        assert legacy_zone(condition, types) == table_zone(condition, types)
+    for data in PARTITIONS:
+        assert (legacy_bytes(model.Partition.CONDITION_FLAGS, data) ==
+                table_bytes(model.Partition.condition_flags, data))
+    assert (legacy_bytes(model.System.STATUS_FLAGS, SYSTEM) ==
+            table_bytes(model.System.status_flags, SYSTEM))
+
+    t_legacy = min(timeit.repeat(legacy_burst, number=number, repeat=3))
+    t_table = min(timeit.repeat(table_burst, number=number, repeat=3))
+    print('%-14s %12s %12s %8s' % ('operation', 'legacy us', 'table us',
+                                   'speedup'))
+    print('%-14s %12.1f %12.1f %7.1fx' % (
+        'panel burst', t_legacy * 1e6 / number, t_table * 1e6 / number,
+        t_legacy / t_table))
+
+
+if __name__ == '__main__':
+    main()
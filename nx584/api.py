@@ -1,11 +1,21 @@
+import concurrent.futures
 import flask
+import hashlib
 import json
 import logging
 
+from nx584 import batch
+from nx584 import controller
+from nx584 import event_queue
+
 
 LOG = logging.getLogger('api')
 CONTROLLER = None
 app = flask.Flask('nx584')
+# The longest a request can wait for a command to take effect, in seconds
+MAX_WAIT = 60
+# name -> (CONTROLLER, its generation, body, etag) of the last response
+_CACHE = {}
 
 
 def show_zone(zone):
@@ -16,6 +26,7 @@ def show_zone(zone):
         'bypassed': zone.bypassed,
         'condition_flags': zone.condition_flags,
         'type_flags': zone.type_flags,
+        'stale': zone.stale,
     }
 
 
@@ -23,8 +34,9 @@ def show_partition(partition):
     return {
         'number': partition.number,
         'condition_flags': partition.condition_flags,
-        'armed': 'Armed' in partition.condition_flags,
+        'armed': partition.armed,
         'last_user': partition.last_user,
+        'stale': partition.stale,
     }
 
 
@@ -41,13 +53,32 @@ def show_user(user):
     }
 
 
+def _cached_response(name, build):
+    """Respond with the JSON of build(), rebuilt only when the state changes.
+
+    The response carries an ETag, so clients which send it back in
+    If-None-Match get a 304 until something changes.
+    """
+    key = (CONTROLLER, CONTROLLER.generation)
+    cached = _CACHE.get(name)
+    if cached is None or cached[:2] != key:
+        body = json.dumps(build()).encode()
+        etag = hashlib.sha1(body).hexdigest()[:16]
+        cached = _CACHE[name] = key + (body, etag)
+    body, etag = cached[2:]
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
 @app.route('/zones')
 def index_zones():
     try:
-        result = json.dumps({
+        return _cached_response('zones', lambda: {
             'zones': [show_zone(zone) for zone in CONTROLLER.zones.values()]})
-        return flask.Response(result,
-                              mimetype='application/json')
     except Exception as e:
         LOG.exception('Failed to index zones')
 
@@ -55,28 +86,114 @@ def index_zones():
 @app.route('/partitions')
 def index_partitions():
     try:
-        result = json.dumps({
+        return _cached_response('partitions', lambda: {
             'partitions': [show_partition(partition)
                            for partition in CONTROLLER.partitions.values()]})
-        return flask.Response(result,
-                              mimetype='application/json')
     except Exception as e:
         LOG.exception('Failed to index partitions')
 
 
+def _get_wait(args):
+    """The number of seconds to wait for a command to take effect, or 0."""
+    wait = float(args.get('wait', 0))
+    if not 0 <= wait <= MAX_WAIT:
+        raise ValueError('wait must be between 0 and %i' % MAX_WAIT)
+    return wait
+
+
+def _wait_for(futures, wait):
+    """Wait up to wait seconds for commands to complete.
+
+    :returns: None if they all succeeded, otherwise an error response
+    """
+    done, not_done = concurrent.futures.wait(futures, timeout=wait)
+    if not_done:
+        return 'Timed out waiting for the panel', 504
+    for future in futures:
+        ex = future.exception()
+        if isinstance(ex, controller.CommandTimeout):
+            return 'The panel did not answer: %s' % ex, 504
+        elif isinstance(ex, controller.CommandFailed):
+            return 'The panel refused the command: %s' % ex, 409
+        elif ex is not None:
+            return 'Unable to send the command: %s' % ex, 503
+
+
+def _outcome(future):
+    """What became of a command: done, rejected, failed or timeout."""
+    if not future.done():
+        return 'timeout'
+    ex = future.exception()
+    if ex is None:
+        return 'done'
+    elif isinstance(ex, controller.CommandTimeout):
+        return 'timeout'
+    elif isinstance(ex, controller.CommandRejected):
+        return 'rejected'
+    return 'failed'
+
+
 @app.route('/command')
 def command():
     args = flask.request.args
-    if args.get('cmd') == 'arm':
-        if args.get('type') == 'stay':
-            CONTROLLER.arm_stay(int(args.get('partition', 1)))
-        elif args.get('type') == 'exit':
-            CONTROLLER.arm_exit(int(args.get('partition', 1)))
+    try:
+        wait = _get_wait(args)
+        partition = int(args.get('partition', 1))
+    except ValueError as ex:
+        return str(ex), 400
+    with CONTROLLER.command_group():
+        if args.get('cmd') == 'arm':
+            if args.get('type') == 'stay':
+                future = CONTROLLER.arm_stay(partition)
+            elif args.get('type') == 'exit':
+                future = CONTROLLER.arm_exit(partition)
+            else:
+                future = CONTROLLER.arm_auto(partition)
+        elif args.get('cmd') == 'disarm':
+            future = CONTROLLER.disarm(args.get('master_pin'), partition)
         else:
-            CONTROLLER.arm_auto(int(args.get('partition', 1)))
-    elif args.get('cmd') == 'disarm':
-        CONTROLLER.disarm(args.get('master_pin'), int(args.get('partition', 1)))
-    return flask.Response()
+            future = None
+        if wait and future is not None:
+            # The answer to this is the partition's state once the
+            # command has been carried out
+            status = CONTROLLER.get_partition_status(partition)
+    if not wait or future is None:
+        return flask.Response()
+    error = _wait_for([future, status], wait)
+    if error:
+        return error
+    return flask.Response(
+        json.dumps(show_partition(CONTROLLER.partitions[partition])),
+        mimetype='application/json')
+
+
+@app.route('/commands', methods=['POST'])
+def post_commands():
+    try:
+        wait = _get_wait(flask.request.args)
+    except ValueError as ex:
+        return str(ex), 400
+    operations = flask.request.get_json(silent=True)
+    if not isinstance(operations, list):
+        return 'Expected a list of operations', 400
+    try:
+        steps = batch.plan(CONTROLLER, operations)
+    except batch.InvalidBatch as ex:
+        return flask.Response(json.dumps({'errors': ex.errors}),
+                              status=400, mimetype='application/json')
+    results = batch.run(CONTROLLER, steps)
+    if wait:
+        # Report what the panel made of each command, instead of just
+        # that it was queued
+        concurrent.futures.wait([future for future, status in results
+                                 if future], timeout=wait)
+        results = [(future, _outcome(future) if future else status)
+                   for future, status in results]
+    return flask.Response(json.dumps({
+        'results': [{'op': operation['op'], 'status': status}
+                    for operation, (future, status)
+                    in zip(operations, results)]}),
+                          mimetype='application/json')
 
 
 @app.route('/zones/<int:zone>', methods=['PUT'])
@@ -84,12 +201,23 @@ def put_zone(zone):
     zone = CONTROLLER.zones.get(zone)
     if not zone:
         flask.abort(404)
+    try:
+        wait = _get_wait(flask.request.args)
+    except ValueError as ex:
+        return str(ex), 400
     zonedata = flask.request.json
     if 'bypassed' in zonedata:
         want_bypass = zonedata['bypassed']
         if want_bypass == zone.bypassed:
             flask.abort(409)
-        CONTROLLER.zone_bypass_toggle(zone.number)
+        with CONTROLLER.command_group():
+            futures = [CONTROLLER.zone_bypass_toggle(zone.number)]
+            if wait:
+                futures.append(CONTROLLER.get_zone_status(zone.number))
+        if wait:
+            error = _wait_for(futures, wait)
+            if error:
+                return error
     result = json.dumps(show_zone(zone))
     return flask.Response(result,
                           mimetype='application/json')
@@ -150,16 +278,96 @@ def put_user(user):
                           mimetype='application/json')
 
 
+def parse_event_filter(args):
+    """Make an EventFilter from the type, zone, partition and event args.
+
+    Each may be given more than once, or as a comma-separated list.
+    """
+    criteria = {}
+    for key in event_queue.FILTER_KEYS:
+        values = [value for arg in args.getlist(key)
+                  for value in arg.split(',') if value]
+        if key in ('zone', 'partition'):
+            values = [int(value) for value in values]
+        criteria[key] = values
+    return event_queue.EventFilter(**criteria)
+
+
 @app.route('/events')
 def get_events():
     index = int(flask.request.args.get('index', 0))
     timeout = int(flask.request.args.get('timeout', 10))
-    events = CONTROLLER.event_queue.get(index, timeout=timeout)
+    try:
+        event_filter = parse_event_filter(flask.request.args)
+    except ValueError:
+        return 'Invalid event filter', 400
+    events, missed, index = CONTROLLER.event_queue.poll(
+        index, timeout=timeout, event_filter=event_filter)
     if events:
-        index = events[-1].number
         events = [event.payload for event in events]
     return flask.Response(json.dumps({'events': events,
-                                      'index': index}),
+                                      'index': index,
+                                      'missed': missed}),
+                          mimetype='application/json')
+
+
+def sse_message(data, event_id=None, event=None):
+    """Format one Server-Sent Events message, with data as JSON."""
+    lines = []
+    if event is not None:
+        lines.append('event: %s\n' % event)
+    if event_id is not None:
+        lines.append('id: %i\n' % event_id)
+    lines.append('data: %s\n\n' % json.dumps(data))
+    return ''.join(lines)
+
+
+# A comment, to keep the connection open through proxies
+SSE_KEEPALIVE = ': keepalive\n\n'
+
+
+def _stream_events(index, heartbeat, event_filter):
+    events, missed, index = CONTROLLER.event_queue.poll(
+        index, timeout=0, event_filter=event_filter)
+    while True:
+        if missed:
+            yield sse_message({'missed': missed}, event='missed')
+        if events:
+            for event in events:
+                yield sse_message(event.payload, event_id=event.number)
+        else:
+            yield SSE_KEEPALIVE
+        events, missed, index = CONTROLLER.event_queue.poll(
+            index, timeout=heartbeat, event_filter=event_filter)
+
+
+@app.route('/events/stream')
+def stream_events():
+    """Send events as they happen, as Server-Sent Events.
+
+    Each event's id is its number, so a client reconnecting with a
+    Last-Event-ID header carries on where it left off. Takes the same
+    filter arguments as /events.
+    """
+    index = flask.request.headers.get('Last-Event-ID',
+                                      flask.request.args.get('index', 0))
+    try:
+        index = int(index)
+        heartbeat = int(flask.request.args.get('heartbeat', 15))
+        event_filter = parse_event_filter(flask.request.args)
+    except ValueError:
+        return 'Invalid arguments', 400
+    return flask.Response(_stream_events(index, heartbeat, event_filter),
+                          mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/stats')
+def get_stats():
+    return flask.Response(json.dumps(
+        {'handlers': CONTROLLER.handler_stats(),
+         'extensions': CONTROLLER.extension_stats(),
+         'mail': CONTROLLER.mail_stats()}),
                           mimetype='application/json')
 
 
@@ -167,5 +375,6 @@ def get_events():
 def get_version():
     return flask.Response(json.dumps(
         {'version': '1.2',
-         'last_active': int(CONTROLLER.last_active)}),
+         'last_active': int(CONTROLLER.last_active),
+         'ready': CONTROLLER.ready}),
                           mimetype='application/json')
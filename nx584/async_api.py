@@ -0,0 +1,410 @@
+"""An asyncio HTTP front end for the REST API.
+
+Serves the same routes as the Flask app in nx584.api, but from a single
+event loop. /events and /events/stream are handled here, with waiting
+clients parked as futures which are resolved when a matching event is
+pushed, so thousands of idle long-polls cost no threads. Every other
+route only looks at the controller's state or queues a command, so it
+is passed straight to the Flask app (as WSGI) on the loop, except for
+requests waiting for a command to take effect, which get a thread.
+"""
+import asyncio
+import collections
+import io
+import json
+import logging
+import sys
+import threading
+import urllib.parse
+
+from nx584 import api
+from nx584 import async_controller
+from nx584 import event_queue
+
+LOG = logging.getLogger('async_api')
+
+MAX_HEADERS = 100
+MAX_BODY = 1048576
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class BadRequest(Exception):
+    pass
+
+
+class Args(dict):
+    """Query arguments, like a (very small) werkzeug MultiDict."""
+    def get(self, key, default=None):
+        values = super(Args, self).get(key)
+        return values[0] if values else default
+
+    def getlist(self, key):
+        return super(Args, self).get(key, [])
+
+
+class Request(object):
+    __slots__ = ('method', 'target', 'path', 'query', 'args', 'version',
+                 'headers', 'body')
+
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = body
+        path, _, self.query = target.partition('?')
+        self.path = urllib.parse.unquote(path)
+        self.args = Args(urllib.parse.parse_qs(self.query))
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+async def read_request(reader):
+    """Read one request from reader.
+
+    :returns: A Request, or None if the connection was closed
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise BadRequest('Invalid request line %r' % line)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise BadRequest('Too many headers')
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise BadRequest('Invalid Content-Length')
+    if length > MAX_BODY:
+        raise BadRequest('Request too large')
+    body = await reader.readexactly(length) if length else b''
+    return Request(method, target, version, headers, body)
+
+
+def format_response(status, body=b'', content_type=None, headers=(),
+                    keep_alive=True):
+    """The bytes of an HTTP response, with body (bytes or str)."""
+    if isinstance(body, str):
+        body = body.encode()
+    if isinstance(status, int):
+        status = '%i %s' % (status, REASONS.get(status, ''))
+    lines = ['HTTP/1.1 %s' % status]
+    headers = list(headers)
+    names = set(name.lower() for name, value in headers)
+    if content_type and 'content-type' not in names:
+        headers.append(('Content-Type', content_type))
+    if 'content-length' not in names:
+        headers.append(('Content-Length', str(len(body))))
+    headers.append(('Connection', keep_alive and 'keep-alive' or 'close'))
+    lines.extend('%s: %s' % header for header in headers)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+class Server(object):
+    """Serves the API for api.CONTROLLER."""
+    def __init__(self, heartbeat=15):
+        self.heartbeat = heartbeat
+        self._loop = None
+        self._server = None
+        # writer -> the task handling its connection
+        self._connections = {}
+        # (key, value) (or None for unfiltered) -> set of (filter, future)
+        self._waiters = collections.defaultdict(set)
+
+    @property
+    def waiting(self):
+        """How many requests are waiting for events."""
+        return len(set().union(*self._waiters.values()))
+
+    async def start(self, host, port):
+        self._loop = asyncio.get_running_loop()
+        api.CONTROLLER.event_queue.add_listener(self._event_listener)
+        self._server = await asyncio.start_server(self._connection, host,
+                                                  port)
+        LOG.info('Listening on %s' % ', '.join(
+            '%s:%i' % sock.getsockname()[:2]
+            for sock in self._server.sockets))
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        api.CONTROLLER.event_queue.remove_listener(self._event_listener)
+        self._server.close()
+        for task in list(self._connections.values()):
+            task.cancel()
+        await self._server.wait_closed()
+
+    def _event_listener(self, event):
+        # Called from whichever thread pushed the event
+        self._loop.call_soon_threadsafe(self._event_pushed, event)
+
+    def _event_pushed(self, event):
+        keys = [None] + event_queue.index_keys(event.payload)
+        for key in keys:
+            for event_filter, future in self._waiters.get(key, ()):
+                if future.done():
+                    continue
+                if not event_filter or event_filter.matches(
+                        event.payload):
+                    future.set_result(None)
+
+    def _add_waiter(self, event_filter):
+        """Register to be woken by the next event matching event_filter."""
+        entry = (event_filter, self._loop.create_future())
+        for key in _waiter_keys(event_filter):
+            self._waiters[key].add(entry)
+        return entry
+
+    def _remove_waiter(self, entry):
+        for key in _waiter_keys(entry[0]):
+            self._waiters[key].discard(entry)
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    async def _wait(self, entry, timeout):
+        """Wait up to timeout seconds for the waiter entry to be woken."""
+        future = entry[1]
+        timer = self._loop.call_later(timeout, _resolve, future)
+        try:
+            await future
+        finally:
+            timer.cancel()
+
+    async def _connection(self, reader, writer):
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except BadRequest as ex:
+                    LOG.debug('Bad request: %s' % ex)
+                    writer.write(format_response(400, str(ex),
+                                                 'text/plain',
+                                                 keep_alive=False))
+                    break
+                if request is None:
+                    break
+                keep_alive = await self._handle(request, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.CancelledError):
+            pass
+        except Exception:
+            LOG.exception('Failed to handle request')
+        finally:
+            del self._connections[writer]
+            writer.close()
+
+    async def _handle(self, request, writer):
+        """Handle one request, writing the response to writer.
+
+        :returns: Whether to keep the connection open
+        """
+        if request.method == 'GET' and request.path == '/events':
+            handler = self._get_events
+        elif request.method == 'GET' and request.path == '/events/stream':
+            return await self._stream_events(request, writer)
+        elif 'wait' in request.args:
+            # Waiting for a command blocks until the panel answers (which
+            # an AsyncNXController would do on this loop), so use a
+            # thread. Few enough requests do this for that to be fine.
+            handler = self._wsgi_in_thread
+        else:
+            handler = self._wsgi
+        try:
+            response = await handler(request)
+        except Exception:
+            LOG.exception('Failed to handle %s %s' % (request.method,
+                                                      request.target))
+            response = (500, 'Internal Server Error', 'text/plain', ())
+        status, body, content_type, headers = response
+        writer.write(format_response(status, body, content_type, headers,
+                                     request.keep_alive))
+        return request.keep_alive
+
+    async def _wsgi_in_thread(self, request):
+        return await self._loop.run_in_executor(None, self._call_wsgi,
+                                                request)
+
+    async def _wsgi(self, request):
+        return self._call_wsgi(request)
+
+    def _call_wsgi(self, request):
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': request.path,
+            'QUERY_STRING': request.query,
+            'SERVER_NAME': 'nx584',
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': request.version,
+            'CONTENT_LENGTH': str(len(request.body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(request.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers.items():
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            environ[key] = value
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        result = api.app.wsgi_app(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        status, headers = started
+        return status, body, None, headers
+
+    async def _poll(self, index, event_filter):
+        """Poll the event queue without waiting for events.
+
+        Reading old events back from the log, or waiting for a push to
+        finish writing to it, would hold up the loop, so that is left to
+        a thread.
+        """
+        queue = api.CONTROLLER.event_queue
+        result = queue.poll_nowait(index, event_filter)
+        if result is None:
+            result = await self._loop.run_in_executor(
+                None, queue.poll, index, 0, event_filter)
+        return result
+
+    async def _next_events(self, index, event_filter, timeout):
+        """Poll for events after index, waiting up to timeout for one.
+
+        Returns at once if events were missed. The waiter is registered
+        before polling, as the poll may give up the loop while it is
+        done in a thread, and an event pushed meanwhile must wake it.
+        """
+        entry = self._add_waiter(event_filter)
+        try:
+            events, missed, last = await self._poll(index, event_filter)
+            if not events and not missed and timeout > 0:
+                await self._wait(entry, timeout)
+                events, missed, last = await self._poll(index, event_filter)
+            return events, missed, last
+        finally:
+            self._remove_waiter(entry)
+
+    async def _get_events(self, request):
+        args = request.args
+        try:
+            index = int(args.get('index', 0))
+            timeout = int(args.get('timeout', 10))
+            event_filter = api.parse_event_filter(args)
+        except ValueError:
+            return 400, 'Invalid event filter', 'text/plain', ()
+        events, missed, index = await self._next_events(index, event_filter,
+                                                        timeout)
+        if events:
+            events = [event.payload for event in events]
+        return (200, json.dumps({'events': events,
+                                 'index': index,
+                                 'missed': missed}),
+                'application/json', ())
+
+    async def _stream_events(self, request, writer):
+        index = request.headers.get('last-event-id',
+                                    request.args.get('index', 0))
+        try:
+            index = int(index)
+            heartbeat = int(request.args.get('heartbeat', self.heartbeat))
+            event_filter = api.parse_event_filter(request.args)
+        except ValueError:
+            writer.write(format_response(400, 'Invalid arguments',
+                                         'text/plain',
+                                         keep_alive=request.keep_alive))
+            return request.keep_alive
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\n'
+                     b'Transfer-Encoding: chunked\r\n'
+                     b'Connection: close\r\n\r\n')
+        events, missed, index = await self._poll(index, event_filter)
+        while True:
+            messages = []
+            if missed:
+                messages.append(api.sse_message({'missed': missed},
+                                                event='missed'))
+            if events:
+                messages.extend(api.sse_message(event.payload,
+                                                event_id=event.number)
+                                for event in events)
+            else:
+                messages.append(api.SSE_KEEPALIVE)
+            writer.write(_chunk(''.join(messages).encode()))
+            await writer.drain()
+            events, missed, index = await self._next_events(
+                index, event_filter, heartbeat)
+
+
+def _chunk(data):
+    return b'%x\r\n%s\r\n' % (len(data), data)
+
+
+def _waiter_keys(event_filter):
+    return event_filter.waiter_keys() if event_filter else [None]
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+async def serve(controller, host, port):
+    """Serve the API for controller until cancelled.
+
+    An AsyncNXController is run on the same event loop; any other
+    controller gets a thread of its own, as with the Flask server.
+    """
+    api.CONTROLLER = controller
+    server = Server()
+    await server.start(host, port)
+    runner = None
+    if isinstance(controller, async_controller.AsyncNXController):
+        runner = asyncio.ensure_future(controller.run())
+    else:
+        t = threading.Thread(target=controller.controller_loop_safe)
+        t.daemon = True
+        t.start()
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+        if runner is not None:
+            controller.stop()
+            await runner
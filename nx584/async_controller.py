@@ -0,0 +1,315 @@
+"""An asyncio implementation of the panel connection.
+
+AsyncNXController handles panel messages exactly like NXController, but
+talks to the panel through asyncio transports instead of a thread
+polling the stream with read timeouts. Nothing runs while the panel and
+the API are quiet, other than the idle heartbeat timer.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import serial
+
+from nx584 import codec
+from nx584 import controller
+
+
+LOG = logging.getLogger('async_controller')
+
+
+class NXStreamProtocol(asyncio.Protocol):
+    """Feeds data from a panel transport through a frame decoder."""
+
+    # How long we wait for the rest of a frame once it has started
+    MID_FRAME_TIMEOUT = 0.5
+
+    def __init__(self, decoder, frame_received):
+        self._decoder = decoder
+        self._frame_received = frame_received
+        self._loop = asyncio.get_running_loop()
+        self._mid_frame = None
+        self.transport = None
+        self.closed = self._loop.create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        decoder = self._decoder
+        decoder.feed(data)
+        try:
+            while True:
+                frame = decoder.next_frame()
+                if frame is None:
+                    break
+                self._frame_received(frame)
+        except controller.ConnectionLost as e:
+            LOG.warning('Connection terminated: %s' % e)
+            self.transport.close()
+            return
+
+        if self._mid_frame is not None:
+            self._mid_frame.cancel()
+            self._mid_frame = None
+        if decoder.in_frame:
+            self._mid_frame = self._loop.call_later(self.MID_FRAME_TIMEOUT,
+                                                    self._mid_frame_timeout)
+
+    def _mid_frame_timeout(self):
+        self._mid_frame = None
+        LOG.error('Mid-frame read timeout (got %i bytes)' % (
+            self._decoder.partial_length))
+        self.transport.close()
+
+    def connection_lost(self, exc):
+        if self._mid_frame is not None:
+            self._mid_frame.cancel()
+            self._mid_frame = None
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+
+class AsyncNXController(controller.NXController):
+    """NXController driven by an asyncio event loop.
+
+    Start it with ``await ctrl.run()``. The command methods may be called
+    from any thread, and return a concurrent.futures.Future as
+    NXController does. A coroutine which wants the panel's reply can
+    wrap it::
+
+        await asyncio.wrap_future(ctrl.arm_stay(1))
+
+    subscribe() provides events as an async iterator.
+    """
+
+    RECONNECT_DELAY = 10
+
+    def __init__(self, portspec, configfile):
+        super(AsyncNXController, self).__init__(portspec, configfile)
+        self.running = False
+        self._loop = None
+        self._protocol = None
+        self._transports = []
+        self._writer = None
+        self._encode = None
+        self._wakeup = None
+        self._stopped = None
+        self._heartbeat = None
+        self._checkpointer = None
+        self._saving = None
+        self._watchdog = 0
+        self._subscribers = set()
+
+    def _on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _call_on_loop(self, fn, *args):
+        if self._on_loop():
+            fn(*args)
+        else:
+            self._loop.call_soon_threadsafe(fn, *args)
+
+    def _queue_changed(self):
+        if self._loop is not None:
+            self._call_on_loop(self._wakeup.set)
+
+    def _send(self, data):
+        if self._writer is None or self._writer.is_closing():
+            LOG.warning('Not connected, unable to send %r' % data)
+            return False
+        self._writer.write(self._encode(data))
+        return True
+
+    async def _open(self):
+        binary = self._config.getboolean('config', 'use_binary_protocol',
+                                         fallback=False)
+        if binary:
+            decoder = controller.NXBinaryDecoder()
+            self._encode = codec.encode_binary_frame
+        else:
+            decoder = controller.NXASCIIDecoder()
+            self._encode = codec.encode_ascii_frame
+        protocol = NXStreamProtocol(decoder, self._frame_received)
+
+        LOG.debug('Connecting...')
+        if self._uses_serial:
+            port, baudrate = self._portspec
+            ser = serial.Serial(port, baudrate, timeout=0)
+            reader, _ = await self._loop.connect_read_pipe(
+                lambda: protocol, ser)
+            # Writes go through a second transport on a copy of the fd,
+            # as asyncio pipe transports only go in one direction.
+            writer, _ = await self._loop.connect_write_pipe(
+                asyncio.BaseProtocol,
+                os.fdopen(os.dup(ser.fileno()), 'wb', buffering=0))
+            self._transports = [reader, writer]
+        else:
+            host, port = self._portspec
+            writer, _ = await self._loop.create_connection(
+                lambda: protocol, host, port)
+            self._transports = [writer]
+
+        self._protocol = protocol
+        self._writer = writer
+        LOG.info('Connected')
+
+    def _close(self):
+        for transport in self._transports:
+            transport.close()
+        self._transports = []
+        self._writer = None
+
+    def _frame_received(self, data):
+        self._watchdog = time.time()
+        frame = self._decode_frame(data)
+        if frame is None:
+            return
+        self._handle_frame(frame)
+        if self._commands:
+            # The frame may have made room to send the next command
+            self._wakeup.set()
+
+    def _schedule_heartbeat(self):
+        delay = self._watchdog + self._idle_time_heartbeat_seconds
+        self._heartbeat = self._loop.call_later(max(0, delay - time.time()),
+                                                self._heartbeat_due)
+
+    def _heartbeat_due(self):
+        if time.time() - self._watchdog >= self._idle_time_heartbeat_seconds:
+            # After time with no activity - generate something to make
+            # sure we are still alive
+            LOG.info('No activity for a while, heartbeating')
+            self.generate_heartbeat_activity()
+            self._watchdog = time.time()
+        self._schedule_heartbeat()
+
+    def _checkpoint_due(self):
+        # The state is gathered here, but written (and synced to disk) by
+        # a thread. If the last write is still going, try again next time.
+        if self._saving is None or self._saving.done():
+            state = self._checkpoint_state(False)
+            if state is not None:
+                self._saving = self._loop.run_in_executor(
+                    None, self._state_store.save, state)
+        self._checkpointer = self._loop.call_later(
+            self._checkpoint_interval, self._checkpoint_due)
+
+    async def _sender(self):
+        while True:
+            self._run_queue()
+            self._wakeup.clear()
+            deadline = self._commands.next_deadline
+            if deadline is not None:
+                deadline = max(0, deadline - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), deadline)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _session(self):
+        self._watchdog = time.time()
+        self._request_initial_state()
+        self._schedule_heartbeat()
+        sender = self._loop.create_task(self._sender())
+        try:
+            exc = await self._protocol.closed
+            if self.running:
+                LOG.warning('Connection terminated: %s' % exc)
+        finally:
+            sender.cancel()
+            self._heartbeat.cancel()
+            self._close()
+            self._commands.connection_lost()
+
+    async def run(self):
+        """Talk to the panel until stop() is called, reconnecting as needed."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._stopped = asyncio.Event()
+        self.running = True
+        self.event_queue.add_listener(self._event_pushed)
+        self._build_dispatch()
+        if self._state_store is not None:
+            self._checkpoint_due()
+        try:
+            while self.running:
+                try:
+                    await self._open()
+                except (OSError, serial.SerialException) as ex:
+                    LOG.error('Failed to connect: %s' % ex)
+                else:
+                    # stop() may have been called while connecting
+                    if self.running:
+                        await self._session()
+                if not self.running:
+                    break
+                LOG.warning('Waiting %is before reconnecting...' % (
+                    self.RECONNECT_DELAY))
+                try:
+                    await asyncio.wait_for(self._stopped.wait(),
+                                           self.RECONNECT_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.event_queue.remove_listener(self._event_pushed)
+            if self._checkpointer is not None:
+                self._checkpointer.cancel()
+            if self._saving is not None:
+                await self._saving
+            # Waits for mail to be sent, so keep it off the loop
+            await self._loop.run_in_executor(None, self.flush)
+            self._close()
+            self._loop = None
+
+    def stop(self):
+        """Disconnect from the panel and make run() return."""
+        self.running = False
+        if self._loop is not None:
+            self._call_on_loop(self._shutdown)
+
+    def _shutdown(self):
+        self._stopped.set()
+        self._close()
+
+    def controller_loop_safe(self):
+        asyncio.run(self.run())
+
+    def _event_pushed(self, event):
+        if self._subscribers:
+            self._call_on_loop(self._publish, event)
+
+    def _publish(self, event):
+        for queue in self._subscribers:
+            queue.put_nowait(event)
+
+    async def subscribe(self, index=None):
+        """Iterate over events as they are added to the event queue.
+
+        :param index: If given, first yield any queued events after this
+                      event number
+        """
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        try:
+            last = self.event_queue.current if index is None else index
+            result = self.event_queue.poll_nowait(last)
+            if result is None:
+                # Old events are read back from the log on disk
+                result = await asyncio.get_running_loop().run_in_executor(
+                    None, self.event_queue.poll, last, 0)
+            for event in result[0] or []:
+                last = event.number
+                yield event
+            while True:
+                event = await queue.get()
+                # Skip anything we already returned from the backlog
+                if event.number > last:
+                    last = event.number
+                    yield event
+        finally:
+            self._subscribers.discard(queue)
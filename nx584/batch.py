@@ -0,0 +1,139 @@
+"""Batches of operations, as sent to POST /commands.
+
+A batch is a list of operations, each a dict with an 'op' of:
+
+arm: arm partition (default 1), with type stay, exit or auto (default)
+disarm: disarm partition (default 1) with master_pin
+bypass: set zone bypassed to true or false
+refresh: ask for the status of zone or partition, or of the system if
+         neither is given
+
+The whole batch is checked before anything is sent. Bypass operations
+only toggle zones which are not already in the state asked for, and
+only the last operation for a zone counts.
+"""
+import logging
+
+LOG = logging.getLogger('batch')
+
+ARM_TYPES = ('stay', 'exit', 'auto')
+MAX_ZONE = 192
+MAX_PARTITION = 8
+
+
+class InvalidBatch(Exception):
+    """Some operations were invalid.
+
+    errors lists, for each operation, what is wrong with it or None.
+    """
+    def __init__(self, errors):
+        super(InvalidBatch, self).__init__('Invalid operations')
+        self.errors = errors
+
+
+def _number(operation, key, maximum, default=None):
+    value = operation.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError('%s must be a number' % key)
+    if not 1 <= value <= maximum:
+        raise ValueError('%s must be between 1 and %i' % (key, maximum))
+    return value
+
+
+def _parse(controller, operation):
+    """Check one operation.
+
+    :returns: A tuple of (zone, bypassed) for bypass operations, otherwise
+              a function which queues its command
+    :raises: ValueError describing the problem
+    """
+    if not isinstance(operation, dict):
+        raise ValueError('Operation must be an object')
+    op = operation.get('op')
+    if op == 'arm':
+        armtype = operation.get('type', 'auto')
+        if armtype not in ARM_TYPES:
+            raise ValueError('Invalid arm type %r' % armtype)
+        partition = _number(operation, 'partition', MAX_PARTITION, 1)
+        method = getattr(controller, 'arm_%s' % armtype)
+        return lambda: method(partition)
+    elif op == 'disarm':
+        partition = _number(operation, 'partition', MAX_PARTITION, 1)
+        pin = operation.get('master_pin')
+        if (not isinstance(pin, str) or not pin.isdigit() or
+                len(pin) not in (4, 6)):
+            raise ValueError('master_pin must be 4 or 6 digits')
+        return lambda: controller.disarm(pin, partition)
+    elif op == 'bypass':
+        zone = _number(operation, 'zone', MAX_ZONE)
+        if zone not in controller.zones:
+            raise ValueError('Unknown zone %i' % zone)
+        bypassed = operation.get('bypassed')
+        if not isinstance(bypassed, bool):
+            raise ValueError('bypassed must be true or false')
+        return zone, bypassed
+    elif op == 'refresh':
+        if 'zone' in operation:
+            zone = _number(operation, 'zone', MAX_ZONE)
+            return lambda: controller.get_zone_status(zone)
+        elif 'partition' in operation:
+            partition = _number(operation, 'partition', MAX_PARTITION)
+            return lambda: controller.get_partition_status(partition)
+        return controller.get_system_status
+    raise ValueError('Unknown operation %r' % op)
+
+
+def plan(controller, operations):
+    """Check a batch and work out what to send for it.
+
+    :returns: A list with, for each operation, a tuple of (a function
+              which queues its command or None, its status): queued, or
+              for bypass operations with nothing to send, unchanged or
+              superseded (by a later operation for the same zone)
+    :raises: InvalidBatch
+    """
+    parsed = []
+    errors = []
+    for operation in operations:
+        try:
+            parsed.append(_parse(controller, operation))
+            errors.append(None)
+        except ValueError as ex:
+            parsed.append(None)
+            errors.append(str(ex))
+    if any(errors):
+        raise InvalidBatch(errors)
+
+    last = {}
+    for index, item in enumerate(parsed):
+        if isinstance(item, tuple):
+            last[item[0]] = index
+    steps = []
+    for index, item in enumerate(parsed):
+        if not isinstance(item, tuple):
+            steps.append((item, 'queued'))
+            continue
+        zone, bypassed = item
+        if last[zone] != index:
+            steps.append((None, 'superseded'))
+        elif controller.zones[zone].bypassed == bypassed:
+            steps.append((None, 'unchanged'))
+        else:
+            steps.append((lambda zone=zone:
+                          controller.zone_bypass_toggle(zone), 'queued'))
+    return steps
+
+
+def run(controller, steps):
+    """Queue the commands for a planned batch as one group.
+
+    :returns: A list of (future or None, status) for each operation
+    """
+    results = []
+    with controller.command_group():
+        for queue, status in steps:
+            results.append((queue() if queue else None, status))
+    LOG.info('Queued %i commands for a batch of %i operations' % (
+        len([future for future, status in results if future]),
+        len(results)))
+    return results
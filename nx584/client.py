@@ -3,11 +3,19 @@ import requests
 import time
 
 
+class StreamingNotSupported(Exception):
+    pass
+
+
 class Client(object):
     def __init__(self, url):
         self._url = url
         self._session = requests.Session()
         self._last_event_index = 0
+        # How many events the server no longer had at the last get_events()
+        self.missed_events = 0
+        # Why each operation was invalid, after a failed run_commands()
+        self.invalid_operations = None
 
     def list_zones(self):
         r = self._session.get(self._url + '/zones')
@@ -23,31 +31,62 @@ class Client(object):
         except TypeError:
             return r.json()['partitions']
 
-    def arm(self, armtype='auto', partition=1):
+    def arm(self, armtype='auto', partition=1, wait=None):
+        """Arm a partition.
+
+        If wait is given, wait up to that many seconds for the panel to
+        confirm the partition's new state before returning.
+        """
         if armtype not in ['stay', 'exit', 'auto']:
             raise Exception('Invalid arm type')
-        r = self._session.get(
-            self._url + '/command',
-            params={'cmd': 'arm',
-                    'type': armtype,
-                    'partition': partition})
+        params = {'cmd': 'arm',
+                  'type': armtype,
+                  'partition': partition}
+        if wait:
+            params['wait'] = wait
+        r = self._session.get(self._url + '/command', params=params)
         return r.status_code == 200
 
-    def disarm(self, master_pin, partition=1):
-        r = self._session.get(
-            self._url + '/command',
-            params={'cmd': 'disarm',
-                    'master_pin': master_pin,
-                    'partition': partition})
+    def disarm(self, master_pin, partition=1, wait=None):
+        params = {'cmd': 'disarm',
+                  'master_pin': master_pin,
+                  'partition': partition}
+        if wait:
+            params['wait'] = wait
+        r = self._session.get(self._url + '/command', params=params)
         return r.status_code == 200
 
-    def set_bypass(self, zone, bypass):
+    def set_bypass(self, zone, bypass, wait=None):
         data = {'bypassed': bypass}
         r = self._session.put(self._url + '/zones/%i' % zone,
+                              params=wait and {'wait': wait} or None,
                               data=json.dumps(data),
                               headers={'Content-Type': 'application/json'})
         return r.status_code == 200
 
+    def run_commands(self, operations, wait=None):
+        """Send a batch of operations (see nx584.batch) to run in order.
+
+        If wait is given, wait up to that many seconds for the panel to
+        answer each command, and report whether it was done, rejected,
+        failed or timed out instead of just queued.
+
+        :returns: The result of each operation, or None if any were
+                  invalid (with the reasons in invalid_operations)
+        """
+        params = {}
+        if wait:
+            params['wait'] = wait
+        r = self._session.post(self._url + '/commands', params=params,
+                               data=json.dumps(operations),
+                               headers={'Content-Type': 'application/json'})
+        self.invalid_operations = None
+        if r.status_code == 200:
+            return r.json()['results']
+        if r.status_code == 400 and r.headers.get(
+                'Content-Type') == 'application/json':
+            self.invalid_operations = r.json()['errors']
+
     def get_user(self, master_pin, user_number):
         params = {}
         while True:
@@ -77,19 +116,66 @@ class Client(object):
         if r.status_code == 200:
             return r.json()
 
-    def get_events(self, index=None, timeout=None):
+    def get_events(self, index=None, timeout=None, **filters):
+        """Get new events, waiting up to timeout seconds for one.
+
+        Keyword arguments type, zone, partition and event (each a value
+        or a list of values) limit the events returned to those matching.
+        """
         if index is None:
             index = self._last_event_index
         if timeout is None:
             timeout = 60
-        r = self._session.get(self._url + '/events',
-                              params={'index': index,
-                                      'timeout': timeout})
+        params = dict(filters, index=index, timeout=timeout)
+        r = self._session.get(self._url + '/events', params=params)
         if r.status_code == 200:
             data = r.json()
             self._last_event_index = data['index']
+            self.missed_events = data.get('missed', 0)
             return data['events']
 
+    def stream_events(self, **filters):
+        """Yield events as the server sends them.
+
+        Resumes after the last event seen by this client. Takes the same
+        filters as get_events(). Returns when the server closes the
+        stream.
+
+        :raises: StreamingNotSupported if the server is too old to stream
+        """
+        headers = {'Accept': 'text/event-stream',
+                   'Last-Event-ID': str(self._last_event_index)}
+        r = self._session.get(self._url + '/events/stream', params=filters,
+                              headers=headers, stream=True)
+        if r.status_code == 404:
+            raise StreamingNotSupported()
+        r.raise_for_status()
+        kind = event_id = None
+        data = []
+        with r:
+            for line in r.iter_lines(decode_unicode=True):
+                if line:
+                    field, _, value = line.partition(':')
+                    value = value[1:] if value.startswith(' ') else value
+                    if field == 'id':
+                        event_id = value
+                    elif field == 'event':
+                        kind = value
+                    elif field == 'data':
+                        data.append(value)
+                    continue
+                if data:
+                    payload = json.loads('\n'.join(data))
+                    if kind == 'missed':
+                        self.missed_events = payload['missed']
+                    else:
+                        if event_id is not None:
+                            self._last_event_index = int(event_id)
+                        yield payload
+                        self.missed_events = 0
+                kind = event_id = None
+                data = []
+
     def get_version(self):
         r = self._session.get(self._url + '/version')
         if r.status_code == 404:
@@ -0,0 +1,78 @@
+"""Wire-level encoding for the NX584 ASCII and binary protocols.
+
+Everything here works on bytes-like objects (bytes, bytearray or
+memoryview) and leaves the per-byte work to C where possible.
+"""
+import binascii
+import itertools
+
+
+def fletcher16(data):
+    """The panel's Fletcher-16 checksum of a frame (length byte onwards).
+
+    :returns: A (sum1, sum2) tuple
+    """
+    # sum2 is the sum of all the running totals of sum1, so both can be
+    # computed without a Python-level loop and reduced once at the end.
+    return sum(data) % 255, sum(itertools.accumulate(data)) % 255
+
+
+def encode_hex(data):
+    """Encode bytes as upper case hex, as used by the ASCII protocol."""
+    return binascii.hexlify(data).upper()
+
+
+def decode_hex(data):
+    """Decode an ASCII protocol hex string (str or bytes) to bytes.
+
+    :raises: ValueError if the data is not valid hex
+    """
+    return binascii.unhexlify(data)
+
+
+def encode_pin(digits):
+    """Pack up to six PIN digits into three bytes, two digits per byte.
+
+    Missing digit pairs are sent as 0xFF.
+    """
+    pinbuf = bytearray(b'\xff\xff\xff')
+    for i in range(3):
+        try:
+            pinbuf[i] = ((int(digits[i * 2 + 1]) << 4) |
+                         int(digits[i * 2]))
+        except (IndexError, TypeError):
+            pass
+    return bytes(pinbuf)
+
+
+def stuff(data):
+    """Escape any start or escape bytes in a binary protocol frame."""
+    # Two replace() passes in C beat any per-byte table walk in Python
+    # for frames this size. Escapes must be handled first so that the
+    # escapes we add for start bytes are not escaped again.
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    return data.replace(b'\x7d', b'\x7d\x5d').replace(b'\x7e', b'\x7d\x5e')
+
+
+def _frame(data):
+    frame = bytearray(data)
+    frame.insert(0, len(frame))
+    frame += bytes(fletcher16(frame))
+    return frame
+
+
+def encode_ascii_frame(data):
+    """Build a complete ASCII protocol frame for a message.
+
+    :param: data is the message type and payload
+    """
+    return b'\n' + encode_hex(_frame(data)) + b'\r'
+
+
+def encode_binary_frame(data):
+    """Build a complete binary protocol frame for a message.
+
+    :param: data is the message type and payload
+    """
+    return b'\x7e' + stuff(_frame(data))
@@ -2,48 +2,67 @@ try:
     import ConfigParser as configparser
 except ImportError:
     import configparser
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import datetime
+import io
 import logging
+import selectors
 import serial
 import socket
+import threading
 import time
 
 import stevedore.extension
 
+from nx584 import codec
+from nx584 import event_log
 from nx584 import event_queue
+from nx584 import extensions
 from nx584 import mail
 from nx584 import model
+from nx584 import persist
+from nx584 import scheduler
 
 
 LOG = logging.getLogger('controller')
 
 
 def parse_ascii(data):
-    data_bytes = []
-    for i in range(0, len(data), 2):
-        data_bytes.append(int(data[i:i + 2], 16))
-    return data_bytes
+    return list(codec.decode_hex(data))
 
 
 def make_ascii(data):
-    data_chars = []
-    for b in data:
-        data_chars.append('%02X' % b)
-    return ''.join(data_chars)
+    return codec.encode_hex(bytes(data)).decode()
 
 
 def make_pin_buffer(digits):
-    pinbuf = []
-    for i in range(0, 6, 2):
-        try:
-            pinbuf.append((int(digits[i + 1]) << 4) | int(digits[i]))
-        except (IndexError, TypeError):
-            pinbuf.append(0xFF)
-    return pinbuf
+    return list(codec.encode_pin(digits))
+
+
+def _optional_int(value):
+    return None if value is None else int(value)
+
+
+def _optional_bool(value):
+    if value is not None and not isinstance(value, bool):
+        raise ValueError('Expected true, false or null, not %r' % (value,))
+    return value
+
+
+def _number(value):
+    # Zone and partition numbers, which are saved as JSON numbers
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError('Invalid number %r' % (value,))
+    return value
 
 
 def fletcher(data, k=16):
-    if  k not in (16, 32, 64):
+    if k == 16:
+        return codec.fletcher16(data)
+    if k not in (32, 64):
         raise ValueError("Valid choices of k are 16, 32 and 64")
     nbytes = k // 16
     mod = 2 ** (8 * nbytes) - 1
@@ -58,37 +77,189 @@ def fletcher(data, k=16):
 
 
 class NXFrame(object):
-    def __init__(self):
-        self.length = 0
-        self.msgtype = 0
-        self.checksum = 0
-        self.data = []
-        self.ackreq = False
+    """A received message, backed by the immutable bytes of its frame.
+
+    The raw frame includes the length byte, the message type and the
+    trailing checksum. Subclasses registered in FRAME_TYPES describe the
+    payload of specific message types with field accessors, which read
+    straight out of the raw frame rather than copying it.
+    """
+    __slots__ = ('raw',)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    @property
+    def length(self):
+        return self.raw[0]
+
+    @property
+    def msgtype(self):
+        return self.raw[1] & 0x7F
+
+    @property
+    def ackreq(self):
+        return bool(self.raw[1] & 0x80)
 
     @property
     def ack_required(self):
         return self.ackreq
 
+    @property
+    def checksum(self):
+        return (self.raw[-2] << 8) | self.raw[-1]
+
+    @property
+    def data(self):
+        return memoryview(self.raw)[2:-2]
+
     @staticmethod
     def decode_line(line_bytes):
-        self = NXFrame()
+        if not isinstance(line_bytes, bytes):
+            line_bytes = bytes(line_bytes)
 
-        s1, s2 = fletcher(line_bytes[:-2])
-        if [s1, s2] != line_bytes[-2:]:
+        s1, s2 = codec.fletcher16(memoryview(line_bytes)[:-2])
+        if s1 != line_bytes[-2] or s2 != line_bytes[-1]:
             raise ReadFailure('Checksum mismatch on received frame')
 
-        self.length = line_bytes[0]
-        msgtypefield = line_bytes[1]
-        self.checksum = (line_bytes[-2] << 8) & line_bytes[-1]
-        self.data = line_bytes[2:-2]
-        self.ackreq = bool(msgtypefield & 0x80)
-        self.msgtype = msgtypefield & 0x7F
-        return self
+        cls = FRAME_TYPES.get(line_bytes[1] & 0x7F, NXFrame)
+        return cls(line_bytes)
 
     @property
     def type_name(self):
         return model.MSG_TYPES[self.msgtype]
 
+    def __repr__(self):
+        return '%s<%s>' % (self.__class__.__name__,
+                           codec.encode_hex(self.data).decode())
+
+
+class Field(object):
+    """A single payload byte of a message, optionally masked and offset."""
+    def __init__(self, offset, mask=0xFF, add=0):
+        # Payload offsets are relative to the message type byte
+        self._index = offset + 2
+        self._mask = mask
+        self._add = add
+
+    def __get__(self, frame, owner):
+        if frame is None:
+            return self
+        return (frame.raw[self._index] & self._mask) + self._add
+
+
+class Flag(object):
+    """A single bit of a payload byte, as a boolean."""
+    def __init__(self, offset, bit):
+        self._index = offset + 2
+        self._bit = bit
+
+    def __get__(self, frame, owner):
+        if frame is None:
+            return self
+        return bool(frame.raw[self._index] & self._bit)
+
+
+class Bytes(object):
+    """A range of payload bytes, as a view on the frame."""
+    def __init__(self, start, end=None):
+        self._start = start + 2
+        # Stop short of the checksum if no end is given
+        self._end = -2 if end is None else end + 2
+
+    def __get__(self, frame, owner):
+        if frame is None:
+            return self
+        return memoryview(frame.raw)[self._start:self._end]
+
+
+class ZoneNameFrame(NXFrame):
+    __slots__ = ()
+    zone = Field(0, add=1)
+    name = Bytes(1)
+
+
+class ZoneStatusFrame(NXFrame):
+    __slots__ = ()
+    zone = Field(0, add=1)
+    partition_mask = Field(1)
+    type_bytes = Bytes(2, 5)
+    condition = Field(5)
+
+
+class ZonesSnapshotFrame(NXFrame):
+    __slots__ = ()
+    # Zones are reported in groups of 16, one nibble each
+    offset = Field(0)
+    status_bytes = Bytes(1, 9)
+
+
+class PartitionStatusFrame(NXFrame):
+    __slots__ = ()
+    partition = Field(0, add=1)
+    last_user = Field(5)
+
+    @property
+    def condition_bytes(self):
+        # The condition flags are split around the last user byte
+        raw = self.raw
+        return raw[3], raw[4], raw[5], raw[6], raw[8], raw[9]
+
+
+class PartitionsSnapshotFrame(NXFrame):
+    __slots__ = ()
+    # One byte per partition
+    status_bytes = Bytes(0, 8)
+
+
+class SystemStatusFrame(NXFrame):
+    __slots__ = ()
+    panel_id = Field(0)
+    status_bytes = Bytes(1, 10)
+
+
+class X10MessageFrame(NXFrame):
+    __slots__ = ()
+    house = Field(0)
+    unit = Field(1)
+    function = Field(2)
+
+
+class LogEventFrame(NXFrame):
+    __slots__ = ()
+    number = Field(0)
+    log_size = Field(1)
+    event_type = Field(2, mask=0x7F)
+    reportable = Flag(2, 0x80)
+    zone_user_device = Field(3, add=1)
+    partition = Field(4)
+    month = Field(5)
+    day = Field(6)
+    hour = Field(7)
+    minute = Field(8)
+
+
+class UserInfoFrame(NXFrame):
+    __slots__ = ()
+    user = Field(0)
+    pin_bytes = Bytes(1, 4)
+    authority = Field(4, mask=0x7F)
+    authority_type = Flag(4, 0x80)
+    partitions = Field(5)
+
+
+FRAME_TYPES = {
+    0x03: ZoneNameFrame,
+    0x04: ZoneStatusFrame,
+    0x05: ZonesSnapshotFrame,
+    0x06: PartitionStatusFrame,
+    0x07: PartitionsSnapshotFrame,
+    0x08: SystemStatusFrame,
+    0x09: X10MessageFrame,
+    0x0A: LogEventFrame,
+    0x12: UserInfoFrame,
+}
+
 
 class ReadTimeout(Exception):
     pass
@@ -102,10 +273,168 @@ class ReadFailure(Exception):
     pass
 
 
+class NXDecoder(object):
+    """Incrementally extract frames from the bytes received from the panel.
+
+    Data is appended with feed() in whatever size chunks the stream
+    provides, and complete frames are returned one at a time by
+    next_frame(). Decoding state is kept between calls, so a frame split
+    across several reads is resumed where it left off.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._pos = 0
+        self._frame = None
+        self.frame_started = None
+
+    @property
+    def in_frame(self):
+        """True if we have seen the start of a frame but not its end."""
+        return self._frame is not None
+
+    @property
+    def partial_length(self):
+        return len(self._frame or b'')
+
+    def feed(self, data):
+        if self._pos:
+            # Drop what we have already consumed, keeping the buffer
+            # object itself for re-use.
+            del self._buffer[:self._pos]
+            self._pos = 0
+        self._buffer += data
+
+    def _start_frame(self):
+        self._frame = bytearray()
+        self.frame_started = time.time()
+
+    def _end_frame(self):
+        frame = self._frame
+        self._frame = None
+        self.frame_started = None
+        return frame
+
+    def _discard(self, start, end):
+        if end > start:
+            LOG.warning('Seeking (discarded %r)' % bytes(
+                self._buffer[start:end]))
+
+    def next_frame(self):
+        """Return the next complete frame, or None if we need more data.
+
+        :returns: The frame bytes, inclusive of the length and checksum
+                  bytes
+        :raises: ConnectionLost if the stream cannot be parsed
+        """
+        return None
+
+
+class NXASCIIDecoder(NXDecoder):
+    def next_frame(self):
+        buf = self._buffer
+        pos = self._pos
+
+        if self._frame is None:
+            start = buf.find(b'\n', pos)
+            if start < 0:
+                self._discard(pos, len(buf))
+                self._pos = len(buf)
+                return None
+            self._discard(pos, start)
+            pos = start + 1
+            self._start_frame()
+
+        end = buf.find(b'\r', pos)
+        if end < 0:
+            # Keep what we have so far and resume the search from the end
+            # of it next time.
+            self._frame += buf[pos:]
+            self._pos = len(buf)
+            return None
+
+        self._frame += buf[pos:end]
+        self._pos = end + 1
+        line = self._end_frame().strip()
+
+        LOG.debug('Parsing ASCII frame %r' % line)
+        try:
+            return codec.decode_hex(line)
+        except Exception:
+            LOG.exception('Failed to parse raw ASCII line %r' % line)
+            raise ConnectionLost()
+
+
+class NXBinaryDecoder(NXDecoder):
+    def __init__(self):
+        super(NXBinaryDecoder, self).__init__()
+        self._escaped = False
+
+    def next_frame(self):
+        buf = self._buffer
+        pos = self._pos
+        end = len(buf)
+
+        while pos < end:
+            frame = self._frame
+            if frame is None:
+                start = buf.find(0x7e, pos)
+                if start < 0:
+                    self._discard(pos, end)
+                    pos = end
+                    break
+                self._discard(pos, start)
+                pos = start + 1
+                self._start_frame()
+                self._escaped = False
+                continue
+
+            if not frame:
+                # The length byte follows the start byte directly
+                frame.append(buf[pos])
+                pos += 1
+                continue
+
+            # Copy everything up to the next special byte in one go
+            need = frame[0] + 3 - len(frame)
+            stop = min(pos + need, end)
+            for special in (0x7d, 0x7e):
+                index = buf.find(special, pos, stop)
+                if index >= 0:
+                    stop = index
+            if stop > pos:
+                if self._escaped:
+                    frame.append(buf[pos] ^ 0x20)
+                    self._escaped = False
+                    frame += buf[pos + 1:stop]
+                else:
+                    frame += buf[pos:stop]
+                pos = stop
+            elif buf[pos] == 0x7e:
+                self._pos = pos
+                self._end_frame()
+                raise ConnectionLost('Received start byte mid-frame!')
+            else:
+                # Adjust any byte stuffed bytes - Skip the current byte if
+                # so, then XOR the following byte with 0x20
+                self._escaped = True
+                pos += 1
+
+            if len(frame) == frame[0] + 3:
+                self._pos = pos
+                return bytes(self._end_frame())
+
+        self._pos = pos
+        return None
+
+
 class NXProtocol(object):
     """Abstract the act of talking to the control panel."""
+    DECODER = NXDecoder
+    READ_SIZE = 4096
+
     def __init__(self, stream):
         self.stream = stream
+        self.decoder = self.DECODER()
 
     def read(self, n):
         """Read bytes from the stream.
@@ -133,6 +462,19 @@ class NXProtocol(object):
         else:
             raise ConnectionLost('What is this stream?')
 
+    def read_available(self):
+        """Read whatever the stream has ready, waiting for at least a byte.
+
+        :raises: ReadTimeout if there is no data
+        :raises: ConnectionLost if something goes wrong
+        """
+        # Serial ports block until the requested number of bytes arrive,
+        # so only ask for what is already waiting.
+        in_waiting = getattr(self.stream, 'in_waiting', None)
+        if isinstance(in_waiting, int):
+            return self.read(max(1, in_waiting))
+        return self.read(self.READ_SIZE)
+
     def write(self, data):
         """Write bytes to the stream.
 
@@ -148,26 +490,38 @@ class NXProtocol(object):
         else:
             raise ConnectionLost('What is this stream?')
 
-    def discard_until(self, byte):
-        """Reads any unexpected data until we encounter an expected byte.
-
-        :raises: ReadTimeout (via self.read()) if we never get it.
-        """
-        while True:
-            c = self.read(1)
-            if c == byte:
-                return c
-            LOG.warning('Seeking (discarded %s %02x)' % (c, c[0]))
-
-    def read_frame(self):
+    def read_frame(self, wait=True):
         """Read a whole frame from the stream.
 
-        :returns: An array of int values, inclusive of the length and checksum
+        :param: wait may be False to only return a frame that has already
+                been read from the stream
+        :returns: The frame bytes, inclusive of the length and checksum
                   bytes
+        :raises: ReadTimeout if there is no data
         :raises: ConnectionLost if something goes wrong or the stream cannot
                  be parsed
         """
-        return []
+        decoder = self.decoder
+        while True:
+            frame = decoder.next_frame()
+            if frame is not None:
+                return frame
+            if not wait:
+                raise ReadTimeout()
+
+            if decoder.in_frame and time.time() - decoder.frame_started > 60:
+                LOG.error('Timeout reading a line, killing connection')
+                raise ConnectionLost()
+
+            try:
+                data = self.read_available()
+            except ReadTimeout:
+                if decoder.in_frame:
+                    LOG.error('Mid-frame read timeout (got %i bytes)' % (
+                        decoder.partial_length))
+                    raise ConnectionLost()
+                raise
+            decoder.feed(data)
 
     def write_frame(self, data):
         """Write a whole frame to the stream.
@@ -180,91 +534,17 @@ class NXProtocol(object):
 
 
 class NXASCII(NXProtocol):
-    def read_frame(self):
-        self.discard_until(b'\n')
-
-        start = time.time()
-        line = ''
-        while not line.endswith('\r'):
-            try:
-                c = self.read(1).decode()
-            except ReadTimeout:
-                LOG.error('Mid-frame read timeout (got %i: %r)' % (
-                    len(line), line))
-                raise ConnectionLost()
-            line += c
-            if time.time() - start > 60:
-                LOG.error('Timeout reading a line, killing connection')
-                raise ConnectionLost()
-
-        LOG.debug('Parsing ASCII frame %r' % line.strip())
-        try:
-            return parse_ascii(line.strip())
-        except Exception:
-            LOG.exception('Failed to parse raw ASCII line %r' % line.strip())
-            raise ConnectionLost()
+    DECODER = NXASCIIDecoder
 
     def write_frame(self, data):
-        data = [len(data)] + data
-        data += fletcher(data)
-        raw = '\n%s\r' % make_ascii(data)
-        self.write(raw.encode())
+        self.write(codec.encode_ascii_frame(data))
 
 
 class NXBinary(NXProtocol):
-    def read_frame(self):
-        self.discard_until(b'\x7e')
-
-        length = self.read(1)[0]
-        buffer = [length]
-        start = time.time()
-
-        bytestuffed = False
-
-        i = 1
-        while (i <= length + 2):
-            try:
-                c = self.read(1)[0]
-            except ReadTimeout:
-                LOG.error('Mid-frame read timeout (expected %i got %i)' % (
-                    length, i))
-                raise ConnectionLost()
-
-            if c == 0x7e:
-                raise ConnectionLost('Received start byte mid-frame!')
-
-            # Adjust any byte stuffed bytes - Skip the current byte if so,
-            # then XOR the following byte with 0x20
-            if c == 0x7d:
-                bytestuffed = True
-            else:
-                if bytestuffed:
-                    c = c ^ 0x20
-                    bytestuffed = False
-                buffer.append(c)
-                i += 1
-
-            if time.time() - start > 60:
-                LOG.error('Timeout reading a line, killing connection')
-                raise ConnectionLost()
-
-        return buffer
+    DECODER = NXBinaryDecoder
 
     def write_frame(self, data):
-        data = [len(data)] + data
-        data += fletcher(data)
-        # Byte Stuff Any 0x7d, 0x7e bytes
-        bytestuff = [i for i, x in enumerate(data) if x == 0x7d]
-        for i, index in reversed(list(enumerate(bytestuff))):
-            data[index:index+1] = [0x7d, 0x5d]
-        bytestuff = [i for i, x in enumerate(data) if x == 0x7e]
-        for i, index in reversed(list(enumerate(bytestuff))):
-            data[index:index+1] = [0x7d, 0x5e]
-
-        # add the start character 0x7e
-        data.insert(0, 0x7e)
-
-        self.write(bytes(data))
+        self.write(codec.encode_binary_frame(data))
 
 
 class StreamWrapper(object):
@@ -272,10 +552,14 @@ class StreamWrapper(object):
 
     This mostly just manages connecting, reconnecting, and some error handling,
     transparent to the protocol (ASCII or Binary) being used.
+
+    on_reconnect, if given, is called after the connection has been
+    dropped and made again by a read or write.
     """
-    def __init__(self, portspec, config):
+    def __init__(self, portspec, config, on_reconnect=None):
         self._portspec = portspec
         self._config = config
+        self._on_reconnect = on_reconnect
 
         try:
             self._use_binary_protocol = self._config.getboolean(
@@ -306,15 +590,27 @@ class StreamWrapper(object):
         self._s.close()
         time.sleep(10)
         self.connect()
+        if self._on_reconnect is not None:
+            self._on_reconnect()
+
+    @property
+    def selectable(self):
+        """The connected stream, if it can be waited on with selectors."""
+        try:
+            self._s.fileno()
+        except (AttributeError, OSError, ValueError):
+            return None
+        return self._s
 
-    def read_frame_raw(self):
+    def read_frame_raw(self, wait=True):
         """Read a raw frame from the stream.
 
         Returns the raw bytes (inclusive of length and checksum) or None
-        if there is no data to read.
+        if there is no data to read. If wait is False, only a frame that
+        has already been read from the stream is returned.
         """
         try:
-            return self.protocol.read_frame()
+            return self.protocol.read_frame(wait=wait)
         except ConnectionLost as e:
             LOG.warning('Connection terminated: %s' % e)
             self.reconnect()
@@ -336,7 +632,7 @@ class StreamWrapper(object):
             LOG.warning('Failed to send frame; reconnecting')
             self.reconnect()
             # Try to re-send if we reconnect so we don't lose this event
-            self.protocol.write(data)
+            self.protocol.write_frame(data)
 
 
 class SocketWrapper(StreamWrapper):
@@ -363,24 +659,292 @@ class SerialWrapper(StreamWrapper):
         return self._s.isOpen();
 
 
+class CommandFailed(Exception):
+    pass
+
+
+class CommandRejected(CommandFailed):
+    pass
+
+
+class CommandTimeout(CommandFailed):
+    pass
+
+
+# The message type the panel answers each request with. Anything not
+# listed here is answered with a Positive Acknowledge.
+RESPONSE_TYPES = {
+    0x21: 0x01,
+    0x23: 0x03,
+    0x24: 0x04,
+    0x25: 0x05,
+    0x26: 0x06,
+    0x27: 0x07,
+    0x28: 0x08,
+    0x2A: 0x0A,
+    0x30: 0x10,
+    0x32: 0x12,
+    0x33: 0x12,
+}
+
+# For requests about a particular zone, partition, user or log entry,
+# the index of the request byte that the response repeats as its first
+# payload byte
+RESPONSE_KEYS = {
+    0x23: 1,
+    0x24: 1,
+    0x25: 1,
+    0x26: 1,
+    0x2A: 1,
+    0x32: 4,
+    0x33: 1,
+}
+
+
+# Status messages which can be ignored if they repeat the last message of
+# the same type about the same zone or partition, with the name of their
+# <name>_duplicates config option and its default
+DUPLICATE_POLICIES = {
+    0x04: ('zone_status', 'drop'),
+    0x06: ('partition_status', 'drop'),
+    0x08: ('system_status', 'process'),
+}
+
+
+def _chain(future):
+    """A new future which completes when, and as, future does."""
+    chained = concurrent.futures.Future()
+
+    def done(future):
+        try:
+            if future.cancelled():
+                chained.cancel()
+            elif future.exception() is not None:
+                chained.set_exception(future.exception())
+            else:
+                chained.set_result(future.result())
+        except concurrent.futures.InvalidStateError:
+            # The caller cancelled it
+            pass
+
+    future.add_done_callback(done)
+    return chained
+
+
+class Command(object):
+    """A message for the panel, tracked until the panel answers it.
+
+    future completes with the NXFrame the panel answered with, or fails
+    with a CommandFailed exception.
+    """
+    __slots__ = ('msg', 'future', 'attempts', 'sent_at', 'response_type',
+                 'key')
+
+    def __init__(self, msg):
+        self.msg = msg
+        self.future = concurrent.futures.Future()
+        self.attempts = 0
+        self.sent_at = None
+        self.response_type = RESPONSE_TYPES.get(msg[0], 0x1D)
+        index = RESPONSE_KEYS.get(msg[0])
+        self.key = None if index is None else msg[index]
+
+    def matches(self, frame):
+        return (frame.msgtype == self.response_type and
+                (self.key is None or frame.raw[2] == self.key))
+
+    def __repr__(self):
+        return 'Command<%s>' % make_ascii(self.msg)
+
+
+class CommandEngine(object):
+    """Sends queued messages to the panel and tracks them until answered.
+
+    Queued commands are sent in the order given by scheduler.Scheduler,
+    and up to window of them are in flight at once. A command completes when
+    the panel sends the matching response, or a Positive Acknowledge for
+    commands that have no response message. Commands are re-sent after a
+    Negative Acknowledge or if the panel does not answer within timeout
+    seconds, up to retries times. Command Failed and Message Rejected
+    replies fail the oldest command in flight, as the panel answers in
+    order.
+    """
+    def __init__(self, send, window=1, timeout=2.0, retries=3):
+        self._send = send
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.pending = scheduler.Scheduler()
+        self.in_flight = collections.deque()
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.pending or self.in_flight)
+
+    def add(self, msg):
+        with self._lock:
+            command = self.pending.add(Command(msg))
+        if scheduler.priority(msg) == scheduler.COMMAND:
+            return command.future
+        # Identical polls are merged into one command, so give each caller
+        # a future of its own, which it can cancel without losing the
+        # reply for the others
+        return _chain(command.future)
+
+    def add_group(self, commands):
+        """Queue Commands to be sent one after another, in order.
+
+        They are all queued as commands, so no other message is sent
+        in between unless it was queued as a command before them.
+        """
+        with self._lock:
+            for command in commands:
+                self.pending.add(command, scheduler.COMMAND)
+
+    def _transmit(self, command, now):
+        command.attempts += 1
+        command.sent_at = now
+        LOG.debug('Sending %s (attempt %i)' % (command, command.attempts))
+        if self._send(command.msg):
+            self.in_flight.append(command)
+        else:
+            command.future.set_exception(
+                ConnectionLost('Failed to send %r' % command))
+
+    def _retry(self, command, now, reason):
+        if command.attempts > self.retries:
+            LOG.warning('Giving up on %s after %i attempts: %s' % (
+                command, command.attempts, reason))
+            command.future.set_exception(CommandTimeout(reason))
+        else:
+            LOG.info('Re-sending %s: %s' % (command, reason))
+            self._transmit(command, now)
+
+    def pump(self, now):
+        """Send queued commands while there is room in the window."""
+        while len(self.in_flight) < self.window:
+            # Commands are added from other threads. The lock is not held
+            # while sending, as a failed send runs the future's callbacks,
+            # which may queue more
+            with self._lock:
+                if not self.pending:
+                    return
+                command = self.pending.popleft()
+            if command.future.set_running_or_notify_cancel():
+                self._transmit(command, now)
+
+    def frame_received(self, frame, now):
+        """Match a frame from the panel against the commands in flight.
+
+        :returns: True if the frame answered a command
+        """
+        msgtype = frame.msgtype
+        if msgtype in (0x1C, 0x1E, 0x1F):
+            if not self.in_flight:
+                LOG.warning('Received %s with no command outstanding' % (
+                    frame.type_name))
+                return True
+            command = self.in_flight.popleft()
+            if msgtype == 0x1E:
+                self._retry(command, now, frame.type_name)
+            elif msgtype == 0x1F:
+                LOG.error('Panel rejected %s' % command)
+                command.future.set_exception(CommandRejected(frame.type_name))
+            else:
+                LOG.error('Panel failed %s' % command)
+                command.future.set_exception(CommandFailed(frame.type_name))
+            return True
+
+        for command in self.in_flight:
+            if command.matches(frame):
+                self.in_flight.remove(command)
+                command.future.set_result(frame)
+                return True
+        return False
+
+    def check_timeouts(self, now):
+        """Re-send or fail commands the panel has not answered in time."""
+        while self.in_flight and (
+                self.in_flight[0].sent_at + self.timeout <= now):
+            command = self.in_flight.popleft()
+            self._retry(command, now, 'No reply after %.1fs' % self.timeout)
+
+    def connection_lost(self):
+        """Fail the commands in flight, as the panel will never answer."""
+        while self.in_flight:
+            command = self.in_flight.popleft()
+            command.future.set_exception(
+                ConnectionLost('Connection lost waiting for a reply'))
+
+    @property
+    def next_deadline(self):
+        """When check_timeouts() next needs to be called, or None."""
+        if self.in_flight:
+            return self.in_flight[0].sent_at + self.timeout
+        return None
+
+
 class NXController(object):
     def __init__(self, portspec, configfile):
         self._portspec = portspec
         self._configfile = configfile
         self._queue_waiting = False
         self._queue_should_wait = False
-        self._queue = []
+        # Queueing a message writes to this socket pair to wake up the
+        # controller loop if it is waiting for the panel
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector = None
+        self._selected = None
         self.last_active = 0
         self.zones = {}
         self.partitions = {}
         self.users = {}
+        # The last snapshot bits seen for each zone and partition
+        self._zone_snapshot = {}
+        self._partition_snapshot = {}
+        # Whether everything requested at startup has been answered
+        self._synced = False
         self.system = model.System()
+        self._registered_handlers = {}
+        self._dispatch = [()] * 128
+        self._handler_counts = [0] * 128
+        self._handler_times = [0.0] * 128
+        self._suppressed_counts = [0] * 128
+        # The last payload of each status message type, by zone/partition
+        self._last_payload = {}
         ext_mgr = stevedore.extension.ExtensionManager(
             'pynx584', invoke_on_load=True, invoke_args=(self,))
         self.extensions = [ext_mgr[name] for name in ext_mgr.names()]
         LOG.info('Loaded extensions %s' % ext_mgr.names())
         self._load_config()
-        self.event_queue = event_queue.EventQueue(100)
+        self._extension_workers = [self._make_worker(ext)
+                                   for ext in self.extensions]
+        self._outbox = mail.Outbox(self._config)
+        self._config_lock = threading.Lock()
+        self._config_writer = persist.DeferredWriter(
+            self._configfile, self._render_config,
+            delay=self._config.getfloat('config', 'config_write_delay',
+                                        fallback=2.0))
+        log_dir = self._config.get('config', 'event_log', fallback=None)
+        if log_dir:
+            log = event_log.EventLog(
+                log_dir,
+                segment_bytes=self._config.getint(
+                    'config', 'event_log_segment_bytes', fallback=1048576),
+                max_segments=self._config.getint(
+                    'config', 'event_log_segments', fallback=10))
+            LOG.info('Logging events to %s, last event was %i' % (
+                log_dir, log.last_number))
+        else:
+            log = None
+        self.event_queue = event_queue.EventQueue(
+            self._config.getint('config', 'event_queue_length',
+                                fallback=100),
+            max_bytes=self._config.getint('config', 'event_queue_bytes',
+                                          fallback=None),
+            log=log)
         try:
             self.zone_name_update = self._config.getboolean('config', 'zone_name_update')
         except configparser.NoOptionError:
@@ -390,14 +954,60 @@ class NXController(object):
                 'config', 'idle_time_heartbeat_seconds')
         except configparser.NoOptionError:
             self._idle_time_heartbeat_seconds = 120
+        # Per thread, the commands queued inside command_group()
+        self._groups = threading.local()
+        self._commands = CommandEngine(
+            self._send,
+            window=self._config.getint('config', 'command_window',
+                                       fallback=1),
+            timeout=self._config.getfloat('config', 'command_timeout',
+                                          fallback=2.0),
+            retries=self._config.getint('config', 'command_retries',
+                                        fallback=3))
+        self._drop_duplicates = set()
+        for msgtype, (name, default) in DUPLICATE_POLICIES.items():
+            policy = self._config.get('config', '%s_duplicates' % name,
+                                      fallback=default)
+            if policy not in ('drop', 'process'):
+                LOG.error('Invalid %s_duplicates policy %r' % (name, policy))
+            elif policy == 'drop':
+                self._drop_duplicates.add(msgtype)
+        self._state_dirty = False
+        # Bumped once a frame that changed the model has been handled, so
+        # the API can tell when what it last sent is out of date
+        self.generation = 0
+        self._changed = False
+        self._next_checkpoint = 0
+        self._checkpoint_interval = self._config.getint(
+            'config', 'checkpoint_interval', fallback=60)
+        try:
+            self._state_store = persist.StateStore(
+                self._config.get('config', 'state_file'))
+        except configparser.NoOptionError:
+            self._state_store = None
+        else:
+            self._restore_state(self._state_store.load())
+
+    @property
+    def _uses_serial(self):
+        return '/' in self._portspec[0] or 'COM' in self._portspec[0]
 
     def connect(self):
-        if '/' in self._portspec[0] or 'COM' in self._portspec[0]:
-            self._ser = SerialWrapper(self._portspec, self._config)
+        if self._uses_serial:
+            self._ser = SerialWrapper(self._portspec, self._config,
+                                      on_reconnect=self._reconnected)
         else:
-            self._ser = SocketWrapper(self._portspec, self._config)
+            self._ser = SocketWrapper(self._portspec, self._config,
+                                      on_reconnect=self._reconnected)
             LOG.info('Connected')
 
+    def _reconnected(self):
+        """Called from the controller thread when the stream reconnects."""
+        # Nothing sent on the old connection will be answered
+        self._commands.connection_lost()
+        # and the panel may have changed while we were away
+        self._request_snapshots()
+
     def _load_config(self):
         self._config = configparser.ConfigParser()
         self._config.read(self._configfile)
@@ -412,46 +1022,287 @@ class NXController(object):
                 zone = self._get_zone(number)
                 zone.name = name
 
-    def _write_config(self):
-        if not self._config.has_section('zones'):
-            self._config.add_section('zones')
+        # Who gets which notifications. Rebuild this if the config changes.
+        self._routes = mail.Routes(self._config)
+
+    def _make_worker(self, ext):
+        # Options in [extension_<name>] override the defaults in [config]
+        section = 'extension_%s' % ext.name
+        maxsize = self._config.getint(
+            section, 'queue_size',
+            fallback=self._config.getint('config', 'extension_queue_size',
+                                         fallback=100))
+        policy = self._config.get(
+            section, 'overflow',
+            fallback=self._config.get('config', 'extension_overflow',
+                                      fallback='drop_oldest'))
+        if policy not in extensions.POLICIES:
+            LOG.error('Invalid overflow policy %r for extension %s' % (
+                policy, ext.name))
+            policy = 'drop_oldest'
+        return extensions.ExtensionWorker(ext.name, ext.obj, maxsize, policy)
+
+    def _notify_extensions(self, method, *args, key=None):
+        if not self._extension_workers:
+            return
+        # The workers call the extensions later, by which time the zone
+        # (or partition or system) may have changed again, so give them
+        # a copy of it as it is now
+        args = tuple(copy.copy(arg) for arg in args)
+        for worker in self._extension_workers:
+            worker.submit(method, *args, key=key)
+
+    def extension_stats(self):
+        """Queue length, lag and drop counts for each extension."""
+        return {worker.name: worker.stats()
+                for worker in self._extension_workers}
+
+    def mail_stats(self):
+        """Counts of the mail sent, failed, queued and held for digests."""
+        return self._outbox.stats()
 
-        for zone in self.zones.values():
-            if (not self._config.has_option('zones', str(zone.number)) and
-                    zone.name != 'Unknown'):
-                self._config.set('zones', str(zone.number), zone.name)
+    def _write_config(self):
+        with self._config_lock:
+            if not self._config.has_section('zones'):
+                self._config.add_section('zones')
+
+            for zone in self.zones.values():
+                if (not self._config.has_option('zones',
+                                                str(zone.number)) and
+                        zone.name != 'Unknown'):
+                    self._config.set('zones', str(zone.number), zone.name)
+        # Zone names arrive one message at a time, so save them all in
+        # one go once they stop changing
+        self._config_writer.schedule()
+
+    def _render_config(self):
+        configfile = io.StringIO()
+        with self._config_lock:
+            self._config.write(configfile)
+        return configfile.getvalue().encode()
+
+    def flush(self):
+        """Write out pending config and state changes, and send mail."""
+        self._config_writer.flush()
+        self.checkpoint(force=True)
+        self._outbox.flush(timeout=30)
+
+    def _save_state(self):
+        # The flags are saved as the raw bitmasks, as some names (such as
+        # 'Reserved') are used for more than one bit
+        return {
+            'zones': [{'number': zone.number,
+                       'name': zone.name,
+                       'state': zone.state,
+                       'condition': zone.condition,
+                       'types': zone.types,
+                       'snapshot': self._zone_snapshot.get(zone.number)}
+                      for zone in self.zones.values()],
+            'partitions': [{'number': partition.number,
+                            'condition': partition.condition,
+                            'last_user': partition.last_user,
+                            'snapshot': self._partition_snapshot.get(
+                                partition.number)}
+                           for partition in self.partitions.values()],
+            'system': {'panel_id': self.system.panel_id,
+                       'status': self.system.status},
+        }
+
+    def _restore_state(self, state):
+        """Load zones, partitions and system status saved by checkpoint().
+
+        Restored zones and partitions are marked stale until the panel
+        confirms them. Users are not saved, as they include PINs. State
+        which does not make sense is ignored, as if none was saved.
+        """
+        if not state:
+            return
         try:
-            with open(self._configfile, 'w') as configfile:
-                self._config.write(configfile)
-        except IOError as ex:
-            LOG.error('Unable to write %s: %s' % (self._configfile, ex))
+            zones = [(_number(data['number']), str(data['name']),
+                      _optional_bool(data['state']),
+                      int(data['condition']), int(data['types']),
+                      _optional_int(data['snapshot']))
+                     for data in state['zones']]
+            partitions = [(_number(data['number']), int(data['condition']),
+                           _optional_int(data['last_user']),
+                           _optional_int(data['snapshot']))
+                          for data in state['partitions']]
+            panel_id = int(state['system']['panel_id'])
+            status = int(state['system']['status'])
+        except (AttributeError, KeyError, TypeError, ValueError) as ex:
+            LOG.error('Ignoring invalid saved state: %r' % ex)
+            return
+        for number, name, zone_state, condition, types, snapshot in zones:
+            zone = self._get_zone(number)
+            if zone.name == 'Unknown':
+                zone.name = name
+            zone.state = zone_state
+            zone.condition = condition
+            zone.types = types
+            zone.stale = True
+            if snapshot is not None:
+                self._zone_snapshot[number] = snapshot
+        for number, condition, last_user, snapshot in partitions:
+            partition = self._get_partition(number)
+            partition.condition = condition
+            partition.last_user = last_user
+            partition.stale = True
+            if snapshot is not None:
+                self._partition_snapshot[number] = snapshot
+        self.system.panel_id = panel_id
+        self.system.status = status
+        LOG.info('Restored %i zones and %i partitions from saved state' % (
+            len(self.zones), len(self.partitions)))
+
+    def _model_changed(self):
+        self._state_dirty = True
+        self._changed = True
+
+    def checkpoint(self, force=False):
+        """Save the panel state, if configured and it has changed.
+
+        Unless force is set, this writes at most once every
+        checkpoint_interval seconds.
+        """
+        state = self._checkpoint_state(force)
+        if state is not None:
+            self._state_store.save(state)
+
+    def _checkpoint_state(self, force):
+        """The state for checkpoint() to save, or None if it need not."""
+        if self._state_store is None or not self._state_dirty:
+            return None
+        now = time.time()
+        if not force and now < self._next_checkpoint:
+            return None
+        self._state_dirty = False
+        self._next_checkpoint = now + self._checkpoint_interval
+        return self._save_state()
+
+    @property
+    def ready(self):
+        """True once the state of the panel has been fully refreshed."""
+        return (self._synced and
+                not any(zone.stale for zone in self.zones.values()) and
+                not any(partition.stale
+                        for partition in self.partitions.values()))
 
     @property
     def interior_zones(self):
-        return [x for x in self.zones.values() if 'Interior' in x.type_flags]
+        return [x for x in self.zones.values()
+                if x.types & model.Zone.INTERIOR]
 
     @property
     def interior_bypassed(self):
-        return all(['Inhibit' in x.condition_flags
+        return all([x.condition & model.Zone.INHIBIT
                     for x in self.interior_zones])
 
-    def process_next(self):
-        data = self._ser.read_frame_raw()
-        if not data:
-            return None
+    def _decode_frame(self, data):
         self.last_active = time.time()
         try:
-            frame = NXFrame.decode_line(data)
+            return NXFrame.decode_line(data)
         except ReadFailure as e:
             LOG.error(str(e))
             return None
-        return frame
+
+    def _wait_readable(self, timeout):
+        """Wait for data from the panel or for a message to be queued.
+
+        :returns: True if there is data to read from the panel
+        """
+        stream = self._ser.selectable
+        if stream is None:
+            # Fall back to blocking in a read with the stream's timeout
+            return True
+
+        if self._selector is None:
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        if stream is not self._selected:
+            if self._selected is not None:
+                try:
+                    self._selector.unregister(self._selected)
+                except (KeyError, ValueError):
+                    pass
+            self._selector.register(stream, selectors.EVENT_READ)
+            self._selected = stream
+
+        readable = False
+        for key, events in self._selector.select(timeout):
+            if key.fileobj is self._wakeup_r:
+                try:
+                    while self._wakeup_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            else:
+                readable = True
+        return readable
+
+    def process_next(self, timeout=None):
+        """Read the next frame from the panel.
+
+        :param: timeout is how long to wait for data, if the stream can be
+                waited on. Waiting is cut short if a message is queued.
+        :returns: An NXFrame, or None if there was nothing to read
+        """
+        data = self._ser.read_frame_raw(wait=False)
+        if data is None and self._wait_readable(timeout):
+            data = self._ser.read_frame_raw()
+        if not data:
+            return None
+        return self._decode_frame(data)
 
     def _send(self, data):
         try:
             self._ser.write_frame_raw(data)
+            return True
         except Exception:
             LOG.exception('Failed to send frame %r' % data)
+            return False
+
+    def _enqueue(self, msg):
+        """Queue a message to be sent to the panel.
+
+        :returns: A concurrent.futures.Future which completes with the
+                  panel's reply, or fails with CommandFailed
+        """
+        group = getattr(self._groups, 'commands', None)
+        if group is not None:
+            command = Command(msg)
+            group.append(command)
+            return command.future
+        future = self._commands.add(msg)
+        self._queue_changed()
+        return future
+
+    @contextlib.contextmanager
+    def command_group(self):
+        """Queue the commands made in this block as one ordered group.
+
+        Nothing is queued until the block exits, and nothing at all if
+        it raises.
+        """
+        group = self._groups.commands = []
+        try:
+            yield
+        except BaseException:
+            for command in group:
+                command.future.cancel()
+            raise
+        finally:
+            self._groups.commands = None
+        if group:
+            self._commands.add_group(group)
+            self._queue_changed()
+
+    def _queue_changed(self):
+        """Called after something is added to the send queue."""
+        try:
+            self._wakeup_w.send(b'\0')
+        except BlockingIOError:
+            # There is already a wakeup pending
+            pass
 
     def send_ack(self):
         self._send([0x1D])
@@ -460,43 +1311,50 @@ class NXController(object):
         self._send([0x1E])
 
     def get_zone_name(self, number):
-        self._queue.append([0x23, number - 1])
+        return self._enqueue([0x23, number - 1])
 
     def get_zone_status(self, number):
-        self._queue.append([0x24, number - 1])
+        return self._enqueue([0x24, number - 1])
 
     def arm_stay(self, partition):
-        self._queue.append([0x3E, 0x00, partition])
+        return self._enqueue([0x3E, 0x00, partition])
 
     def arm_exit(self, partition):
-        self._queue.append([0x3E, 0x02, partition])
+        return self._enqueue([0x3E, 0x02, partition])
 
     def arm_auto(self, partition):
-        self._queue.append([0x3D, 0x05, 0x01, 0x01])
+        return self._enqueue([0x3D, 0x05, 0x01, 0x01])
 
     def disarm(self, master_pin, partition):
-        self._queue.append([0x3C] +
-                           make_pin_buffer(master_pin) +
-                           [0x01, partition])
+        return self._enqueue([0x3C] +
+                             make_pin_buffer(master_pin) +
+                             [0x01, partition])
 
     def zone_bypass_toggle(self, zone):
-        self._queue.append([0x3F, zone - 1])
+        return self._enqueue([0x3F, zone - 1])
 
     def get_system_status(self):
-        self._queue.append([0x28])
+        return self._enqueue([0x28])
 
     def get_partition_status(self, partition):
-        self._queue.append([0x26, partition - 1])
+        return self._enqueue([0x26, partition - 1])
+
+    def get_zones_snapshot(self, offset):
+        """Request the snapshot of zones 16 * offset + 1 onwards."""
+        return self._enqueue([0x25, offset])
+
+    def get_partitions_snapshot(self):
+        return self._enqueue([0x27])
 
     def set_time(self):
         now = datetime.datetime.now()
-        self._queue.append([0x3B,
-                            now.year - 2000,
-                            now.month,
-                            now.day,
-                            now.hour,
-                            now.minute,
-                            ((now.weekday() + 1) % 7) + 1])
+        return self._enqueue([0x3B,
+                              now.year - 2000,
+                              now.month,
+                              now.day,
+                              now.hour,
+                              now.minute,
+                              ((now.weekday() + 1) % 7) + 1])
 
     def get_user_info(self, master_pin, user_number):
         if len(master_pin) < 6:
@@ -505,7 +1363,7 @@ class NXController(object):
             LOG.error('Master pin %r incorrect length' % master_pin)
             return False
         digits = make_pin_buffer(master_pin)
-        self._queue.append([0x32] + digits + [user_number])
+        self._enqueue([0x32] + digits + [user_number])
         LOG.debug('Sending for user info %s' % digits)
         return True
 
@@ -519,7 +1377,7 @@ class NXController(object):
             LOG.info('Setting user %i PIN to `%s`' % (
                 user.number,
                 ''.join(str(x) for x in user.pin if x < 10)))
-            self._queue.append(
+            self._enqueue(
                 [0x34] + mstr_digits + [user.number] + user_digits)
         return True
 
@@ -540,11 +1398,12 @@ class NXController(object):
 
     def process_msg_3(self, frame):
         # Zone Name
-        number = frame.data[0] + 1
-        name = ''.join([chr(x) for x in frame.data[1:]])
+        number = frame.zone
+        name = frame.name.tobytes().decode('latin-1')
         LOG.info('Zone %i: %s' % (number, repr(name.strip())))
         if self.zone_name_update:
             self._get_zone(number).name = name.strip()
+            self._model_changed()
             LOG.debug('Zone info from %s' % self.zones.keys())
             self._write_config()
         else:
@@ -552,21 +1411,15 @@ class NXController(object):
 
     def process_msg_4(self, frame):
         # Zone Status
-        zone = self._get_zone(frame.data[0] + 1)
-        condition = frame.data[5]
-        types = frame.data[2:5]
+        zone = self._get_zone(frame.zone)
+        condition = frame.condition
+        types = frame.type_bytes
         zone.state = bool(condition & 0x01)
+        zone.stale = False
+        self._model_changed()
 
-        zone.condition_flags = []
-        for index, string in enumerate(model.Zone.STATUS_FLAGS):
-            if condition & (1 << index):
-                zone.condition_flags.append(string)
-
-        zone.type_flags = []
-        for byte, flags in enumerate(model.Zone.TYPE_FLAGS):
-            for bit, name in enumerate(flags):
-                if types[byte] & (1 << bit):
-                    zone.type_flags.append(name)
+        zone.condition = condition
+        zone.types = int.from_bytes(types, 'little')
 
         LOG.info('Zone %i (%s) state is %s' % (
             zone.number, zone.name,
@@ -581,19 +1434,35 @@ class NXController(object):
                  'zone_flags': zone.condition_flags,
              }
         self.event_queue.push(event)
-        for ext in self.extensions:
-            ext.obj.zone_status(zone)
-
-    def _send_flag_notifications(self, flags_section, flags_key, asserted,
-                                 deasserted, email_fn):
+        self._notify_extensions('zone_status', zone, key=zone.number)
+
+    def process_msg_5(self, frame):
+        # Zones Snapshot
+        max_zone = self._config.getint('config', 'max_zone', fallback=8)
+        first = frame.offset * 16 + 1
+        for index, byte in enumerate(frame.status_bytes):
+            for number, bits in ((first + index * 2, byte & 0x0F),
+                                 (first + index * 2 + 1, byte >> 4)):
+                if number > max_zone:
+                    return
+                previous = self._zone_snapshot.get(number)
+                self._zone_snapshot[number] = bits
+                if bits == previous and number in self.zones:
+                    if self.zones[number].stale:
+                        self.zones[number].stale = False
+                        self._model_changed()
+                    continue
+                self._model_changed()
+                LOG.debug('Zone %i snapshot %s' % (
+                    number, [name for bit, name in
+                             enumerate(model.Zone.SNAPSHOT_FLAGS)
+                             if bits & (1 << bit)]))
+                self.get_zone_status(number)
+
+    def _send_flag_notifications(self, flags, asserted, deasserted,
+                                 email_fn):
         changed = asserted | deasserted
-        try:
-            flags = set(self._config.get(flags_section,
-                                         flags_key).split(','))
-        except (configparser.NoOptionError, configparser.NoSectionError):
-            flags = set([])
-
-        if any([flag in changed for flag in flags]):
+        if not flags.isdisjoint(changed):
             if deasserted & flags:
                 status = '(restored)'
             else:
@@ -604,28 +1473,27 @@ class NXController(object):
             email_fn(sub, msg)
 
     def process_msg_6(self, frame):
-        partition = self._get_partition(frame.data[0] + 1)
-        partition.last_user = frame.data[5]
-        types = frame.data[1:5] + frame.data[6:8]
+        partition = self._get_partition(frame.partition)
+        partition.last_user = frame.last_user
+        partition.stale = False
+        self._model_changed()
+        types = frame.condition_bytes
         was_armed = partition.armed
-        orig_flags = partition.condition_flags
-        partition.condition_flags = []
-        for byte, flags in enumerate(model.Partition.CONDITION_FLAGS):
-            for bit, name in enumerate(flags):
-                if types[byte] & (1 << bit):
-                    partition.condition_flags.append(name)
+        orig = partition.condition
+        partition.condition = int.from_bytes(bytes(types), 'little')
         if was_armed != partition.armed:
             LOG.info('Partition %i %s armed' % (
                 partition.number,
                 '' if partition.armed else 'not'))
         LOG.debug('Partition %i %s' % (partition.number,
                                        partition.condition_flags))
-        for ext in self.extensions:
-            ext.obj.partition_status(partition)
+        self._notify_extensions('partition_status', partition,
+                                key=partition.number)
 
-        deasserted = set(orig_flags) - set(partition.condition_flags)
-        asserted = set(partition.condition_flags) - set(orig_flags)
-        changed = asserted | deasserted
+        changed = orig ^ partition.condition
+        names = model.Partition.condition_flags.names
+        deasserted = set(names(changed & orig))
+        asserted = set(names(changed & partition.condition))
 
         event = {'type': 'partition',
                  'timestamp': datetime.datetime.now().isoformat(),
@@ -638,34 +1506,59 @@ class NXController(object):
         self.event_queue.push(event)
 
         if changed:
+            route = self._routes.partition(partition.number)
+            if route is mail.NO_PARTITION_ROUTES:
+                return
             mail.send_partition_email(self._config, partition,
-                                      deasserted, asserted)
+                                      deasserted, asserted,
+                                      outbox=self._outbox,
+                                      routes=self._routes)
 
             def email_status(sub, msg):
                 mail.send_partition_status_email(self._config, partition,
-                                                 'status', sub, msg)
+                                                 'status', sub, msg,
+                                                 outbox=self._outbox,
+                                                 routes=self._routes)
 
             def email_alarms(sub, msg):
                 mail.send_partition_status_email(self._config, partition,
-                                                 'alarms', sub, msg)
+                                                 'alarms', sub, msg,
+                                                 outbox=self._outbox,
+                                                 routes=self._routes)
 
-            section = 'partition_%i' % partition.number
-            self._send_flag_notifications(section, 'status_flags', asserted,
+            self._send_flag_notifications(route.status_flags, asserted,
                                           deasserted, email_status)
-            self._send_flag_notifications(section, 'alarm_flags', asserted,
+            self._send_flag_notifications(route.alarm_flags, asserted,
                                           deasserted, email_alarms)
 
 
+    def process_msg_7(self, frame):
+        # Partitions Snapshot
+        for number, bits in enumerate(frame.status_bytes, 1):
+            previous = self._partition_snapshot.get(number)
+            self._partition_snapshot[number] = bits
+            if not bits & 0x01:
+                # Not a valid partition
+                continue
+            if bits == previous and number in self.partitions:
+                if self.partitions[number].stale:
+                    self.partitions[number].stale = False
+                    self._model_changed()
+                continue
+            self._model_changed()
+            LOG.debug('Partition %i snapshot %s' % (
+                number, [name for bit, name in
+                         enumerate(model.Partition.SNAPSHOT_FLAGS)
+                         if bits & (1 << bit)]))
+            self.get_partition_status(number)
+
     def process_msg_8(self, frame):
         errors = model.System.STATUS_FLAGS[1] + model.System.STATUS_FLAGS[2]
-        status = frame.data[1:10]
-        self.system.panel_id = frame.data[0]
-        orig_flags = self.system.status_flags
-        self.system.status_flags = []
-        for byte, flags in enumerate(model.System.STATUS_FLAGS):
-            for bit, name in enumerate(flags):
-                if status[byte] & (1 << bit):
-                    self.system.status_flags.append(name)
+        status = frame.status_bytes
+        self.system.panel_id = frame.panel_id
+        self._model_changed()
+        orig = self.system.status
+        self.system.status = int.from_bytes(status, 'little')
         LOG.debug('System status received (panel id 0x%02x)' % (
             self.system.panel_id))
 
@@ -684,19 +1577,21 @@ class NXController(object):
             msg = 'System %sasserts %s' % (pfx, flag)
             fn(msg)
 
-        deasserted = set(orig_flags) - set(self.system.status_flags)
-        asserted = set(self.system.status_flags) - set(orig_flags)
+        changed = orig ^ self.system.status
+        names = model.System.status_flags.names
+        deasserted = set(names(changed & orig))
+        asserted = set(names(changed & self.system.status))
 
         for flag in deasserted:
             _log(flag, False)
         for flag in asserted:
             _log(flag, True)
 
-        for ext in self.extensions:
-            ext.obj.system_status(self.system)
+        self._notify_extensions('system_status', self.system, key=0)
 
         if asserted or deasserted:
-            mail.send_system_email(self._config, deasserted, asserted)
+            mail.send_system_email(self._config, deasserted, asserted,
+                                   outbox=self._outbox, routes=self._routes)
 
         for i in range(1, 9):
             if ('Valid partition %i' % i) in asserted:
@@ -705,37 +1600,36 @@ class NXController(object):
 
     def process_msg_9(self, frame):
         commands = {0x28: 'on', 0x38: 'off'}
-        house = chr(ord('A') + frame.data[0])
-        unit = frame.data[1]
-        cmd = commands.get(frame.data[2], frame.data[2])
+        house = chr(ord('A') + frame.house)
+        unit = frame.unit
+        cmd = commands.get(frame.function, frame.function)
         LOG.info('Device %s%02i command %s' % (house, unit, cmd))
         event = {'type': 'device-command',
                  'timestamp': datetime.datetime.now().isoformat(),
                  'device': '%s%02i' % (house, unit),
                  'command': '%s' % cmd}
         self.event_queue.push(event)
-        for ext in self.extensions:
-            ext.obj.device_command(house, unit, cmd)
+        self._notify_extensions('device_command', house, unit, cmd)
 
     def process_msg_10(self, frame):
         event = model.LogEvent()
-        event.number = frame.data[0]
-        event.log_size = frame.data[1]
-        event.event_type = frame.data[2] & 0x7F
-        event.reportable = bool(frame.data[2] & 0x80)
-        event.zone_user_device = frame.data[3] + 1
-        event.partition_number = frame.data[4]
+        event.number = frame.number
+        event.log_size = frame.log_size
+        event.event_type = frame.event_type
+        event.reportable = frame.reportable
+        event.zone_user_device = frame.zone_user_device
+        event.partition_number = frame.partition
         euro_format = self._config.getboolean('config', 'euro_date_format',
                                               fallback=False)
         if euro_format:
-            month = frame.data[6]
-            day = frame.data[5]
+            month = frame.day
+            day = frame.month
         else:
-            month = frame.data[5]
-            day = frame.data[6]
+            month = frame.month
+            day = frame.day
 
-        hour = frame.data[7]
-        minute = frame.data[8]
+        hour = frame.hour
+        minute = frame.minute
         now = datetime.datetime.now()
         if month > now.month:
             year = now.year - 1
@@ -752,44 +1646,51 @@ class NXController(object):
                                           event.timestamp))
         _event = {'type': 'log',
                   'event': event.event_string,
+                  'event_name': event.event,
                   'timestamp': event.timestamp.isoformat(),
               }
         self.event_queue.push(_event)
-        for ext in self.extensions:
-            ext.obj.log_event(event)
+        self._notify_extensions('log_event', event)
 
-        mail.send_log_event_mail(self._config, event)
+        mail.send_log_event_mail(self._config, event, outbox=self._outbox,
+                                 routes=self._routes)
 
     def process_msg_18(self, frame):
-        user = self._get_user(frame.data[0])
+        user = self._get_user(frame.user)
         user.pin = []
-        user.authority_flags = []
-        user.authorized_partitions = []
-        for byte in frame.data[1:4]:
+        for byte in frame.pin_bytes:
             user.pin.append(byte & 0x0F)
             user.pin.append((byte & 0xF0) >> 4)
-        authbytetype = frame.data[4] & 0x80
-        authbyte = frame.data[4] & 0x7F
-        flags = model.User.AUTHORITY_FLAGS[1 if authbytetype else 0]
-        for i, flag in enumerate(flags):
-            if authbyte & (1 << i):
-                user.authority_flags.append(flag)
-        for i in range(0, 8):
-            if frame.data[5] & (1 << i):
-                user.authorized_partitions.append(i + 1)
+        user.authority = frame.authority
+        if frame.authority_type:
+            user.authority |= 0x80
+        user.partitions = frame.partitions
         LOG.info('Received information about user %i' % user.number)
 
     def _run_queue(self):
-        if not self._queue:
-            return
-        msg = self._queue.pop(0)
-        LOG.debug('Sending queued %s' % msg)
-        self._send(msg)
+        now = time.time()
+        self._commands.check_timeouts(now)
+        self._commands.pump(now)
+        if not self._commands:
+            self._synced = True
+
+    def _request_snapshots(self):
+        """Refresh zone and partition state.
+
+        The snapshot handlers request the full status of anything which
+        has changed since the last snapshot, or which we have not seen.
+        """
+        max_zone = self._config.getint('config', 'max_zone', fallback=8)
+        self.get_partitions_snapshot()
+        for offset in range((max_zone + 15) // 16):
+            self.get_zones_snapshot(offset)
 
     def generate_heartbeat_activity(self):
         self.get_system_status()
+        self._request_snapshots()
 
-    def controller_loop(self):
+    def _request_initial_state(self):
+        self._synced = False
         self.set_time()
         self.get_system_status()
 
@@ -799,49 +1700,127 @@ class NXController(object):
             max_zone = 8
             self._config.set('config', 'max_zone', str(max_zone))
 
+        self._request_snapshots()
         for i in range(1, max_zone + 1):
-            self.get_zone_status(i)
             if not self._config.has_option('zones', str(i)):
                 self.get_zone_name(i)
 
+    def _handle_frame(self, frame):
+        LOG.debug('Received: %i %s (data %s)', frame.msgtype,
+                  frame.type_name, frame)
+        if frame.ack_required:
+            LOG.debug('Sending ACK')
+            self.send_ack()
+        msgtype = frame.msgtype
+        handlers = self._dispatch[msgtype]
+        if msgtype in self._drop_duplicates:
+            # The first payload byte is the zone or partition number
+            key = (msgtype, frame.raw[2])
+            payload = frame.raw[2:-2]
+            if self._last_payload.get(key) == payload:
+                LOG.debug('Ignoring unchanged %s' % frame.type_name)
+                self._suppressed_counts[msgtype] += 1
+                handlers = None
+            else:
+                self._last_payload[key] = payload
+        if handlers:
+            start = time.perf_counter()
+            for handler in handlers:
+                try:
+                    handler(frame)
+                except Exception as e:
+                    LOG.exception('Failed to process message type %i',
+                                  msgtype)
+            self._handler_counts[msgtype] += 1
+            self._handler_times[msgtype] += time.perf_counter() - start
+            if self._changed:
+                self._changed = False
+                self.generation += 1
+        # Only now complete any command this answers, so that whoever is
+        # waiting for it sees the state as updated by the frame
+        answered = self._commands.frame_received(frame, time.time())
+        if handlers is not None and not handlers and not answered:
+            LOG.debug('Unsupported frame type %i (0x%02x)' % (
+                msgtype, msgtype))
+
+    def _build_dispatch(self):
+        """Build the table of handlers for each message type.
+
+        The process_msg_N methods handle message type N, followed by
+        anything added with register_handler().
+        """
+        self._dispatch = [()] * 128
+        for msgtype in range(128):
+            self._update_dispatch(msgtype)
+
+    def _update_dispatch(self, msgtype):
+        handlers = []
+        core = getattr(self, 'process_msg_%i' % msgtype, None)
+        if core is not None:
+            handlers.append(core)
+        handlers.extend(self._registered_handlers.get(msgtype, []))
+        self._dispatch[msgtype] = tuple(handlers)
+
+    def register_handler(self, msgtype, handler):
+        """Call handler(frame) for every message of msgtype received.
+
+        Extensions may use this to handle messages the controller itself
+        ignores, such as Keypad Message Received (0x0B).
+        """
+        self._registered_handlers.setdefault(msgtype, []).append(handler)
+        self._update_dispatch(msgtype)
+
+    def unregister_handler(self, msgtype, handler):
+        self._registered_handlers[msgtype].remove(handler)
+        self._update_dispatch(msgtype)
+
+    def handler_stats(self):
+        """How many messages of each type were handled, and how long it took.
+
+        :returns: A dict of msgtype to a dict of name, count, seconds and
+                  the number of unchanged messages ignored (suppressed)
+        """
+        names = model.MSG_TYPES
+        return {msgtype: {'name': (names[msgtype] if msgtype < len(names)
+                                   else 'Unknown'),
+                          'count': count,
+                          'seconds': self._handler_times[msgtype],
+                          'suppressed': self._suppressed_counts[msgtype]}
+                for msgtype, count in enumerate(self._handler_counts)
+                if count or self._suppressed_counts[msgtype]}
+
+    def controller_loop(self):
+        self._build_dispatch()
+        self._request_initial_state()
+
         watchdog = time.time()
 
         while self.running:
-            frame = self.process_next()
+            now = time.time()
+            heartbeat_due = watchdog + self._idle_time_heartbeat_seconds
+            if now >= heartbeat_due:
+                # After time with no activity - generate
+                # something to make sure we are still alive
+                LOG.info('No activity for a while, heartbeating')
+                self.generate_heartbeat_activity()
+                watchdog = now
+                continue
+
+            self._run_queue()
+            self.checkpoint()
+
+            # Sleep until the panel sends something, a message is queued,
+            # or we have a deadline to meet
+            deadline = heartbeat_due
+            if self._commands.next_deadline is not None:
+                deadline = min(deadline, self._commands.next_deadline)
+            if self._state_dirty and self._state_store is not None:
+                deadline = min(deadline, self._next_checkpoint)
+            frame = self.process_next(max(0, deadline - now))
             if frame is None:
-                if time.time() - watchdog < self._idle_time_heartbeat_seconds:
-                    self._run_queue()
-                else:
-                    # After time with no activity - generate
-                    # something to make sure we are still alive
-                    LOG.info('No activity for a while, heartbeating')
-                    self.generate_heartbeat_activity()
-                    watchdog = time.time()
                 continue
             watchdog = time.time()
-            LOG.debug('Received: %i %s (data %s)' % (frame.msgtype,
-                                                     frame.type_name,
-                                                     frame.data))
-            if frame.ack_required:
-                LOG.debug('Sending ACK')
-                self.send_ack()
-            else:
-                pass
-                # This is sometimes too fast if we get two responses
-                # from a single command (like time set). Need to keep
-                # track of waiting for replies and re-send things when
-                # we don't hear back.
-                # self._run_queue()
-            name = 'process_msg_%i' % frame.msgtype
-            if hasattr(self, name):
-                try:
-                    getattr(self, name)(frame)
-                except Exception as e:
-                    LOG.exception('Failed to process message type %i',
-                                  frame.msgtype)
-            else:
-                LOG.debug('Unsupported frame type %i (0x%02x)' % (
-                    frame.msgtype, frame.msgtype))
+            self._handle_frame(frame)
 
     def controller_loop_safe(self):
         self.running = True
@@ -852,5 +1831,6 @@ class NXController(object):
                 self.controller_loop()
             except Exception as e:
                 LOG.exception('Controller loop exited: %s' % e)
+                self._commands.connection_lost()
                 LOG.warning('Waiting 10s before reconnecting...')
                 time.sleep(10)
@@ -0,0 +1,184 @@
+"""An append-only log of events on disk.
+
+Events are written as lines of JSON to segment files named after the
+number of the first event they hold. A new segment is started when the
+current one grows past segment_bytes or gets older than segment_seconds,
+and each time the log is opened, so a line torn by a crash is never
+appended to. Only the newest max_segments segments are kept.
+
+For each segment, the file offset of every index_interval'th event is
+kept in memory, so reading from any event number only has to scan a
+few lines.
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+from nx584 import event_queue
+
+LOG = logging.getLogger('event_log')
+
+SUFFIX = '.log'
+
+
+class Segment(object):
+    __slots__ = ('path', 'first', 'last', 'size', 'numbers', 'offsets')
+
+    def __init__(self, path, first):
+        self.path = path
+        self.first = first
+        self.last = first - 1
+        self.size = 0
+        # The sparse index: event numbers and the offsets of their lines
+        self.numbers = []
+        self.offsets = []
+
+    def add(self, number, offset, index_interval):
+        if (number - self.first) % index_interval == 0:
+            self.numbers.append(number)
+            self.offsets.append(offset)
+        self.last = number
+
+    def offset_of(self, number):
+        """An offset at or before the line for event number."""
+        i = bisect.bisect_right(self.numbers, number) - 1
+        return self.offsets[i] if i >= 0 else 0
+
+
+class EventLog(object):
+    READ_SIZE = 65536
+
+    def __init__(self, directory, segment_bytes=1048576,
+                 segment_seconds=86400, max_segments=10, index_interval=64):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.max_segments = max_segments
+        self.index_interval = index_interval
+        self._lock = threading.Lock()
+        self._segments = []
+        self._file = None
+        self._started = 0
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SUFFIX):
+                try:
+                    first = int(name[:-len(SUFFIX)])
+                except ValueError:
+                    continue
+                self._segments.append(self._scan(
+                    os.path.join(directory, name), first))
+        self._segments.sort(key=lambda segment: segment.first)
+
+    def _scan(self, path, first):
+        segment = Segment(path, first)
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    number = json.loads(line.decode())['n']
+                except (ValueError, KeyError, TypeError):
+                    LOG.warning('Ignoring bad event at %s:%i' % (path,
+                                                                  offset))
+                    break
+                segment.add(number, offset, self.index_interval)
+                offset += len(line)
+        segment.size = offset
+        return segment
+
+    @property
+    def first_number(self):
+        """The number of the oldest event in the log (or 1 if empty)."""
+        for segment in self._segments:
+            if segment.last >= segment.first:
+                return segment.first
+        return self.last_number + 1
+
+    @property
+    def last_number(self):
+        """The number of the newest event in the log, or 0."""
+        for segment in reversed(self._segments):
+            if segment.last >= segment.first:
+                return segment.last
+        return 0
+
+    def _rotate(self, first):
+        if self._file is not None:
+            self._file.close()
+        path = os.path.join(self.directory, '%020i%s' % (first, SUFFIX))
+        self._file = open(path, 'ab')
+        self._started = time.time()
+        self._segments.append(Segment(path, first))
+        while len(self._segments) > self.max_segments:
+            old = self._segments.pop(0)
+            try:
+                os.unlink(old.path)
+            except OSError as ex:
+                LOG.error('Unable to remove %s: %s' % (old.path, ex))
+
+    def append(self, event):
+        line = json.dumps({'n': event.number, 'p': event.payload},
+                          separators=(',', ':')).encode() + b'\n'
+        with self._lock:
+            segment = self._segments[-1] if self._file else None
+            if (segment is None or segment.size >= self.segment_bytes or
+                    time.time() - self._started >= self.segment_seconds):
+                self._rotate(event.number)
+                segment = self._segments[-1]
+            try:
+                self._file.write(line)
+                self._file.flush()
+            except OSError as ex:
+                LOG.error('Unable to write event %i: %s' % (event.number,
+                                                            ex))
+                return
+            segment.add(event.number, segment.size, self.index_interval)
+            segment.size += len(line)
+
+    def read(self, after, limit):
+        """Read up to limit events numbered after the given number.
+
+        :returns: A list of event_queue.Event objects
+        """
+        with self._lock:
+            segments = [(segment.path, segment.offset_of(after + 1),
+                         segment.size)
+                        for segment in self._segments
+                        if segment.last > after]
+        events = []
+        for path, offset, size in segments:
+            try:
+                f = open(path, 'rb')
+            except OSError as ex:
+                # Probably removed by rotation since we looked
+                LOG.debug('Unable to read %s: %s' % (path, ex))
+                continue
+            with f:
+                f.seek(offset)
+                remaining = size - offset
+                partial = b''
+                while remaining > 0:
+                    data = f.read(min(self.READ_SIZE, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    lines = (partial + data).split(b'\n')
+                    partial = lines.pop()
+                    for line in lines:
+                        record = json.loads(line.decode())
+                        if record['n'] <= after:
+                            continue
+                        events.append(event_queue.Event(record['n'],
+                                                        record['p']))
+                        if len(events) >= limit:
+                            return events
+        return events
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -1,5 +1,25 @@
+import collections
+import json
+import logging
 import threading
 
+LOG = logging.getLogger('event_queue')
+
+# The keys that can be filtered on, and the event field each matches. A
+# log event's 'event' is the full description, so filtering by event
+# matches the name of what happened (such as 'Alarm') instead
+FILTER_FIELDS = {'type': 'type', 'zone': 'zone', 'partition': 'partition',
+                 'event': 'event_name'}
+FILTER_KEYS = tuple(FILTER_FIELDS)
+
+
+def index_keys(payload):
+    """The (key, value) pairs an event with payload is indexed under."""
+    if not isinstance(payload, dict):
+        return []
+    return [(key, payload[field]) for key, field in FILTER_FIELDS.items()
+            if field in payload]
+
 
 class Event(object):
     def __init__(self, number, payload):
@@ -10,42 +30,259 @@ class Event(object):
         return 'Event<%i>' % self.number
 
 
+class EventFilter(object):
+    """Matches events with one of the given values for each field.
+
+    For example, EventFilter(type=['zone_status'], zone=[1, 2]) matches
+    status events for zones 1 and 2.
+    """
+    def __init__(self, **criteria):
+        for key in criteria:
+            if key not in FILTER_KEYS:
+                raise ValueError('Unable to filter on %r' % key)
+        self.criteria = {key: frozenset(values)
+                         for key, values in criteria.items() if values}
+        # Events are looked up (and waiters woken) by the most
+        # selective field
+        self.key = min(self.criteria,
+                       key=lambda key: len(self.criteria[key]),
+                       default=None)
+
+    def __bool__(self):
+        return bool(self.criteria)
+
+    def waiter_keys(self):
+        """The (key, value) pairs a waiter for this filter is woken by."""
+        return [(self.key, value) for value in self.criteria[self.key]]
+
+    def matches(self, payload):
+        if not isinstance(payload, dict):
+            return False
+        return all(payload.get(FILTER_FIELDS[key]) in values
+                   for key, values in self.criteria.items())
+
+
 class EventQueue(object):
-    def __init__(self, length, start=0):
-        self._queue = []
-        self._queue_lock = threading.Lock()
+    """A numbered queue of the most recent events.
+
+    Events are kept in a ring buffer of length slots, so event number N
+    is always in slot N % length. If max_bytes is given, the oldest
+    events are also dropped once the JSON encoding of the events held
+    would exceed that many bytes.
+
+    If log (an event_log.EventLog) is given, every event is also written
+    to it, numbering carries on from the last event in it, and events no
+    longer held in memory are read back from it.
+
+    The numbers of the events held are also indexed by the value of each
+    of the FILTER_KEYS, so a filtered fetch only looks at events which
+    might match, and a filtered waiter is only woken by a matching event.
+    """
+    def __init__(self, length, start=0, max_bytes=None, log=None):
+        if log is not None:
+            start = max(start, log.last_number)
+        self._ring = [None] * length
+        self._sizes = [0] * length
         self._length = length
-        self._index = start
-        self._condition = threading.Condition()
-        self._min = start
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._lock = threading.RLock()
+        # Unfiltered waiters wait on this, filtered ones on a condition of
+        # their own (sharing the lock) registered in _waiters
+        self._condition = threading.Condition(self._lock)
+        self._waiters = collections.defaultdict(list)
+        # (key, value) -> deque of numbers of the events held with it
+        self._index = {}
+        # The numbers of the oldest and newest events held, so the
+        # queue is empty when _min > _max
+        self._min = start + 1
         self._max = start
+        self._listeners = []
+        self._log = log
+
+    def add_listener(self, callback):
+        """Call callback(event) for every event pushed from now on.
+
+        Callbacks are run in order of events, from the thread doing the
+        push, and must not block.
+        """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def __len__(self):
+        return self._max - self._min + 1
+
+    def _drop_oldest(self):
+        slot = self._min % self._length
+        for index_key in index_keys(self._ring[slot].payload):
+            numbers = self._index[index_key]
+            numbers.popleft()
+            if not numbers:
+                del self._index[index_key]
+        self._ring[slot] = None
+        self._bytes -= self._sizes[slot]
+        self._min += 1
 
     def push(self, thing):
         self._condition.acquire()
         self._max += 1
-        self._queue.append(Event(self._max, thing))
-        self._queue = self._queue[0 - self._length:]
-        self._min = self._queue[0].number
+        event = Event(self._max, thing)
+        if len(self) > self._length:
+            self._drop_oldest()
+        slot = self._max % self._length
+        self._ring[slot] = event
+        keys = index_keys(thing)
+        for index_key in keys:
+            self._index.setdefault(index_key,
+                                   collections.deque()).append(self._max)
+        if self._log is not None:
+            self._log.append(event)
+        if self._max_bytes is not None:
+            self._sizes[slot] = len(json.dumps(thing))
+            self._bytes += self._sizes[slot]
+            while self._bytes > self._max_bytes and self._min < self._max:
+                self._drop_oldest()
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception:
+                LOG.exception('Event listener %r failed' % listener)
         self._condition.notify_all()
+        if self._waiters:
+            for index_key in keys:
+                for event_filter, waiter in self._waiters.get(index_key, ()):
+                    if event_filter.matches(thing):
+                        waiter.notify()
         self._condition.release()
 
     @property
     def current(self):
         return self._max
 
-    def get(self, index, timeout=None):
+    def _read_log(self, index, event_filter):
+        """Read events after index from the log, without the lock held.
+
+        Reads on until an event matches or the events held in memory are
+        reached.
+
+        :returns: A tuple of (events, missed, the last number read)
+        """
+        missed = None
+        events = []
+        while True:
+            batch = self._log.read(index, self._length)
+            if not batch:
+                break
+            if missed is None:
+                missed = batch[0].number - index - 1
+            index = batch[-1].number
+            events = [event for event in batch
+                      if not event_filter or
+                      event_filter.matches(event.payload)]
+            if events or index + 1 >= self._min:
+                break
+        return events, missed or 0, index
+
+    def _matching(self, index, event_filter):
+        numbers = []
+        for value in event_filter.criteria[event_filter.key]:
+            for number in reversed(self._index.get((event_filter.key, value),
+                                                   ())):
+                if number <= index:
+                    break
+                numbers.append(number)
+        numbers.sort()
+        events = [self._ring[number % self._length] for number in numbers]
+        return [event for event in events
+                if event_filter.matches(event.payload)]
+
+    def _wait_for(self, event_filter, timeout):
+        waiter = threading.Condition(self._lock)
+        entry = (event_filter, waiter)
+        keys = event_filter.waiter_keys()
+        for index_key in keys:
+            self._waiters[index_key].append(entry)
+        try:
+            waiter.wait(timeout)
+        finally:
+            for index_key in keys:
+                self._waiters[index_key].remove(entry)
+                if not self._waiters[index_key]:
+                    del self._waiters[index_key]
+
+    def fetch(self, index, timeout=None, event_filter=None):
+        """Get the events after index, waiting up to timeout for one.
+
+        :param event_filter: An EventFilter, to only get (and wait for)
+                             the events it matches
+        :returns: A tuple of (events, missed), where events is None if
+                  there were none, and missed is the number of events
+                  after index which are no longer held (whether or not
+                  they would have matched)
+        """
+        return self.poll(index, timeout, event_filter)[:2]
+
+    def poll(self, index, timeout=None, event_filter=None):
+        """Like fetch, but also say how far through the events it got.
+
+        With a filter, the events looked at can run on past the last one
+        which matched, so the next poll should carry on from there rather
+        than from the last event returned.
+
+        :returns: A tuple of (events, missed, the number of the last
+                  event looked at, or index if that is later)
+        """
         self._condition.acquire()
+        try:
+            missed = 0
+            if index + 1 < self._min and self._log is not None:
+                # Too old for memory, so read it from disk without
+                # holding up pushes
+                self._condition.release()
+                try:
+                    events, missed, index = self._read_log(index,
+                                                           event_filter)
+                finally:
+                    self._condition.acquire()
+                if events:
+                    return events, missed, index
+            if event_filter:
+                events = self._matching(index, event_filter)
+                if not events and timeout != 0:
+                    self._wait_for(event_filter, timeout)
+                    events = self._matching(index, event_filter)
+                missed += max(0, self._min - index - 1)
+                return events or None, missed, max(index, self._max)
+            if index >= self._max and timeout != 0:
+                self._condition.wait(timeout)
+            if index >= self._max:
+                return None, missed, index
+            first = max(index + 1, self._min)
+            ring = self._ring
+            length = self._length
+            return ([ring[number % length]
+                     for number in range(first, self._max + 1)],
+                    missed + first - index - 1, self._max)
+        finally:
+            self._condition.release()
 
-        data_available = lambda: index < self._min or self._max > index
-
-        if not data_available():
-            self._condition.wait(timeout)
-        the_index = index - self._min + 1
-        if the_index < 0:
-            the_index = 0
-        if data_available():
-            result = self._queue[the_index:]
-        else:
-            result = None
-        self._condition.release()
-        return result
+    def poll_nowait(self, index, event_filter=None):
+        """Like poll without a timeout, if it can be done without blocking.
+
+        :returns: What poll would, or None if the events after index have
+                  to be read from the log, or another thread is using the
+                  queue
+        """
+        if not self._condition.acquire(blocking=False):
+            return None
+        try:
+            if index + 1 < self._min and self._log is not None:
+                return None
+            return self.poll(index, 0, event_filter)
+        finally:
+            self._condition.release()
+
+    def get(self, index, timeout=None, event_filter=None):
+        return self.fetch(index, timeout, event_filter)[0]
@@ -0,0 +1,134 @@
+import collections
+import logging
+import threading
+import time
+
+LOG = logging.getLogger('extensions')
+
+POLICIES = ('drop_oldest', 'block', 'coalesce')
+
+
+class ExtensionWorker(object):
+    """Runs the callbacks of one extension on its own thread.
+
+    Calls are made in the order they were submitted. At most maxsize
+    calls wait to be made; when the queue is full, policy decides what
+    happens to a new one:
+
+    drop_oldest: the oldest waiting call is discarded
+    block: the caller waits until there is room
+    coalesce: a waiting call with the same key is replaced by the new
+              one (keeping its place in the queue), otherwise the oldest
+              waiting call is discarded
+    """
+    def __init__(self, name, obj, maxsize=100, policy='drop_oldest'):
+        if policy not in POLICIES:
+            raise ValueError('Invalid overflow policy %r' % policy)
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_lag = 0.0
+        self._obj = obj
+        self._queue = collections.deque()
+        self._keys = {}
+        self._busy = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                                        name='extension-%s' % name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, method, *args, key=None):
+        """Queue a call to the extension's method with args.
+
+        :param key: Identifies what the call is about (such as a zone), for
+                    the coalesce policy
+        """
+        item = [method, args, time.time(), key]
+        with self._condition:
+            if (self.policy == 'coalesce' and key is not None and
+                    len(self._queue) >= self.maxsize):
+                waiting = self._keys.get((method, key))
+                if waiting is not None:
+                    waiting[1] = args
+                    self.coalesced += 1
+                    return
+            if self.policy == 'block':
+                while len(self._queue) >= self.maxsize:
+                    self._condition.wait()
+            elif len(self._queue) >= self.maxsize:
+                self._discard(self._queue.popleft())
+                LOG.warning('Extension %s is not keeping up, dropped a '
+                            'call' % self.name)
+            self._queue.append(item)
+            if key is not None:
+                self._keys[(method, key)] = item
+            self._condition.notify_all()
+
+    def _discard(self, item):
+        self.dropped += 1
+        self._forget(item)
+
+    def _forget(self, item):
+        method, args, queued, key = item
+        if key is not None and self._keys.get((method, key)) is item:
+            del self._keys[(method, key)]
+
+    @property
+    def lag(self):
+        """How long the oldest waiting call has been waiting, in seconds."""
+        with self._condition:
+            if not self._queue:
+                return 0.0
+            return time.time() - self._queue[0][2]
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                item = self._queue.popleft()
+                self._forget(item)
+                self._busy = True
+                self._condition.notify_all()
+            method, args, queued, key = item
+            self.max_lag = max(self.max_lag, time.time() - queued)
+            try:
+                getattr(self._obj, method)(*args)
+            except Exception:
+                LOG.exception('Extension %s failed in %s' % (self.name,
+                                                              method))
+            with self._condition:
+                self.processed += 1
+                self._busy = False
+                self._condition.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until every queued call has finished.
+
+        :returns: True if the queue emptied before the timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._queue or self._busy:
+                remaining = None if deadline is None else (
+                    deadline - time.time())
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stats(self):
+        return {'queued': self.queued,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'lag': self.lag,
+                'max_lag': self.max_lag}
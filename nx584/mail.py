@@ -2,25 +2,33 @@ try:
     import ConfigParser as configparser
 except ImportError:
     import configparser
+import collections
 import email
 import email.mime
 import email.mime.text
 import email.utils
+import logging
 import smtplib
+import threading
+import time
+
+LOG = logging.getLogger('mail')
 
 
 class MissingEmailConfig(Exception):
     pass
 
 
-def _send_system_email(config, subject, recips, body):
+def _get_server(config):
     try:
-        fromaddr = config.get('email', 'fromaddr')
-        smtphost = config.get('email', 'smtphost')
+        return (config.get('email', 'fromaddr'),
+                config.get('email', 'smtphost'))
     except (configparser.NoOptionError,
             configparser.NoSectionError):
         raise MissingEmailConfig()
 
+
+def _make_message(fromaddr, subject, recips, body):
     msg = email.mime.text.MIMEText(body)
     msg['Subject'] = subject
     msg['From'] = fromaddr
@@ -28,19 +36,254 @@ def _send_system_email(config, subject, recips, body):
     msg['Message-Id'] = email.utils.make_msgid('nx584')
     for addr in recips:
         msg['To'] = addr
+    return msg.as_string()
+
+
+def _send_system_email(config, subject, recips, body, outbox=None,
+                       urgent=False):
+    fromaddr, smtphost = _get_server(config)
+    if outbox is not None:
+        outbox.send(subject, recips, body, urgent=urgent)
+        return
 
     smtp = smtplib.SMTP(smtphost)
-    smtp.sendmail(fromaddr, recips, msg.as_string())
+    smtp.sendmail(fromaddr, recips,
+                  _make_message(fromaddr, subject, recips, body))
     smtp.quit()
 
 
-def send_system_email(config, deasserted, asserted):
+class Outbox(object):
+    """Sends mail from a background thread.
+
+    One SMTP connection is kept open while there is mail to send, and
+    closed after idle_timeout seconds without any. Failed deliveries are
+    retried smtp_retries times with exponential backoff.
+
+    If digest_seconds (in the [email] section) is set, non-urgent
+    notifications are held for that long and then sent as one message
+    per set of recipients. Urgent ones are always sent straight away.
+    """
+    IDLE_TIMEOUT = 30
+    BACKOFF = 1.0
+
+    def __init__(self, config):
+        self._config = config
+        self.digest_seconds = config.getfloat('email', 'digest_seconds',
+                                              fallback=0)
+        self.retries = config.getint('email', 'smtp_retries', fallback=3)
+        self.sent = 0
+        self.failed = 0
+        self._queue = collections.deque()
+        self._digest = collections.OrderedDict()
+        self._digest_due = None
+        self._sending = False
+        self._smtp = None
+        self._last_used = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def send(self, subject, recips, body, urgent=False):
+        recips = tuple(sorted(recips))
+        with self._condition:
+            if urgent or not self.digest_seconds:
+                self._queue.append((subject, recips, body))
+            else:
+                self._digest.setdefault(recips, []).append((subject, body))
+                if self._digest_due is None:
+                    self._digest_due = time.time() + self.digest_seconds
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='mail-outbox')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _collect_digests(self):
+        for recips, items in self._digest.items():
+            if len(items) == 1:
+                subject, body = items[0]
+            else:
+                subject = 'Security System digest (%i notifications)' % (
+                    len(items))
+                body = '\n\n'.join('%s\n%s' % item for item in items)
+            self._queue.append((subject, recips, body))
+        self._digest.clear()
+        self._digest_due = None
+
+    def _next_timeout(self):
+        timeouts = []
+        if self._digest_due is not None:
+            timeouts.append(self._digest_due - time.time())
+        if self._smtp is not None:
+            timeouts.append(self._last_used + self.IDLE_TIMEOUT - time.time())
+        return max(0, min(timeouts)) if timeouts else None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._sending = False
+                self._condition.notify_all()
+                while not self._queue:
+                    if (self._digest_due is not None and
+                            time.time() >= self._digest_due):
+                        self._collect_digests()
+                        break
+                    if (self._smtp is not None and time.time() >=
+                            self._last_used + self.IDLE_TIMEOUT):
+                        break
+                    self._condition.wait(self._next_timeout())
+                message = self._queue.popleft() if self._queue else None
+                self._sending = message is not None
+            if message is None:
+                self._disconnect()
+            else:
+                self._deliver(*message)
+
+    def _disconnect(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._smtp = None
+
+    def _deliver(self, subject, recips, body):
+        try:
+            fromaddr, smtphost = _get_server(self._config)
+        except MissingEmailConfig:
+            LOG.error('Unable to send %r: email is not configured' % subject)
+            self.failed += 1
+            return
+        msg = _make_message(fromaddr, subject, recips, body)
+        for attempt in range(self.retries + 1):
+            try:
+                if self._smtp is None:
+                    self._smtp = smtplib.SMTP(smtphost, timeout=30)
+                self._smtp.sendmail(fromaddr, recips, msg)
+            except (smtplib.SMTPException, OSError) as ex:
+                LOG.warning('Failed to send %r (attempt %i): %s' % (
+                    subject, attempt + 1, ex))
+                self._smtp = None
+                if attempt < self.retries:
+                    time.sleep(self.BACKOFF * 2 ** attempt)
+            else:
+                self._last_used = time.time()
+                self.sent += 1
+                return
+        LOG.error('Giving up on sending %r to %s' % (subject,
+                                                     ','.join(recips)))
+        self.failed += 1
+
+    def stats(self):
+        """How many messages were sent, failed, are queued or are held."""
+        with self._condition:
+            return {'sent': self.sent,
+                    'failed': self.failed,
+                    'queued': len(self._queue) + int(self._sending),
+                    'held': sum(len(items)
+                                for items in self._digest.values())}
+
+    def flush(self, timeout=None):
+        """Send any held digests and wait for everything to be sent.
+
+        :returns: True if the outbox emptied before the timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            if self._digest:
+                self._collect_digests()
+                self._condition.notify_all()
+            while self._queue or self._sending:
+                remaining = None if deadline is None else (
+                    deadline - time.time())
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+
+DEFAULT_ALARM_EVENTS = ('Alarm', 'Alarm restore', 'Manual fire')
+
+
+def _get_list(config, section, option, default=()):
     try:
-        emails = config.get('email', 'system').split(',')
+        value = config.get(section, option)
     except (configparser.NoOptionError,
             configparser.NoSectionError):
-        return
+        return tuple(default)
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+class PartitionRoutes(object):
+    """Who to tell about flag changes on one partition.
+
+    flags: recipients for any flag change not in ignore_flags
+    status, alarms: recipients for changes to status_flags and
+                    alarm_flags respectively
+    """
+    __slots__ = ('flags', 'ignore_flags', 'status', 'status_flags',
+                 'alarms', 'alarm_flags')
+
+    def __init__(self, flags=(), ignore_flags=(), status=(),
+                 status_flags=(), alarms=(), alarm_flags=()):
+        self.flags = tuple(flags)
+        self.ignore_flags = frozenset(ignore_flags)
+        self.status = tuple(status)
+        self.status_flags = frozenset(status_flags)
+        self.alarms = tuple(alarms)
+        self.alarm_flags = frozenset(alarm_flags)
+
+    @classmethod
+    def from_config(cls, config, section):
+        return cls(**{option: _get_list(config, section, option)
+                      for option in cls.__slots__})
+
+
+NO_PARTITION_ROUTES = PartitionRoutes()
+
+
+class Routes(object):
+    """The notification rules in a config, compiled for quick lookup.
 
+    Build a new one whenever the config is (re)loaded.
+    """
+    def __init__(self, config):
+        self.system = _get_list(config, 'email', 'system')
+
+        events = frozenset(_get_list(config, 'email', 'events'))
+        alarms = events | frozenset(_get_list(config, 'email', 'alarms'))
+        alarm_events = _get_list(config, 'email', 'alarm_events',
+                                 DEFAULT_ALARM_EVENTS)
+        self._log_events = dict.fromkeys(alarm_events,
+                                         (tuple(sorted(alarms)), True))
+        self._log_default = (tuple(sorted(events)), False)
+
+        self._partitions = {}
+        for section in config.sections():
+            if not section.startswith('partition_'):
+                continue
+            try:
+                number = int(section[len('partition_'):])
+            except ValueError:
+                continue
+            self._partitions[number] = PartitionRoutes.from_config(config,
+                                                                   section)
+
+    def partition(self, number):
+        return self._partitions.get(number, NO_PARTITION_ROUTES)
+
+    def log_event(self, name):
+        """Who to tell about a log event.
+
+        :returns: A tuple of (recipients, urgent)
+        """
+        return self._log_events.get(name, self._log_default)
+
+
+def send_system_email(config, deasserted, asserted, outbox=None,
+                      routes=None):
+    emails = (routes or Routes(config)).system
     if not emails:
         return
 
@@ -54,31 +297,22 @@ def send_system_email(config, deasserted, asserted):
 
     try:
         _send_system_email(config, 'Security System Alert',
-                           emails, body)
+                           emails, body, outbox=outbox)
     except MissingEmailConfig:
         pass
 
 
-def send_partition_email(config, partition, deasserted, asserted):
-    try:
-        emails = config.get('partition_%i' % partition.number,
-                            'flags').split(',')
-    except (configparser.NoOptionError,
-            configparser.NoSectionError):
+def send_partition_email(config, partition, deasserted, asserted,
+                         outbox=None, routes=None):
+    route = (routes or Routes(config)).partition(partition.number)
+    emails = route.flags
+    if not emails:
         return
 
-    try:
-        ignore = set(config.get('partition_%i' % partition.number,
-                                'ignore_flags').split(','))
-    except configparser.NoOptionError:
-        ignore = set([])
-
-    deasserted = deasserted - ignore
-    asserted = asserted - ignore
+    deasserted = deasserted - route.ignore_flags
+    asserted = asserted - route.ignore_flags
     if not asserted and not deasserted:
         return
-    if not emails:
-        return
 
     body = ('Security System partition %i alert.\n' % partition.number +
             '\n' +
@@ -92,19 +326,19 @@ def send_partition_email(config, partition, deasserted, asserted):
         _send_system_email(
             config,
             'Security System Partition %i Alert' % partition.number,
-            emails, body)
+            emails, body, outbox=outbox)
     except MissingEmailConfig:
         pass
 
 
-def send_partition_status_email(config, partition, recip_key, sub, message):
-    try:
-        emails = config.get('partition_%i' % partition.number,
-                            recip_key).split(',')
-    except (configparser.NoOptionError,
-            configparser.NoSectionError):
-        return
+def send_partition_status_email(config, partition, recip_key, sub, message,
+                                outbox=None, routes=None):
+    """Send a partition status or alarm notification.
 
+    :param recip_key: 'status' or 'alarms'
+    """
+    route = (routes or Routes(config)).partition(partition.number)
+    emails = getattr(route, recip_key)
     if not emails:
         return
 
@@ -113,36 +347,21 @@ def send_partition_status_email(config, partition, recip_key, sub, message):
         _send_system_email(
             config,
             'Security: %s' % sub,
-            emails, body)
+            emails, body, outbox=outbox, urgent=recip_key == 'alarms')
     except MissingEmailConfig:
         pass
 
 
-def send_log_event_mail(config, event):
-    try:
-        alarm_emails = set(config.get('email', 'alarms').split(','))
-    except (configparser.NoOptionError, configparser.NoSectionError):
-        alarm_emails = set([])
-
-    try:
-        alarm_events = set(config.get('email', 'alarm_events').split(','))
-    except (configparser.NoOptionError, configparser.NoSectionError):
-        alarm_events = set(['Alarm', 'Alarm restore', 'Manual fire',])
-
-    try:
-        event_emails = set(config.get('email', 'events').split(','))
-    except (configparser.NoOptionError, configparser.NoSectionError):
-        event_emails = set([])
-
-    emails = set(event_emails)
-    if event.event in alarm_events:
-        emails |= alarm_emails
-
+def send_log_event_mail(config, event, outbox=None, routes=None):
+    emails, alarm = (routes or Routes(config)).log_event(event.event)
     if not emails:
         return
 
     body = '%s at %s' % (event.event_string, event.timestamp)
 
-    _send_system_email(
-        config, 'Security: %s' % event.event,
-        emails, body)
+    try:
+        _send_system_email(
+            config, 'Security: %s' % event.event,
+            emails, body, outbox=outbox, urgent=alarm)
+    except MissingEmailConfig:
+        pass
@@ -1,10 +1,13 @@
 import argparse
+import asyncio
 import logging
 import logging.handlers
 import os
 import threading
 
 from nx584 import api
+from nx584 import async_api
+from nx584 import async_controller
 from nx584 import controller
 
 LOG_FORMAT = '%(asctime)-15s %(module)s %(levelname)s %(message)s'
@@ -36,6 +39,15 @@ def main():
                         help='Listen address (defaults to 127.0.0.1)')
     parser.add_argument('--port', default=5007, type=int,
                         help='Listen port (defaults to 5007)')
+    parser.add_argument('--asyncio', default=False, action='store_true',
+                        help='Talk to the panel from an asyncio event loop '
+                             'instead of a polling thread')
+    parser.add_argument('--http-engine', default='flask',
+                        choices=('flask', 'asyncio'),
+                        help='Serve the API with the Flask development '
+                             'server (the default), or from an asyncio '
+                             'event loop, which copes with many more '
+                             'waiting /events clients')
     args = parser.parse_args()
 
     LOG = logging.getLogger()
@@ -72,17 +84,28 @@ def main():
     LOG.info('Ready')
     logging.getLogger('connectionpool').setLevel(logging.WARNING)
 
+    if args.asyncio:
+        controller_cls = async_controller.AsyncNXController
+    else:
+        controller_cls = controller.NXController
+
     if args.connect:
         host, port = args.connect.split(':')
-        ctrl = controller.NXController((host, int(port)),
-                                       args.config)
+        ctrl = controller_cls((host, int(port)), args.config)
     elif args.serial:
-        ctrl = controller.NXController((args.serial, args.baudrate),
-                                       args.config)
+        ctrl = controller_cls((args.serial, args.baudrate), args.config)
     else:
         LOG.error('Either host:port or serial and baudrate are required')
         return
 
+    if args.http_engine == 'asyncio':
+        try:
+            asyncio.run(async_api.serve(ctrl, args.listen, args.port))
+        except KeyboardInterrupt:
+            pass
+        ctrl.flush()
+        return
+
     api.CONTROLLER = ctrl
 
     t = threading.Thread(target=ctrl.controller_loop_safe)
@@ -90,3 +113,4 @@ def main():
     t.start()
 
     api.app.run(debug=False, host=args.listen, port=args.port, threaded=True)
+    ctrl.flush()
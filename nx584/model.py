@@ -67,11 +67,69 @@ MSG_TYPES = [
 ]
 
 
+def flag_table(names):
+    """Precompute the names of the set bits for every value of a byte.
+
+    :param names: The name of each bit, least significant first
+    :returns: A tuple indexed by byte value of tuples of names
+    """
+    return tuple(tuple(name for bit, name in enumerate(names)
+                       if value & (1 << bit))
+                 for value in range(256))
+
+
+# Bit N set means partition N + 1
+PARTITION_TABLE = flag_table(range(1, 9))
+
+
+class FlagField(object):
+    """Presents an integer bitmask attribute as a list of flag names.
+
+    Byte N of the flags (as sent by the panel) is bits 8N to 8N+7 of the
+    integer, decoded with tables[N]. Assigning a list of names sets the
+    bitmask.
+    """
+    def __init__(self, attr, tables):
+        self._attr = attr
+        self._tables = tables
+        self._masks = {}
+        for byte, table in enumerate(tables):
+            for bit in range(8):
+                for name in table[1 << bit]:
+                    self._masks.setdefault(name, 1 << (byte * 8 + bit))
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        return self.names(getattr(obj, self._attr))
+
+    def __set__(self, obj, names):
+        setattr(obj, self._attr, self.mask(*names))
+
+    def names(self, value):
+        """The names of the flags set in value."""
+        flags = []
+        for table in self._tables:
+            flags.extend(table[value & 0xFF])
+            value >>= 8
+        return flags
+
+    def mask(self, *names):
+        """The bitmask with the named flags set."""
+        value = 0
+        for name in names:
+            value |= self._masks[name]
+        return value
+
+
 class Zone(object):
     STATUS_FLAGS = [
         'Faulted', 'Trouble', 'Bypass', 'Inhibit', 'Low battery',
         'Loss of supervision', 'Reserved',]
 
+    # The bits of a zone's nibble in a Zones Snapshot message
+    SNAPSHOT_FLAGS = ['Faulted', 'Bypass', 'Trouble', 'Alarm memory']
+
     TYPE_FLAGS = [
         ['Fire', '24 hour', 'Key-switch', 'Follower',
          'Entry / exit delay 1', 'Entry / exit delay 2',
@@ -84,17 +142,30 @@ class Zone(object):
          'Restorable', 'Listen in'],
     ]
 
+    STATUS_TABLE = flag_table(STATUS_FLAGS)
+    TYPE_TABLES = tuple(flag_table(flags) for flags in TYPE_FLAGS)
+
+    __slots__ = ('number', 'name', 'state', 'condition', 'types', 'stale')
+
+    condition_flags = FlagField('condition', (STATUS_TABLE,))
+    type_flags = FlagField('types', TYPE_TABLES)
+
+    BYPASSED = condition_flags.mask('Bypass', 'Inhibit')
+    INHIBIT = condition_flags.mask('Inhibit')
+    INTERIOR = type_flags.mask('Interior')
+
     def __init__(self, number):
         self.number = number
         self.name = 'Unknown'
         self.state = None
-        self.condition_flags = []
-        self.type_flags = []
+        self.condition = 0
+        self.types = 0
+        # True if restored from saved state and not yet confirmed
+        self.stale = False
 
     @property
     def bypassed(self):
-        return ('Inhibit' in self.condition_flags or
-                'Bypass' in self.condition_flags)
+        return bool(self.condition & self.BYPASSED)
 
 
 class Partition(object):
@@ -122,14 +193,29 @@ class Partition(object):
          'Keyswitch armed', 'Delay trip in progress (common zone)'],
     ]
 
+    CONDITION_TABLES = tuple(flag_table(flags) for flags in CONDITION_FLAGS)
+
+    # The bits of a partition's byte in a Partitions Snapshot message
+    SNAPSHOT_FLAGS = ['Valid partition', 'Ready', 'Armed', 'Stay mode',
+                      'Chime mode', 'Entry delay', 'Exit delay',
+                      'Previous alarm']
+
+    __slots__ = ('number', 'condition', 'last_user', 'stale')
+
+    condition_flags = FlagField('condition', CONDITION_TABLES)
+
+    ARMED = condition_flags.mask('Armed')
+
     def __init__(self, number):
         self.number = number
-        self.condition_flags = []
+        self.condition = 0
         self.last_user = None
+        # True if restored from saved state and not yet confirmed
+        self.stale = False
 
     @property
     def armed(self):
-        return 'Armed' in self.condition_flags
+        return bool(self.condition & self.ARMED)
 
 
 class System(object):
@@ -169,9 +255,15 @@ class System(object):
          'Valid partition 7', 'Valid partition 8'],
     ]
 
+    STATUS_TABLES = tuple(flag_table(flags) for flags in STATUS_FLAGS)
+
+    __slots__ = ('panel_id', 'status')
+
+    status_flags = FlagField('status', STATUS_TABLES)
+
     def __init__(self):
         self.panel_id = 0
-        self.status_flags = []
+        self.status = 0
 
 
 class LogEvent(object):
@@ -290,11 +382,25 @@ class User(object):
          'Open / close report enable'],
     )
 
+    AUTHORITY_TABLES = tuple(flag_table(flags) for flags in AUTHORITY_FLAGS)
+
+    __slots__ = ('number', 'pin', 'authority', 'partitions')
+
     def __init__(self, number):
         self.number = number
         self.pin = []
-        self.authority_flags = []
-        self.authorized_partitions = []
+        # The authority byte; the top bit selects the meaning of the rest
+        self.authority = 0
+        self.partitions = 0
+
+    @property
+    def authority_flags(self):
+        table = self.AUTHORITY_TABLES[self.authority >> 7]
+        return list(table[self.authority & 0x7F])
+
+    @property
+    def authorized_partitions(self):
+        return list(PARTITION_TABLE[self.partitions])
 
 
 class NX584Extension(object):
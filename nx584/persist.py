@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+LOG = logging.getLogger('persist')
+
+
+def atomic_write(path, data):
+    """Replace the contents of path with data (bytes).
+
+    The data is written to a temporary file in the same directory and
+    renamed over path once it is safely on disk, so readers (and a crash
+    at any point) see either the old contents or the new, never a
+    partial file.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=dirname,
+                               prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class StateStore(object):
+    """Saves and loads a snapshot of the panel state as JSON."""
+
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """Read the saved state.
+
+        :returns: The state dict, or None if there is no usable state
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                state = json.loads(f.read().decode())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as ex:
+            LOG.error('Unable to read state from %s: %s' % (self.path, ex))
+            return None
+        if not isinstance(state, dict):
+            LOG.error('Ignoring state in %s which is not an object' % (
+                self.path))
+            return None
+        if state.get('version') != self.VERSION:
+            LOG.warning('Ignoring state in %s with version %r' % (
+                self.path, state.get('version')))
+            return None
+        saved = state.get('saved')
+        if not isinstance(saved, (int, float)):
+            LOG.error('Ignoring state in %s with no save time' % self.path)
+            return None
+        LOG.info('Loaded state saved at %s' % time.ctime(saved))
+        return state
+
+    def save(self, state):
+        """Write state to disk, replacing any previous state.
+
+        :returns: True if the state was written
+        """
+        state = dict(state, version=self.VERSION, saved=time.time())
+        try:
+            atomic_write(self.path,
+                         json.dumps(state, separators=(',', ':')).encode())
+        except OSError as ex:
+            LOG.error('Unable to write state to %s: %s' % (self.path, ex))
+            return False
+        return True
+
+
+class DeferredWriter(object):
+    """Writes a file in the background a short time after it changes.
+
+    Calls to schedule() within delay seconds of each other are merged
+    into one write. render() is called from the writer thread to produce
+    the file contents as bytes, and the write is skipped if they match
+    what is already on disk.
+    """
+    def __init__(self, path, render, delay=2.0):
+        self.path = path
+        self.delay = delay
+        self._render = render
+        self._lock = threading.Lock()
+        self._timer = None
+        self._pending = False
+        self._written = None
+
+    def schedule(self):
+        """Write the file within delay seconds."""
+        with self._lock:
+            self._pending = True
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Write any pending changes now."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+            self._pending = False
+            data = self._render()
+            if self._written is None:
+                try:
+                    with open(self.path, 'rb') as f:
+                        self._written = f.read()
+                except OSError:
+                    pass
+            if data == self._written:
+                LOG.debug('%s is unchanged, not writing' % self.path)
+                return
+            try:
+                atomic_write(self.path, data)
+            except OSError as ex:
+                LOG.error('Unable to write %s: %s' % (self.path, ex))
+                return
+            self._written = data
@@ -0,0 +1,85 @@
+import collections
+import logging
+
+LOG = logging.getLogger('scheduler')
+
+# Priority classes, highest first
+COMMAND = 0
+STATUS = 1
+NAME = 2
+
+# Requests which only read state from the panel. Sending one of these
+# twice gets the same answer, so identical ones waiting to be sent are
+# merged.
+POLLS = {
+    0x21: STATUS,   # Interface Configuration Request
+    0x23: NAME,     # Zone Name Request
+    0x24: STATUS,   # Zone Status Request
+    0x25: STATUS,   # Zones Snapshot Request
+    0x26: STATUS,   # Partition Status Request
+    0x27: STATUS,   # Partitions Snapshot Request
+    0x28: STATUS,   # System Status Request
+    0x2A: STATUS,   # Log Event Request
+    0x30: STATUS,   # Program Data Request
+    0x32: STATUS,   # User Information Request with PIN
+    0x33: STATUS,   # User Information Request without PIN
+}
+
+
+def priority(msg):
+    """The priority class of a message to the panel."""
+    return POLLS.get(msg[0], COMMAND)
+
+
+class Scheduler(object):
+    """Orders messages waiting to be sent to the panel.
+
+    Commands which change the panel's state (arming, bypassing, setting
+    the clock, etc) are sent before status requests, and status requests
+    before zone name requests, otherwise in the order they were added.
+
+    Items are anything with a msg attribute holding the message type and
+    payload.
+    """
+    def __init__(self):
+        self._queues = [collections.deque() for i in (COMMAND, STATUS, NAME)]
+        self._polls = {}
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def __bool__(self):
+        return any(self._queues)
+
+    def add(self, item, klass=None):
+        """Queue item to be sent.
+
+        :param klass: The priority class to queue item in, instead of the
+                      one for its message type. Polls queued as COMMAND
+                      are not merged.
+        :returns: item, or the identical poll already waiting to be sent
+        """
+        if klass is None:
+            klass = priority(item.msg)
+        if klass != COMMAND:
+            key = bytes(item.msg)
+            waiting = self._polls.get(key)
+            if waiting is not None:
+                LOG.debug('Merged duplicate request %s' % key.hex())
+                return waiting
+            self._polls[key] = item
+        self._queues[klass].append(item)
+        return item
+
+    def popleft(self):
+        """Remove and return the next item to send.
+
+        :raises: IndexError if nothing is queued
+        """
+        for queue in self._queues:
+            if queue:
+                item = queue.popleft()
+                if self._polls.get(bytes(item.msg)) is item:
+                    del self._polls[bytes(item.msg)]
+                return item
+        raise IndexError('pop from an empty scheduler')
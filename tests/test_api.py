@@ -0,0 +1,161 @@
+import concurrent.futures
+import json
+import unittest
+from unittest import mock
+
+from nx584 import api
+from nx584 import controller
+from nx584 import event_queue
+from nx584 import model
+
+
+def _future(exception=None, done=True):
+    future = concurrent.futures.Future()
+    if exception:
+        future.set_exception(exception)
+    elif done:
+        future.set_result(None)
+    return future
+
+
+class TestStreamEvents(unittest.TestCase):
+    def setUp(self):
+        self.controller = mock.MagicMock()
+        self.controller.event_queue = event_queue.EventQueue(3)
+        patcher = mock.patch.object(api, 'CONTROLLER', self.controller)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = api.app.test_client()
+
+    def _push(self, *zones):
+        for zone in zones:
+            self.controller.event_queue.push({'type': 'zone_status',
+                                              'zone': zone})
+
+    def _stream(self, target, **kwargs):
+        response = self.client.get(target, **kwargs)
+        self.addCleanup(response.close)
+        return response, iter(response.response)
+
+    def _next(self, chunks):
+        chunk = next(chunks)
+        return chunk.decode() if isinstance(chunk, bytes) else chunk
+
+    def test_sse_message(self):
+        self.assertEqual('data: {"zone": 1}\n\n', api.sse_message({'zone': 1}))
+        self.assertEqual('event: missed\nid: 3\ndata: 2\n\n',
+                         api.sse_message(2, event_id=3, event='missed'))
+
+    def test_resume(self):
+        self._push(1, 2)
+        response, chunks = self._stream(
+            '/events/stream?heartbeat=0', headers={'Last-Event-ID': '1'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('text/event-stream', response.mimetype)
+        self.assertEqual('no-cache', response.headers['Cache-Control'])
+        self.assertEqual('id: 2\ndata: {"type": "zone_status", "zone": 2}\n\n',
+                         self._next(chunks))
+
+    def test_missed(self):
+        self._push(1, 2, 3, 4, 5)
+        response, chunks = self._stream('/events/stream?index=0&heartbeat=0')
+        self.assertEqual('event: missed\ndata: {"missed": 2}\n\n',
+                         self._next(chunks))
+        self.assertEqual(['id: 3', 'id: 4', 'id: 5'],
+                         [self._next(chunks).split('\n')[0]
+                          for i in range(3)])
+
+    def test_keepalive(self):
+        self._push(1)
+        response, chunks = self._stream('/events/stream?index=1&heartbeat=0')
+        self.assertEqual(api.SSE_KEEPALIVE, self._next(chunks))
+        self._push(2)
+        self.assertEqual('id: 2\ndata: {"type": "zone_status", "zone": 2}\n\n',
+                         self._next(chunks))
+
+    def test_filtered(self):
+        self._push(1, 2)
+        response, chunks = self._stream(
+            '/events/stream?index=0&heartbeat=0&zone=2')
+        self.assertEqual('id: 2', self._next(chunks).split('\n')[0])
+        self.assertEqual(api.SSE_KEEPALIVE, self._next(chunks))
+
+    def test_invalid(self):
+        for query in ('heartbeat=soon', 'zone=front', 'index=last'):
+            response = self.client.get('/events/stream?%s' % query)
+            self.assertEqual(400, response.status_code, query)
+        response = self.client.get('/events/stream',
+                                   headers={'Last-Event-ID': 'x'})
+        self.assertEqual(400, response.status_code)
+
+
+class TestCommands(unittest.TestCase):
+    def setUp(self):
+        self.controller = mock.MagicMock()
+        self.controller.zones = {1: model.Zone(1)}
+        self.controller.arm_stay.return_value = _future()
+        self.controller.zone_bypass_toggle.return_value = _future(
+            controller.CommandRejected('Message Rejected'))
+        self.controller.disarm.return_value = _future(
+            controller.ConnectionLost('Not connected'))
+        self.controller.get_partition_status.return_value = _future(
+            done=False)
+        patcher = mock.patch.object(api, 'CONTROLLER', self.controller)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = api.app.test_client()
+
+    def _post(self, query=''):
+        operations = [
+            {'op': 'arm', 'type': 'stay'},
+            {'op': 'bypass', 'zone': 1, 'bypassed': True},
+            {'op': 'disarm', 'master_pin': '1234'},
+            {'op': 'refresh', 'partition': 1},
+            {'op': 'bypass', 'zone': 1, 'bypassed': False},
+        ]
+        response = self.client.post('/commands%s' % query,
+                                    data=json.dumps(operations),
+                                    content_type='application/json')
+        return response.status_code, [result['status'] for result in
+                                      response.get_json()['results']]
+
+    def test_queued(self):
+        self.assertEqual((200, ['queued', 'superseded', 'queued', 'queued',
+                                'unchanged']), self._post())
+
+    def test_wait(self):
+        self.assertEqual((200, ['done', 'superseded', 'failed', 'timeout',
+                                'unchanged']), self._post('?wait=0.1'))
+        self.controller.arm_stay.return_value = _future(
+            controller.CommandTimeout('No answer'))
+        self.controller.get_partition_status.return_value = _future()
+        self.assertEqual((200, ['timeout', 'superseded', 'failed', 'done',
+                                'unchanged']), self._post('?wait=0.1'))
+
+    def test_wait_rejected(self):
+        self.controller.zones[1].condition = 0x04
+        response = self.client.post(
+            '/commands?wait=1',
+            data=json.dumps([{'op': 'bypass', 'zone': 1,
+                              'bypassed': False}]),
+            content_type='application/json')
+        self.assertEqual('rejected',
+                         response.get_json()['results'][0]['status'])
+
+    def test_invalid_wait(self):
+        response = self.client.post('/commands?wait=600', data='[]',
+                                    content_type='application/json')
+        self.assertEqual(400, response.status_code)
+
+
+class TestStats(unittest.TestCase):
+    def test_stats(self):
+        ctrl = mock.MagicMock()
+        ctrl.handler_stats.return_value = {}
+        ctrl.extension_stats.return_value = {}
+        ctrl.mail_stats.return_value = {'sent': 2, 'failed': 1,
+                                        'queued': 0, 'held': 3}
+        with mock.patch.object(api, 'CONTROLLER', ctrl):
+            response = api.app.test_client().get('/stats')
+        self.assertEqual({'sent': 2, 'failed': 1, 'queued': 0, 'held': 3},
+                         response.get_json()['mail'])
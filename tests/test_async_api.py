@@ -0,0 +1,186 @@
+import asyncio
+import concurrent.futures
+import json
+import unittest
+from unittest import mock
+
+from nx584 import api
+from nx584 import async_api
+from nx584 import controller
+from nx584 import event_queue
+from nx584 import model
+
+
+class TestAsyncAPI(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.controller = mock.MagicMock()
+        self.controller.event_queue = event_queue.EventQueue(10)
+        zone = model.Zone(1)
+        zone.name = 'Front door'
+        self.controller.zones = {1: zone}
+        patcher = mock.patch.object(api, 'CONTROLLER', self.controller)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = async_api.Server()
+        await self.server.start('127.0.0.1', 0)
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    async def _request(self, target, method='GET', body=b'', headers=''):
+        reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                       self.server.port)
+        writer.write(('%s %s HTTP/1.1\r\nContent-Length: %i\r\n%s'
+                      'Connection: close\r\n\r\n' % (
+                          method, target, len(body),
+                          headers)).encode() + body)
+        data = await reader.read()
+        writer.close()
+        head, _, body = data.partition(b'\r\n\r\n')
+        self.headers = dict(line.split(': ', 1) for line in
+                            head.decode().split('\r\n')[1:])
+        return int(head.split()[1]), body
+
+    async def test_zones(self):
+        status, body = await self._request('/zones')
+        self.assertEqual(200, status)
+        self.assertEqual('Front door', json.loads(body)['zones'][0]['name'])
+
+    async def test_zones_etag(self):
+        self.controller.generation = 1
+        status, body = await self._request('/zones')
+        etag = self.headers['ETag']
+        header = 'If-None-Match: %s\r\n' % etag
+        status, body = await self._request('/zones', headers=header)
+        self.assertEqual(304, status)
+        self.assertEqual(b'', body)
+        self.controller.zones[1].name = 'Back door'
+        self.controller.generation = 2
+        status, body = await self._request('/zones', headers=header)
+        self.assertEqual(200, status)
+        self.assertNotEqual(etag, self.headers['ETag'])
+
+    def _future(self, exception=None):
+        future = concurrent.futures.Future()
+        if exception:
+            future.set_exception(exception)
+        else:
+            future.set_result(None)
+        return future
+
+    async def test_command_wait(self):
+        partition = model.Partition(1)
+        partition.condition = 0x40
+        self.controller.partitions = {1: partition}
+        self.controller.arm_stay.return_value = self._future()
+        self.controller.get_partition_status.return_value = self._future()
+        status, body = await self._request(
+            '/command?cmd=arm&type=stay&partition=1&wait=5')
+        self.assertEqual(200, status)
+        self.assertTrue(json.loads(body)['armed'])
+        self.controller.get_partition_status.assert_called_once_with(1)
+
+        self.controller.arm_stay.return_value = self._future(
+            controller.CommandRejected('Message Rejected'))
+        status, body = await self._request(
+            '/command?cmd=arm&type=stay&partition=1&wait=5')
+        self.assertEqual(409, status)
+
+        self.controller.arm_stay.return_value = concurrent.futures.Future()
+        status, body = await self._request(
+            '/command?cmd=arm&type=stay&partition=1&wait=0.1')
+        self.assertEqual(504, status)
+
+    async def test_bypass_wait(self):
+        self.controller.zone_bypass_toggle.return_value = self._future()
+        self.controller.get_zone_status.return_value = self._future()
+        status, body = await self._request(
+            '/zones/1?wait=5', method='PUT',
+            body=b'{"bypassed": true}',
+            headers='Content-Type: application/json\r\n')
+        self.assertEqual(200, status)
+        self.controller.get_zone_status.assert_called_once_with(1)
+
+    async def test_not_found(self):
+        status, body = await self._request('/nothing')
+        self.assertEqual(404, status)
+
+    async def test_events(self):
+        self.controller.event_queue.push({'type': 'zone_status', 'zone': 1})
+        status, body = await self._request('/events?index=0&timeout=0')
+        self.assertEqual({'events': [{'type': 'zone_status', 'zone': 1}],
+                          'index': 1, 'missed': 0}, json.loads(body))
+
+    async def test_events_busy(self):
+        self.controller.event_queue.push({'type': 'zone_status', 'zone': 1})
+        with mock.patch.object(self.controller.event_queue, 'poll_nowait',
+                               return_value=None):
+            status, body = await self._request('/events?index=0&timeout=0')
+        self.assertEqual(1, json.loads(body)['index'])
+
+    async def test_events_pushed_during_poll(self):
+        queue = self.controller.event_queue
+        poll = queue.poll
+        calls = []
+
+        def poll_then_push(*args):
+            result = poll(*args)
+            if not calls:
+                queue.push({'type': 'zone_status', 'zone': 1})
+            calls.append(args)
+            return result
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        with mock.patch.object(queue, 'poll_nowait', return_value=None):
+            with mock.patch.object(queue, 'poll', side_effect=poll_then_push):
+                status, body = await self._request('/events?index=0&timeout=5')
+        self.assertLess(loop.time() - start, 2)
+        self.assertEqual({'events': [{'type': 'zone_status', 'zone': 1}],
+                          'index': 1, 'missed': 0}, json.loads(body))
+
+    async def test_events_no_match(self):
+        self.controller.event_queue.push({'type': 'zone_status', 'zone': 1})
+        status, body = await self._request(
+            '/events?index=0&timeout=0&zone=2')
+        self.assertEqual({'events': None, 'index': 1, 'missed': 0},
+                         json.loads(body))
+
+    async def test_events_wait(self):
+        polls = [asyncio.ensure_future(self._request(
+            '/events?index=0&timeout=5&zone=%i' % zone))
+                 for zone in (1, 2)]
+        while self.server.waiting < 2:
+            await asyncio.sleep(0.01)
+        self.controller.event_queue.push({'type': 'zone_status', 'zone': 2})
+        status, body = await polls[1]
+        self.assertEqual(1, json.loads(body)['index'])
+        self.assertFalse(polls[0].done())
+        self.assertEqual(1, self.server.waiting)
+        polls[0].cancel()
+
+    async def test_stream(self):
+        for zone in (1, 2):
+            self.controller.event_queue.push({'type': 'zone_status',
+                                              'zone': zone})
+        reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                       self.server.port)
+        writer.write(b'GET /events/stream HTTP/1.1\r\n'
+                     b'Last-Event-ID: 2\r\n\r\n')
+        head = await reader.readuntil(b'\r\n\r\n')
+        self.assertIn(b'text/event-stream', head)
+        # Nothing new yet
+        self.assertEqual(b'd\r\n: keepalive\n\n\r\n',
+                         await reader.readuntil(b'\n\n\r\n'))
+        self.controller.event_queue.push({'type': 'zone_status', 'zone': 3})
+        self.assertEqual(b'30\r\nid: 3\ndata: {"type": "zone_status", '
+                         b'"zone": 3}\n\n\r\n',
+                         await reader.readuntil(b'\n\n\r\n'))
+        writer.close()
+
+    async def test_bad_request(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                       self.server.port)
+        writer.write(b'nonsense\r\n\r\n')
+        self.assertIn(b'400', await reader.readline())
+        writer.close()
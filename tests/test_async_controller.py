@@ -0,0 +1,177 @@
+import asyncio
+import concurrent.futures
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from nx584 import async_controller
+from nx584 import codec
+from nx584 import controller
+
+
+class FakePanel(object):
+    """A TCP server which answers requests like a panel."""
+    def __init__(self):
+        self.received = []
+        self.writers = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._client, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[:2]
+
+    def send(self, msg):
+        for writer in self.writers:
+            writer.write(codec.encode_ascii_frame(msg))
+
+    async def _client(self, reader, writer):
+        self.writers.append(writer)
+        decoder = controller.NXASCIIDecoder()
+        while True:
+            data = await reader.read(100)
+            if not data:
+                break
+            decoder.feed(data)
+            while True:
+                frame = decoder.next_frame()
+                if frame is None:
+                    break
+                self.received.append(frame[1:-2])
+                msgtype = frame[1] & 0x7F
+                if msgtype == 0x24:
+                    # Zone status: faulted, interior
+                    self.send([0x84, frame[2], 0x01, 0x40, 0x00, 0x00, 0x01])
+                elif msgtype == 0x25:
+                    # Zones snapshot: zone 1 faulted
+                    self.send([0x05, frame[2], 0x01] + [0x00] * 7)
+                elif msgtype == 0x27:
+                    # Partitions snapshot: no valid partitions
+                    self.send([0x07] + [0x00] * 8)
+                elif msgtype == 0x23:
+                    self.send([0x03, frame[2]] + [0x20] * 16)
+                elif msgtype == 0x28:
+                    self.send([0x08] + [0x00] * 11)
+                elif msgtype != 0x1D:
+                    self.send([0x1D])
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+
+
+class TestAsyncController(unittest.TestCase):
+    def _make(self, address):
+        with mock.patch('stevedore.extension.ExtensionManager'):
+            with tempfile.NamedTemporaryFile() as f:
+                ctrl = async_controller.AsyncNXController(address, f.name)
+        ctrl._config.set('config', 'max_zone', '1')
+        return ctrl
+
+    async def _run(self, test):
+        panel = FakePanel()
+        ctrl = self._make(await panel.start())
+        task = asyncio.get_running_loop().create_task(ctrl.run())
+        try:
+            await asyncio.wait_for(test(panel, ctrl), 5)
+        finally:
+            ctrl.stop()
+            await asyncio.wait_for(task, 5)
+            await panel.stop()
+
+    def test_command(self):
+        async def test(panel, ctrl):
+            events = ctrl.subscribe()
+            event = await events.__anext__()
+            self.assertEqual('zone_status', event.payload['type'])
+            self.assertEqual(1, event.payload['zone'])
+            self.assertTrue(ctrl.zones[1].state)
+            self.assertEqual(['Interior'], ctrl.zones[1].type_flags)
+
+            future = ctrl.arm_stay(1)
+            # Not wrapped for the loop, so nothing complains if the
+            # result is never looked at
+            self.assertIsInstance(future, concurrent.futures.Future)
+            await asyncio.wrap_future(future)
+            while bytes([0x3E, 0x00, 0x01]) not in panel.received:
+                await asyncio.sleep(0.01)
+
+            # The zone status transition has the ack bit set
+            self.assertIn(bytes([0x1D]), panel.received)
+            await events.aclose()
+
+        asyncio.run(self._run(test))
+
+    def test_command_from_thread(self):
+        async def test(panel, ctrl):
+            future = await asyncio.get_running_loop().run_in_executor(
+                None, ctrl.zone_bypass_toggle, 3)
+            await asyncio.wrap_future(future)
+            while bytes([0x3F, 0x02]) not in panel.received:
+                await asyncio.sleep(0.01)
+
+        asyncio.run(self._run(test))
+
+    def test_reconnect(self):
+        async def test(panel, ctrl):
+            ctrl.RECONNECT_DELAY = 0
+            while not panel.writers:
+                await asyncio.sleep(0.01)
+            panel.writers.pop().close()
+            while not panel.writers:
+                await asyncio.sleep(0.01)
+            # The new session asks for the initial state again
+            while panel.received.count(bytes([0x28])) < 2:
+                await asyncio.sleep(0.01)
+
+        asyncio.run(self._run(test))
+
+    def test_blocking_work_off_loop(self):
+        threads = {}
+
+        def record(name):
+            def fn(*args, **kwargs):
+                threads[name] = threading.current_thread()
+            return fn
+
+        async def test(panel, ctrl):
+            ctrl._state_store = mock.MagicMock()
+            ctrl._state_store.save.side_effect = record('save')
+            ctrl._model_changed()
+            ctrl._checkpoint_due()
+            await ctrl._saving
+            ctrl._checkpointer.cancel()
+            ctrl.flush = record('flush')
+
+        panel = FakePanel()
+        ctrl = self._make(None)
+
+        async def run():
+            ctrl._portspec = await panel.start()
+            task = asyncio.get_running_loop().create_task(ctrl.run())
+            try:
+                await asyncio.wait_for(test(panel, ctrl), 5)
+            finally:
+                ctrl.stop()
+                await asyncio.wait_for(task, 5)
+                await panel.stop()
+
+        asyncio.run(run())
+        self.assertEqual({'save', 'flush'}, set(threads))
+        for thread in threads.values():
+            self.assertIsNot(threading.main_thread(), thread)
+
+        # Once stopped, commands are only queued
+        ctrl.get_system_status()
+
+    def test_subscribe_backlog_from_thread(self):
+        async def test(panel, ctrl):
+            ctrl.event_queue.push({'type': 'test'})
+            with mock.patch.object(ctrl.event_queue, 'poll_nowait',
+                                   return_value=None):
+                events = ctrl.subscribe(0)
+                event = await events.__anext__()
+            self.assertEqual({'type': 'test'}, event.payload)
+            await events.aclose()
+
+        asyncio.run(self._run(test))
@@ -0,0 +1,78 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from nx584 import batch
+from nx584 import controller
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('stevedore.extension.ExtensionManager'):
+            with tempfile.NamedTemporaryFile() as f:
+                self.ctrl = controller.NXController('fakeport', f.name)
+        for number in (1, 2, 3):
+            self.ctrl._get_zone(number)
+        # Zone 2 is already bypassed
+        self.ctrl.zones[2].condition = 0x08
+
+    def _queued(self):
+        queued = []
+        while self.ctrl._commands.pending:
+            queued.append(self.ctrl._commands.pending.popleft().msg)
+        return queued
+
+    def test_plan(self):
+        steps = batch.plan(self.ctrl, [
+            {'op': 'refresh', 'zone': 1},
+            {'op': 'bypass', 'zone': 1, 'bypassed': True},
+            {'op': 'bypass', 'zone': 2, 'bypassed': True},
+            {'op': 'bypass', 'zone': 3, 'bypassed': True},
+            {'op': 'bypass', 'zone': 3, 'bypassed': False},
+            {'op': 'arm', 'type': 'stay', 'partition': 1},
+        ])
+        self.assertEqual(['queued', 'queued', 'unchanged', 'superseded',
+                          'unchanged', 'queued'],
+                         [status for queue, status in steps])
+        results = batch.run(self.ctrl, steps)
+        self.assertEqual([True, True, False, False, False, True],
+                         [future is not None for future, status in results])
+        # Sent in the order given, even the status request
+        self.assertEqual([[0x24, 0], [0x3F, 0], [0x3E, 0x00, 1]],
+                         self._queued())
+
+    def test_invalid(self):
+        self.ctrl.get_system_status()
+        with self.assertRaises(batch.InvalidBatch) as cm:
+            batch.plan(self.ctrl, [
+                {'op': 'bypass', 'zone': 1, 'bypassed': True},
+                {'op': 'bypass', 'zone': 9, 'bypassed': True},
+                {'op': 'arm', 'type': 'away'},
+                {'op': 'disarm', 'master_pin': '12'},
+                {'op': 'refresh', 'partition': 0},
+                {'op': 'explode'},
+                'arm',
+            ])
+        self.assertEqual(None, cm.exception.errors[0])
+        self.assertEqual(6, len([e for e in cm.exception.errors if e]))
+        self.assertEqual([[0x28]], self._queued())
+
+    def test_group_order(self):
+        self.ctrl.get_zone_name(1)
+        self.ctrl.get_system_status()
+        with self.ctrl.command_group():
+            self.ctrl.get_partition_status(1)
+            self.ctrl.arm_stay(1)
+            # Not queued until the group is
+            self.assertEqual(2, len(self.ctrl._commands.pending))
+        self.ctrl.zone_bypass_toggle(2)
+        self.assertEqual([[0x26, 0], [0x3E, 0x00, 1], [0x3F, 1], [0x28],
+                          [0x23, 0]], self._queued())
+
+    def test_group_failed(self):
+        with self.assertRaises(ValueError):
+            with self.ctrl.command_group():
+                future = self.ctrl.arm_stay(1)
+                raise ValueError()
+        self.assertTrue(future.cancelled())
+        self.assertEqual([], self._queued())
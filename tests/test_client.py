@@ -0,0 +1,85 @@
+import importlib.machinery
+import importlib.util
+import os
+import unittest
+from unittest import mock
+
+from nx584 import client
+
+
+def _response(status_code=200, lines=(), data=None):
+    response = mock.MagicMock()
+    response.status_code = status_code
+    response.__enter__.return_value = response
+    response.iter_lines.return_value = iter(lines)
+    response.json.return_value = data
+    return response
+
+
+def _load_cli():
+    path = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                        'nx584_client')
+    loader = importlib.machinery.SourceFileLoader('nx584_client_cli', path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+class Stop(Exception):
+    pass
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.client = client.Client('http://panel')
+        self.client._session = mock.MagicMock()
+
+    def test_stream_events(self):
+        self.client._last_event_index = 4
+        self.client._session.get.return_value = _response(lines=[
+            ': keepalive', '',
+            'event: missed', 'data: {"missed": 3}', '',
+            'id: 8', 'data: {"type": "zone_status",', 'data:  "zone": 1}', '',
+            'id: 9', 'data: {"type": "log"}', '',
+        ])
+        events = self.client.stream_events(zone=1)
+        self.assertEqual({'type': 'zone_status', 'zone': 1}, next(events))
+        self.assertEqual(3, self.client.missed_events)
+        self.assertEqual(8, self.client._last_event_index)
+        self.assertEqual({'type': 'log'}, next(events))
+        self.assertEqual(0, self.client.missed_events)
+        self.assertEqual(9, self.client._last_event_index)
+        self.assertRaises(StopIteration, next, events)
+        self.client._session.get.assert_called_once_with(
+            'http://panel/events/stream', params={'zone': 1},
+            headers={'Accept': 'text/event-stream', 'Last-Event-ID': '4'},
+            stream=True)
+
+    def test_stream_events_not_supported(self):
+        self.client._session.get.return_value = _response(404)
+        self.assertRaises(client.StreamingNotSupported, list,
+                          self.client.stream_events())
+
+
+class TestClientCLI(unittest.TestCase):
+    def test_events_fallback(self):
+        cli = _load_cli()
+        clnt = client.Client('http://panel')
+        clnt._session = mock.MagicMock()
+        clnt._session.get.side_effect = [
+            _response(404),
+            _response(data={'events': [{'zone': 2}], 'index': 5,
+                            'missed': 0}),
+            Stop(),
+        ]
+        args = mock.MagicMock(zone=2, partition=None)
+        with mock.patch('builtins.print') as mock_print:
+            self.assertRaises(Stop, cli.do_events, clnt, args)
+        mock_print.assert_called_once_with({'zone': 2})
+        urls = [c[0][0] for c in clnt._session.get.call_args_list]
+        self.assertEqual(['http://panel/events/stream',
+                          'http://panel/events', 'http://panel/events'],
+                         urls)
+        self.assertEqual({'zone': 2, 'index': 5, 'timeout': 60},
+                         clnt._session.get.call_args[1]['params'])
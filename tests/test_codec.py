@@ -0,0 +1,71 @@
+import random
+import unittest
+
+from nx584 import codec
+from nx584 import controller
+
+
+def legacy_fletcher(data):
+    mod = 2 ** 8 - 1
+    s = s2 = 0
+    for t in data:
+        s += t
+        s2 += s
+    cksum = s % mod + (mod + 1) * (s2 % mod)
+    return cksum & 0xFF, (cksum & 0xFF00) >> 8
+
+
+def legacy_stuff(data):
+    data = list(data)
+    bytestuff = [i for i, x in enumerate(data) if x == 0x7d]
+    for i, index in reversed(list(enumerate(bytestuff))):
+        data[index:index+1] = [0x7d, 0x5d]
+    bytestuff = [i for i, x in enumerate(data) if x == 0x7e]
+    for i, index in reversed(list(enumerate(bytestuff))):
+        data[index:index+1] = [0x7d, 0x5e]
+    return bytes(data)
+
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(584)
+        self.samples = [bytes(rand.randrange(256)
+                              for i in range(rand.randrange(1, 64)))
+                        for j in range(200)]
+        self.samples.append(bytes(range(256)) * 4)
+
+    def test_fletcher16(self):
+        for data in self.samples:
+            self.assertEqual(legacy_fletcher(data), codec.fletcher16(data))
+            self.assertEqual(legacy_fletcher(data),
+                             controller.fletcher(list(data)))
+
+    def test_hex(self):
+        for data in self.samples:
+            text = ''.join('%02X' % b for b in data)
+            self.assertEqual(text, controller.make_ascii(list(data)))
+            self.assertEqual(list(data), controller.parse_ascii(text))
+            self.assertEqual(data, codec.decode_hex(codec.encode_hex(data)))
+
+    def test_stuff(self):
+        for data in self.samples:
+            self.assertEqual(legacy_stuff(data), codec.stuff(data))
+        self.assertEqual(b'\x7d\x5d\x7d\x5e', codec.stuff(b'\x7d\x7e'))
+
+    def test_pin(self):
+        self.assertEqual([0x21, 0x43, 0xFF], controller.make_pin_buffer('1234'))
+        self.assertEqual([0x21, 0x43, 0x65],
+                         controller.make_pin_buffer('123456'))
+        self.assertEqual([0x21, 0x43, 0xFF],
+                         controller.make_pin_buffer([1, 2, 3, 4, 15]))
+        self.assertEqual([0xFF, 0xFF, 0xFF], controller.make_pin_buffer(None))
+
+    def test_frames(self):
+        data = [0x28, 0x7e, 0x7d]
+        frame = [len(data)] + data
+        frame += legacy_fletcher(frame)
+        self.assertEqual(
+            b'\n' + ''.join('%02X' % b for b in frame).encode() + b'\r',
+            codec.encode_ascii_frame(data))
+        self.assertEqual(b'\x7e' + legacy_stuff(frame),
+                         codec.encode_binary_frame(data))
@@ -1,5 +1,9 @@
 import io
+import os
 import logging
+import socket
+import threading
+import time
 import unittest
 import tempfile
 from unittest import mock
@@ -29,7 +33,7 @@ class TestProtocols(unittest.TestCase):
         data = proto.read_frame()
 
         # Make sure we got the right length, data, and checksum
-        self.assertEqual(data, [length] + TESTFRAME + [s1, s2])
+        self.assertEqual(data, bytes([length] + TESTFRAME + [s1, s2]))
 
     def test_write_binary(self):
         stream = io.BytesIO()
@@ -50,7 +54,94 @@ class TestProtocols(unittest.TestCase):
         data = proto.read_frame()
 
         # Make sure we got the right length, data, and checksum
-        self.assertEqual(data, [length] + TESTFRAME + [s1, s2])
+        self.assertEqual(data, bytes([length] + TESTFRAME + [s1, s2]))
+
+    def _test_decode_split(self, protocol):
+        stream = io.BytesIO()
+        proto = protocol(stream)
+        proto.write_frame(TESTFRAME)
+        proto.write_frame([0x7d, 0x7d])
+        raw = b'junk' + stream.getvalue()
+
+        # Feed the decoder one byte at a time, as a slow stream would
+        decoder = protocol.DECODER()
+        frames = []
+        for i in range(len(raw)):
+            decoder.feed(raw[i:i + 1])
+            frame = decoder.next_frame()
+            if frame is not None:
+                frames.append(frame)
+
+        length = len(TESTFRAME)
+        s1, s2 = controller.fletcher([length] + TESTFRAME)
+        t1, t2 = controller.fletcher([2, 0x7d, 0x7d])
+        self.assertEqual([bytes([length] + TESTFRAME + [s1, s2]),
+                          bytes([2, 0x7d, 0x7d, t1, t2])],
+                         frames)
+        self.assertFalse(decoder.in_frame)
+
+    def test_decode_split_ascii(self):
+        self._test_decode_split(controller.NXASCII)
+
+    def test_decode_split_binary(self):
+        self._test_decode_split(controller.NXBinary)
+
+    def _test_mid_frame_timeout(self, protocol):
+        stream = io.BytesIO()
+        proto = protocol(stream)
+        proto.write_frame(TESTFRAME)
+        proto.write_frame(TESTFRAME)
+        stream = io.BytesIO(stream.getvalue()[:-3])
+        proto = protocol(stream)
+
+        # The first frame is complete, the second is truncated
+        self.assertEqual(len(TESTFRAME) + 3, len(proto.read_frame()))
+        self.assertRaises(controller.ConnectionLost, proto.read_frame)
+
+    def test_mid_frame_timeout_ascii(self):
+        self._test_mid_frame_timeout(controller.NXASCII)
+
+    def test_mid_frame_timeout_binary(self):
+        self._test_mid_frame_timeout(controller.NXBinary)
+
+
+class TestFrames(unittest.TestCase):
+    def _decode(self, data):
+        frame = [len(data)] + data
+        frame += controller.fletcher(frame)
+        return controller.NXFrame.decode_line(bytes(frame))
+
+    def test_zone_status(self):
+        frame = self._decode([0x84, 0x04, 0x01, 0x41, 0x10, 0x00, 0x03])
+        self.assertIsInstance(frame, controller.ZoneStatusFrame)
+        self.assertEqual(4, frame.msgtype)
+        self.assertTrue(frame.ack_required)
+        self.assertEqual(5, frame.zone)
+        self.assertEqual(1, frame.partition_mask)
+        self.assertEqual(b'\x41\x10\x00', frame.type_bytes)
+        self.assertEqual(3, frame.condition)
+        self.assertFalse(hasattr(frame, '__dict__'))
+
+    def test_log_event(self):
+        frame = self._decode([0x0A, 0x10, 0xFF, 0x81, 0x02, 0x00,
+                              0x07, 0x04, 0x0C, 0x1E])
+        self.assertIsInstance(frame, controller.LogEventFrame)
+        self.assertFalse(frame.ack_required)
+        self.assertEqual(1, frame.event_type)
+        self.assertTrue(frame.reportable)
+        self.assertEqual(3, frame.zone_user_device)
+        self.assertEqual((7, 4, 12, 30),
+                         (frame.month, frame.day, frame.hour, frame.minute))
+
+    def test_unknown_type(self):
+        frame = self._decode([0x0B, 0x01, 0x02])
+        self.assertIs(controller.NXFrame, type(frame))
+        self.assertEqual(b'\x01\x02', frame.data)
+
+    def test_bad_checksum(self):
+        self.assertRaises(controller.ReadFailure,
+                          controller.NXFrame.decode_line,
+                          b'\x01\x28\x00\x00')
 
 
 class SplitIO(io.BytesIO):
@@ -65,7 +156,7 @@ class SplitIO(io.BytesIO):
         return self.w.write(b)
 
 
-def get_wrapper(config):
+def get_wrapper(config, on_reconnect=None):
     rio = io.BytesIO()
     wio = io.BytesIO()
 
@@ -74,7 +165,8 @@ def get_wrapper(config):
             self._s = SplitIO(rio, wio)
             return True
 
-    return rio, wio, FakeWrapper('fakeport', config)
+    return rio, wio, FakeWrapper('fakeport', config,
+                                 on_reconnect=on_reconnect)
 
 
 class TestController(unittest.TestCase):
@@ -90,6 +182,8 @@ class TestController(unittest.TestCase):
         self.ctrl.running = True
         self.ctrl._idle_time_heartbeat_seconds = 0.1
         self.ctrl._config.set('config', 'max_zone', '2')
+        # Nothing answers, so send everything without waiting
+        self.ctrl._commands.window = 10
 
         with mock.patch.object(self.ctrl, 'generate_heartbeat_activity',
                                side_effect=stop):
@@ -104,9 +198,9 @@ class TestController(unittest.TestCase):
 
         expected = [
             '0128292A',   # system status
-            '022400264E', # zone 1 status
+            '01272829',   # partitions snapshot
+            '0225002750', # zones 1-16 snapshot
             '022300254C', # zone 1 name
-            '022401274F', # zone 2 status
             '022301264D', # zone 2 name
         ]
 
@@ -189,3 +283,395 @@ class TestController(unittest.TestCase):
     def test_receive_binary(self):
         buf = self._test_receive(True)
         print('Test buffer is %r' % list(buf))
+
+    def _frame(self, data):
+        frame = [len(data)] + data
+        frame += controller.fletcher(frame)
+        return controller.NXFrame.decode_line(bytes(frame))
+
+    def test_zones_snapshot(self):
+        self.ctrl._config.set('config', 'max_zone', '18')
+        # Zone 2 faulted, zone 18 bypassed
+        snapshot = self._frame([0x05, 0x00, 0x10] + [0x00] * 7)
+        with mock.patch.object(self.ctrl, 'get_zone_status') as gzs:
+            self.ctrl.process_msg_5(snapshot)
+            # Everything is unknown, so we ask about every zone
+            self.assertEqual(list(range(1, 17)),
+                             [c[0][0] for c in gzs.call_args_list])
+            for i in range(1, 17):
+                self.ctrl._get_zone(i)
+
+            gzs.reset_mock()
+            self.ctrl.process_msg_5(snapshot)
+            gzs.assert_not_called()
+
+            snapshot = self._frame([0x05, 0x00, 0x11] + [0x00] * 7)
+            self.ctrl.process_msg_5(snapshot)
+            gzs.assert_called_once_with(1)
+
+            # Zones past max_zone are ignored
+            gzs.reset_mock()
+            self.ctrl.process_msg_5(
+                self._frame([0x05, 0x01, 0x20, 0x02] + [0x00] * 6))
+            self.assertEqual([17, 18], [c[0][0] for c in gzs.call_args_list])
+
+    def test_partitions_snapshot(self):
+        # Partition 1 valid and ready, partition 2 valid and armed
+        snapshot = self._frame([0x07, 0x03, 0x05] + [0x00] * 6)
+        with mock.patch.object(self.ctrl, 'get_partition_status') as gps:
+            self.ctrl.process_msg_7(snapshot)
+            self.assertEqual([1, 2], [c[0][0] for c in gps.call_args_list])
+            self.ctrl._get_partition(1)
+            self.ctrl._get_partition(2)
+
+            gps.reset_mock()
+            self.ctrl.process_msg_7(
+                self._frame([0x07, 0x03, 0x07] + [0x00] * 6))
+            gps.assert_called_once_with(2)
+
+    def test_register_handler(self):
+        handler = mock.MagicMock()
+        self.ctrl.register_handler(0x0B, handler)
+        keypad = self._frame([0x0B, 0x00, 0x01])
+        with mock.patch.object(self.ctrl, 'process_msg_4') as pm:
+            self.ctrl._build_dispatch()
+            self.ctrl._handle_frame(keypad)
+            self.ctrl._handle_frame(
+                self._frame([0x04, 0x00, 0x01, 0x40, 0x00, 0x00, 0x01]))
+            pm.assert_called_once_with(mock.ANY)
+        handler.assert_called_once_with(keypad)
+
+        stats = self.ctrl.handler_stats()
+        self.assertEqual([0x04, 0x0B], sorted(stats))
+        self.assertEqual('Keypad Message Received', stats[0x0B]['name'])
+        self.assertEqual(1, stats[0x0B]['count'])
+
+        self.ctrl.unregister_handler(0x0B, handler)
+        self.ctrl._handle_frame(keypad)
+        handler.assert_called_once_with(keypad)
+
+    def test_duplicate_frames(self):
+        status = [0x04, 0x00, 0x01, 0x40, 0x00, 0x00, 0x01]
+        with mock.patch.object(self.ctrl, 'process_msg_4') as pm:
+            self.ctrl._build_dispatch()
+            self.ctrl._handle_frame(self._frame(status))
+            self.ctrl._handle_frame(self._frame(status))
+            self.ctrl._handle_frame(self._frame([0x04, 0x01] + status[2:]))
+            self.assertEqual(2, pm.call_count)
+            self.ctrl._handle_frame(self._frame(status[:-1] + [0x00]))
+            self.assertEqual(3, pm.call_count)
+        self.assertEqual(1, self.ctrl.handler_stats()[4]['suppressed'])
+
+    def test_command_done_after_handlers(self):
+        self.ctrl._build_dispatch()
+        future = self.ctrl.get_zone_status(1)
+        with mock.patch.object(self.ctrl._commands, '_send',
+                               return_value=True):
+            self.ctrl._commands.pump(0)
+        seen = []
+        future.add_done_callback(
+            lambda f: seen.append(self.ctrl.zones[1].state))
+        self.ctrl._handle_frame(self._frame(
+            [0x04, 0x00, 0x01, 0x40, 0x00, 0x00, 0x01]))
+        self.assertEqual([True], seen)
+
+    def test_stream_reconnect(self):
+        fake_config = mock.MagicMock()
+        fake_config.getboolean.return_value = False
+        rio, wio, self.ctrl._ser = get_wrapper(
+            fake_config, on_reconnect=self.ctrl._reconnected)
+        future = self.ctrl.get_zone_status(1)
+        self.ctrl._commands.pump(0)
+        self.assertEqual(1, len(self.ctrl._commands.in_flight))
+        with mock.patch.object(self.ctrl._ser.protocol, 'read_frame',
+                               side_effect=controller.ConnectionLost()):
+            with mock.patch('time.sleep'):
+                self.assertIsNone(self.ctrl.process_next(0))
+        self.assertIsInstance(future.exception(0), controller.ConnectionLost)
+        # Resynchronise straight away, rather than at the next heartbeat
+        queued = []
+        while self.ctrl._commands.pending:
+            queued.append(self.ctrl._commands.pending.popleft().msg)
+        self.assertIn([0x27], queued)
+        self.assertIn([0x25, 0], queued)
+
+    def test_generation(self):
+        status = [0x04, 0x00, 0x01, 0x40, 0x00, 0x00, 0x01]
+        self.ctrl._build_dispatch()
+        self.assertEqual(0, self.ctrl.generation)
+        self.ctrl._handle_frame(self._frame(status))
+        self.assertEqual(1, self.ctrl.generation)
+        # Dropped as a duplicate, so nothing changed
+        self.ctrl._handle_frame(self._frame(status))
+        self.assertEqual(1, self.ctrl.generation)
+        self.ctrl._handle_frame(self._frame([0x1D]))
+        self.assertEqual(1, self.ctrl.generation)
+
+    def test_extensions_get_snapshot(self):
+        worker = mock.MagicMock()
+        self.ctrl._extension_workers = [worker]
+        self.ctrl.process_msg_4(
+            self._frame([0x04, 0x00, 0x01, 0x40, 0x00, 0x00, 0x01]))
+        zone = worker.submit.call_args[0][1]
+        self.assertIsNot(self.ctrl.zones[1], zone)
+        self.ctrl.zones[1].condition = 0
+        self.assertEqual(['Faulted'], zone.condition_flags)
+
+    def test_duplicate_frames_process(self):
+        with mock.patch('stevedore.extension.ExtensionManager'):
+            with tempfile.NamedTemporaryFile('w') as f:
+                f.write('[config]\nzone_status_duplicates = process\n')
+                f.flush()
+                ctrl = controller.NXController('fakeport', f.name)
+        status = self._frame([0x04, 0x00, 0x01, 0x40, 0x00, 0x00, 0x01])
+        with mock.patch.object(ctrl, 'process_msg_4') as pm:
+            ctrl._build_dispatch()
+            ctrl._handle_frame(status)
+            ctrl._handle_frame(status)
+            self.assertEqual(2, pm.call_count)
+
+    def test_state_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = '%s/state.json' % tmp
+            self.ctrl._config.set('config', 'state_file', path)
+            self.ctrl._state_store = controller.persist.StateStore(path)
+            self.ctrl.process_msg_4(
+                self._frame([0x04, 0x00, 0x01, 0x40, 0x00, 0x00, 0x01]))
+            self.ctrl.process_msg_5(
+                self._frame([0x05, 0x00, 0x01] + [0x00] * 7))
+            self.ctrl.checkpoint()
+
+            # Nothing changed, so nothing is written
+            os.unlink(path)
+            self.ctrl.checkpoint(force=True)
+            self.assertFalse(os.path.exists(path))
+            self.ctrl._model_changed()
+            self.ctrl.checkpoint(force=True)
+
+            with mock.patch('stevedore.extension.ExtensionManager'):
+                with open('%s/config.ini' % tmp, 'w') as f:
+                    f.write('[config]\nstate_file = %s\n' % path)
+                ctrl = controller.NXController('fakeport', f.name)
+
+        zone = ctrl.zones[1]
+        self.assertTrue(zone.state)
+        self.assertTrue(zone.stale)
+        self.assertEqual(['Interior'], zone.type_flags)
+        self.assertFalse(ctrl.ready)
+
+        # An unchanged snapshot confirms the saved state
+        ctrl._synced = True
+        with mock.patch.object(ctrl, 'get_zone_status') as gzs:
+            ctrl.process_msg_5(self._frame([0x05, 0x00, 0x01] + [0x00] * 7))
+            self.assertEqual([2, 3, 4, 5, 6, 7, 8],
+                             [c[0][0] for c in gzs.call_args_list])
+        self.assertFalse(zone.stale)
+        self.assertTrue(ctrl.ready)
+
+    def test_mail_stats(self):
+        self.assertEqual({'sent': 0, 'failed': 0, 'queued': 0, 'held': 0},
+                         self.ctrl.mail_stats())
+
+    def test_log_event_name(self):
+        # Zone 3 alarm
+        self.ctrl.process_msg_10(self._frame(
+            [0x0A, 0x10, 0xFF, 0x00, 0x02, 0x00, 0x01, 0x01, 0x01, 0x00]))
+        event = self.ctrl.event_queue.get(0, 0)[-1].payload
+        self.assertEqual('Zone 3 Alarm', event['event'])
+        self.assertEqual('Alarm', event['event_name'])
+
+    def test_restore_state_bits(self):
+        # Bits whose names are shared with other bits survive the trip
+        self.ctrl.system.status = 0x3F << 48
+        self.ctrl._get_partition(1).condition = 1 << 16 | 1 << 27
+        state = self.ctrl._save_state()
+        with mock.patch('stevedore.extension.ExtensionManager'):
+            with tempfile.NamedTemporaryFile() as f:
+                ctrl = controller.NXController('fakeport', f.name)
+        ctrl._restore_state(state)
+        self.assertEqual(0x3F << 48, ctrl.system.status)
+        self.assertEqual(1 << 16 | 1 << 27, ctrl.partitions[1].condition)
+        self.assertTrue(ctrl.partitions[1].stale)
+
+    def test_restore_state_invalid(self):
+        state = self.ctrl._save_state()
+        state['partitions'] = [{'number': 1, 'condition': 'Armed'}]
+        self.ctrl._restore_state(state)
+        self.assertEqual({}, self.ctrl.partitions)
+        del state['system']
+        self.ctrl._restore_state(state)
+
+    def test_restore_state_bad_zone(self):
+        state = self.ctrl._save_state()
+        for zones in (['x'], [{'number': 'x'}], {'number': 1}, 1,
+                      [{'number': 1, 'name': 'Door', 'state': 'open',
+                        'condition': 0, 'types': 0, 'snapshot': None}]):
+            state['zones'] = zones
+            self.ctrl._restore_state(state)
+            self.assertEqual({}, self.ctrl.zones)
+
+    def test_startup_invalid_state(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = '%s/state.json' % tmp
+            with open(path, 'w') as f:
+                f.write('{"version": 2, "saved": 0, "zones": [[1]], '
+                        '"partitions": [], "system": {}}')
+            with open('%s/config.ini' % tmp, 'w') as f:
+                f.write('[config]\nstate_file = %s\n' % path)
+            with mock.patch('stevedore.extension.ExtensionManager'):
+                ctrl = controller.NXController('fakeport', f.name)
+        self.assertEqual({}, ctrl.zones)
+
+    def test_wakeup_on_enqueue(self):
+        panel, stream = socket.socketpair()
+        stream.settimeout(0.5)
+        panel.settimeout(2)
+
+        class SocketPairWrapper(controller.StreamWrapper):
+            def _connect(self):
+                self._s = stream
+                return True
+
+        fake_config = mock.MagicMock()
+        fake_config.getboolean.return_value = False
+        self.ctrl._ser = SocketPairWrapper('fakeport', fake_config)
+        self.ctrl._config.set('config', 'max_zone', '0')
+        self.ctrl.running = True
+        thread = threading.Thread(target=self.ctrl.controller_loop)
+        thread.start()
+
+        try:
+            # Answer the startup requests so the loop goes idle
+            proto = controller.NXASCII(panel)
+            replies = {0x3B: [0x1D],
+                       0x28: [0x08] + [0x00] * 11,
+                       0x27: [0x07] + [0x00] * 8}
+            for i in range(len(replies)):
+                frame = proto.read_frame()
+                proto.write_frame(replies[frame[1]])
+            time.sleep(0.1)
+
+            start = time.time()
+            self.ctrl.arm_stay(1)
+            frame = proto.read_frame()
+            self.assertLess(time.time() - start, 0.25)
+            self.assertEqual(b'\x3E\x00\x01', frame[1:-2])
+        finally:
+            self.ctrl.running = False
+            self.ctrl._queue_changed()
+            thread.join()
+            panel.close()
+            stream.close()
+
+
+class TestCommandEngine(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.engine = controller.CommandEngine(self._send, window=2,
+                                               timeout=1, retries=1)
+
+    def _send(self, msg):
+        self.sent.append(msg[0])
+        return True
+
+    def _frame(self, data):
+        frame = [len(data)] + data
+        frame += controller.fletcher(frame)
+        return controller.NXFrame.decode_line(bytes(frame))
+
+    def test_window(self):
+        futures = [self.engine.add([0x3D, 0x00]),
+                   self.engine.add([0x3E, 0x00, 0x01]),
+                   self.engine.add([0x28])]
+        self.engine.pump(0)
+        self.assertEqual([0x3D, 0x3E], self.sent)
+
+        self.assertTrue(self.engine.frame_received(self._frame([0x1D]), 0))
+        self.engine.pump(0)
+        self.assertEqual([0x3D, 0x3E, 0x28], self.sent)
+        self.assertEqual(0x1D, futures[0].result(0).msgtype)
+        self.assertFalse(futures[1].done())
+
+        self.assertTrue(self.engine.frame_received(
+            self._frame([0x08] + [0x00] * 11), 0))
+        self.assertEqual(0x08, futures[2].result(0).msgtype)
+        self.assertFalse(futures[1].done())
+
+    def test_send_failed_requeue(self):
+        # A failed send runs callbacks which may queue more commands
+        futures = []
+        first = self.engine.add([0x28])
+        first.add_done_callback(
+            lambda f: futures.append(self.engine.add([0x27])))
+        with mock.patch.object(self.engine, '_send', return_value=False):
+            self.engine.pump(0)
+        self.assertRaises(controller.ConnectionLost, first.result, 0)
+        self.assertEqual(1, len(futures))
+
+    def test_merged_polls(self):
+        first = self.engine.add([0x28])
+        second = self.engine.add([0x28])
+        self.assertIsNot(first, second)
+        self.assertTrue(first.cancel())
+        self.engine.pump(0)
+        self.assertEqual([0x28], self.sent)
+        self.assertTrue(self.engine.frame_received(
+            self._frame([0x08] + [0x00] * 11), 0))
+        self.assertEqual(0x08, second.result(0).msgtype)
+        self.assertTrue(first.cancelled())
+
+    def test_key(self):
+        self.engine.window = 1
+        zone1 = self.engine.add([0x24, 0x00])
+        zone2 = self.engine.add([0x24, 0x01])
+        self.engine.pump(0)
+        self.engine.window = 2
+        self.engine.pump(0)
+
+        frame = self._frame([0x04, 0x01, 0x01, 0x00, 0x00, 0x00, 0x00])
+        self.assertTrue(self.engine.frame_received(frame, 0))
+        self.assertIs(frame, zone2.result(0))
+        self.assertFalse(zone1.done())
+
+        # A status for a zone we did not ask about is not an answer
+        frame = self._frame([0x04, 0x05, 0x01, 0x00, 0x00, 0x00, 0x00])
+        self.assertFalse(self.engine.frame_received(frame, 0))
+
+    def test_nak(self):
+        future = self.engine.add([0x3D, 0x00])
+        self.engine.pump(0)
+        self.engine.frame_received(self._frame([0x1E]), 0)
+        self.assertEqual([0x3D, 0x3D], self.sent)
+        self.engine.frame_received(self._frame([0x1E]), 0)
+        self.assertRaises(controller.CommandTimeout, future.result, 0)
+        self.assertFalse(self.engine)
+
+    def test_timeout(self):
+        future = self.engine.add([0x3D, 0x00])
+        self.engine.pump(0)
+        self.assertEqual(1, self.engine.next_deadline)
+        self.engine.check_timeouts(0.5)
+        self.assertEqual([0x3D], self.sent)
+        self.engine.check_timeouts(1)
+        self.assertEqual([0x3D, 0x3D], self.sent)
+        self.engine.check_timeouts(2)
+        self.assertRaises(controller.CommandTimeout, future.result, 0)
+        self.assertIsNone(self.engine.next_deadline)
+
+    def test_connection_lost(self):
+        future = self.engine.add([0x3D, 0x00])
+        self.engine.pump(0)
+        self.engine.connection_lost()
+        self.assertRaises(controller.ConnectionLost, future.result, 0)
+        self.assertIsNone(self.engine.next_deadline)
+
+    def test_rejected(self):
+        rejected = self.engine.add([0x3D, 0x00])
+        failed = self.engine.add([0x3D, 0x01])
+        self.engine.pump(0)
+        self.engine.frame_received(self._frame([0x1F]), 0)
+        self.engine.frame_received(self._frame([0x1C]), 0)
+        self.assertRaises(controller.CommandRejected, rejected.result, 0)
+        self.assertRaises(controller.CommandFailed, failed.result, 0)
+        self.assertNotIsInstance(failed.exception(0),
+                                 controller.CommandRejected)
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nx584 import event_log
+from nx584 import event_queue
+
+
+class TestEventLog(unittest.TestCase):
+    def setUp(self):
+        super(TestEventLog, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def _log(self, **kwargs):
+        log = event_log.EventLog(self.dir, **kwargs)
+        self.addCleanup(log.close)
+        return log
+
+    def test_append_read(self):
+        log = self._log(index_interval=4)
+        for i in range(1, 21):
+            log.append(event_queue.Event(i, {'i': i}))
+        self.assertEqual(1, log.first_number)
+        self.assertEqual(20, log.last_number)
+        self.assertEqual([10, 11, 12],
+                         [e.number for e in log.read(9, 3)])
+        self.assertEqual({'i': 20}, log.read(19, 10)[0].payload)
+        self.assertEqual([], log.read(20, 10))
+
+    def test_reopen(self):
+        log = self._log()
+        for i in range(1, 6):
+            log.append(event_queue.Event(i, i))
+        log.close()
+        log = self._log()
+        self.assertEqual(5, log.last_number)
+        log.append(event_queue.Event(6, 6))
+        self.assertEqual(2, len(os.listdir(self.dir)))
+        self.assertEqual([4, 5, 6], [e.payload for e in log.read(3, 10)])
+
+    def test_torn_write(self):
+        log = self._log()
+        for i in range(1, 4):
+            log.append(event_queue.Event(i, i))
+        log.close()
+        with open(os.path.join(self.dir, os.listdir(self.dir)[0]),
+                  'ab') as f:
+            f.write(b'{"n":4,"p"')
+        log = self._log()
+        self.assertEqual(3, log.last_number)
+        self.assertEqual([1, 2, 3], [e.payload for e in log.read(0, 10)])
+
+    def test_rotate(self):
+        log = self._log(segment_bytes=50, max_segments=3)
+        for i in range(1, 31):
+            log.append(event_queue.Event(i, 'x' * 10))
+        self.assertEqual(3, len(os.listdir(self.dir)))
+        first = log.first_number
+        self.assertGreater(first, 1)
+        events = log.read(0, 100)
+        self.assertEqual(list(range(first, 31)),
+                         [e.number for e in events])
+
+
+class TestEventQueueLog(unittest.TestCase):
+    def setUp(self):
+        super(TestEventQueueLog, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_old_events_from_disk(self):
+        log = event_log.EventLog(self.dir)
+        self.addCleanup(log.close)
+        eq = event_queue.EventQueue(5, log=log)
+        for i in range(1, 21):
+            eq.push(i)
+        events, missed = eq.fetch(2)
+        self.assertEqual(0, missed)
+        self.assertEqual([3, 4, 5, 6, 7], [e.payload for e in events])
+        events, missed = eq.fetch(17)
+        self.assertEqual([18, 19, 20], [e.payload for e in events])
+        # Only events still in memory can be had without blocking
+        self.assertIsNone(eq.poll_nowait(2))
+        events, missed, index = eq.poll_nowait(17)
+        self.assertEqual([18, 19, 20], [e.payload for e in events])
+
+    def test_resume_numbering(self):
+        log = event_log.EventLog(self.dir)
+        eq = event_queue.EventQueue(5, log=log)
+        for i in range(1, 4):
+            eq.push(i)
+        log.close()
+        log = event_log.EventLog(self.dir)
+        self.addCleanup(log.close)
+        eq = event_queue.EventQueue(5, log=log)
+        self.assertEqual(3, eq.current)
+        eq.push(4)
+        self.assertEqual(4, eq.current)
+        self.assertEqual([2, 3, 4], [e.payload for e in eq.get(1)])
@@ -1,3 +1,5 @@
+import threading
+import time
 import unittest
 from unittest import mock
 
@@ -19,8 +21,7 @@ class TestEventQueue(unittest.TestCase):
         for i in range(1, 11):
             eq.push(i)
         self.assertEqual(10, eq.current)
-        self.assertEqual([6, 7, 8, 9, 10],
-                         [x.payload for x in eq._queue])
+        self.assertEqual(5, len(eq))
         self.assertEqual([6, 7, 8, 9, 10],
                          [x.payload for x in eq.get(0)])
         self.assertEqual([6, 7, 8, 9, 10],
@@ -53,3 +54,124 @@ class TestEventQueue(unittest.TestCase):
         with mock.patch.object(eq, '_condition') as mock_c:
             self.assertEqual(None, eq.get(c))
             mock_c.wait.assert_called_once_with(None)
+
+    def test_missed(self):
+        eq = event_queue.EventQueue(5)
+        for i in range(1, 11):
+            eq.push(i)
+        events, missed = eq.fetch(2)
+        self.assertEqual(3, missed)
+        self.assertEqual([6, 7, 8, 9, 10], [x.payload for x in events])
+        self.assertEqual(0, eq.fetch(5)[1])
+        self.assertEqual((None, 0), eq.fetch(10, timeout=0))
+
+    def test_max_bytes(self):
+        eq = event_queue.EventQueue(100, max_bytes=20)
+        for i in range(10):
+            eq.push('abcd')
+        # Each event is six bytes of JSON
+        self.assertEqual(3, len(eq))
+        self.assertEqual([8, 9, 10], [x.number for x in eq.get(0)])
+
+        # A single large event is kept until the next one
+        eq.push('x' * 100)
+        self.assertEqual([11], [x.number for x in eq.get(0)])
+
+    def test_start(self):
+        eq = event_queue.EventQueue(5, start=20)
+        self.assertEqual(0, len(eq))
+        self.assertEqual(None, eq.get(20, timeout=0))
+        eq.push('a')
+        self.assertEqual([21], [x.number for x in eq.get(0)])
+
+
+class TestEventFilter(unittest.TestCase):
+    def test_filter(self):
+        eq = event_queue.EventQueue(10)
+        eq.push({'type': 'zone_status', 'zone': 1})
+        eq.push({'type': 'zone_status', 'zone': 2})
+        eq.push({'type': 'partition', 'partition': 1})
+        eq.push('not a dict')
+        eq.push({'type': 'zone_status', 'zone': 1})
+        f = event_queue.EventFilter(type=['zone_status'], zone=[1])
+        self.assertEqual([1, 5], [e.number for e in eq.get(0, 0, f)])
+        self.assertEqual([5], [e.number for e in eq.get(1, 0, f)])
+        self.assertIsNone(eq.get(5, 0, f))
+        f = event_queue.EventFilter(zone=[1, 2])
+        self.assertEqual([1, 2, 5], [e.number for e in eq.get(0, 0, f)])
+
+    def test_filter_event_name(self):
+        eq = event_queue.EventQueue(10)
+        eq.push({'type': 'log', 'event': 'Zone 3 Alarm',
+                 'event_name': 'Alarm'})
+        eq.push({'type': 'log', 'event': 'User 1 Opening',
+                 'event_name': 'Opening'})
+        f = event_queue.EventFilter(event=['Alarm'])
+        self.assertEqual([1], [e.number for e in eq.get(0, 0, f)])
+        self.assertIn(('event', 'Opening'), eq._index)
+
+    def test_filter_trimmed(self):
+        eq = event_queue.EventQueue(3)
+        for i in range(1, 7):
+            eq.push({'type': 'zone_status', 'zone': i % 2})
+        f = event_queue.EventFilter(zone=[0])
+        events, missed = eq.fetch(0, 0, f)
+        self.assertEqual([4, 6], [e.number for e in events])
+        self.assertEqual(3, missed)
+        self.assertEqual({('zone', 0): [4, 6], ('zone', 1): [5],
+                          ('type', 'zone_status'): [4, 5, 6]},
+                         {k: list(v) for k, v in eq._index.items()})
+
+    def test_poll_no_match(self):
+        eq = event_queue.EventQueue(3)
+        for i in range(1, 7):
+            eq.push({'type': 'zone_status', 'zone': 1})
+        f = event_queue.EventFilter(zone=[2])
+        self.assertEqual((None, 3, 6), eq.poll(0, 0, f))
+        # Carrying on from there, nothing more was missed
+        self.assertEqual((None, 0, 6), eq.poll(6, 0, f))
+        self.assertEqual((None, 0, 9), eq.poll(9, 0, f))
+        eq.push({'type': 'zone_status', 'zone': 2})
+        events, missed, index = eq.poll(6, 0, f)
+        self.assertEqual(([7], 0, 7),
+                         ([e.number for e in events], missed, index))
+
+    def test_poll_nowait(self):
+        eq = event_queue.EventQueue(3)
+        eq.push('a')
+        self.assertEqual(1, eq.poll_nowait(0)[2])
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with eq._lock:
+                locked.set()
+                release.wait(5)
+
+        t = threading.Thread(target=hold)
+        t.start()
+        locked.wait(5)
+        self.assertIsNone(eq.poll_nowait(0))
+        release.set()
+        t.join()
+
+    def test_bad_filter(self):
+        self.assertRaises(ValueError, event_queue.EventFilter, color=['red'])
+        self.assertFalse(event_queue.EventFilter(zone=[]))
+
+    def test_selective_wakeup(self):
+        eq = event_queue.EventQueue(10)
+        f = event_queue.EventFilter(zone=[2])
+        result = []
+        t = threading.Thread(target=lambda: result.append(eq.get(0, 5, f)))
+        t.start()
+        while not eq._waiters:
+            time.sleep(0.001)
+        waiter = eq._waiters[('zone', 2)][0][1]
+        with mock.patch.object(waiter, 'notify') as mock_notify:
+            eq.push({'type': 'zone_status', 'zone': 1})
+            self.assertFalse(mock_notify.called)
+        eq.push({'type': 'zone_status', 'zone': 2})
+        t.join(5)
+        self.assertEqual([2], [e.number for e in result[0]])
+        self.assertEqual({}, dict(eq._waiters))
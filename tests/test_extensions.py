@@ -0,0 +1,99 @@
+import threading
+import time
+import unittest
+
+from nx584 import extensions
+
+
+class SlowExtension(object):
+    def __init__(self):
+        self.gate = threading.Event()
+        self.calls = []
+
+    def zone_status(self, zone):
+        self.gate.wait(5)
+        self.calls.append(zone)
+
+    def log_event(self, event):
+        raise Exception('broken')
+
+
+class TestExtensionWorker(unittest.TestCase):
+    def _worker(self, policy, maxsize=2):
+        ext = SlowExtension()
+        worker = extensions.ExtensionWorker('slow', ext, maxsize, policy)
+        # Hold the worker in the first call until the test lets it go
+        worker.submit('zone_status', 0, key=0)
+        while not worker._busy:
+            time.sleep(0.001)
+        return ext, worker
+
+    def test_order(self):
+        ext, worker = self._worker('drop_oldest', maxsize=10)
+        for i in range(1, 5):
+            worker.submit('zone_status', i, key=i)
+        ext.gate.set()
+        self.assertTrue(worker.join(5))
+        self.assertEqual([0, 1, 2, 3, 4], ext.calls)
+        self.assertEqual(5, worker.stats()['processed'])
+
+    def test_drop_oldest(self):
+        ext, worker = self._worker('drop_oldest')
+        for i in range(1, 5):
+            worker.submit('zone_status', i, key=i)
+        self.assertEqual(2, worker.stats()['dropped'])
+        self.assertGreater(worker.lag, 0)
+        ext.gate.set()
+        self.assertTrue(worker.join(5))
+        self.assertEqual([0, 3, 4], ext.calls)
+        self.assertEqual(0, worker.lag)
+
+    def test_coalesce(self):
+        ext, worker = self._worker('coalesce')
+        worker.submit('zone_status', 'first', key=1)
+        worker.submit('zone_status', 'second', key=2)
+        worker.submit('zone_status', 'third', key=1)
+        self.assertEqual(1, worker.stats()['coalesced'])
+        self.assertEqual(0, worker.stats()['dropped'])
+        ext.gate.set()
+        self.assertTrue(worker.join(5))
+        self.assertEqual([0, 'third', 'second'], ext.calls)
+
+    def test_coalesce_not_full(self):
+        ext, worker = self._worker('coalesce', maxsize=10)
+        worker.submit('zone_status', 'first', key=1)
+        worker.submit('zone_status', 'second', key=1)
+        self.assertEqual(0, worker.stats()['coalesced'])
+        ext.gate.set()
+        self.assertTrue(worker.join(5))
+        self.assertEqual([0, 'first', 'second'], ext.calls)
+
+    def test_block(self):
+        ext, worker = self._worker('block', maxsize=1)
+        worker.submit('zone_status', 1)
+        submitted = threading.Event()
+
+        def submit():
+            worker.submit('zone_status', 2)
+            submitted.set()
+
+        thread = threading.Thread(target=submit)
+        thread.start()
+        self.assertFalse(submitted.wait(0.1))
+        ext.gate.set()
+        self.assertTrue(submitted.wait(5))
+        thread.join()
+        self.assertTrue(worker.join(5))
+        self.assertEqual([0, 1, 2], ext.calls)
+
+    def test_failure(self):
+        ext, worker = self._worker('drop_oldest')
+        worker.submit('log_event', None)
+        worker.submit('zone_status', 1)
+        ext.gate.set()
+        self.assertTrue(worker.join(5))
+        self.assertEqual([0, 1], ext.calls)
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, extensions.ExtensionWorker,
+                          'slow', SlowExtension(), 1, 'ignore')
@@ -0,0 +1,206 @@
+import configparser
+import socketserver
+import threading
+import unittest
+from unittest import mock
+
+from nx584 import mail
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough of an SMTP server to accept mail from smtplib."""
+    def _reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self._reply('220 localhost')
+        message = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode().strip()
+            command = line.upper()
+            if command.startswith(('HELO', 'EHLO')):
+                self._reply('250 localhost')
+            elif command.startswith('MAIL'):
+                if server.fail:
+                    server.fail -= 1
+                    # Drop the connection
+                    return
+                message = {'to': []}
+                self._reply('250 OK')
+            elif command.startswith('RCPT'):
+                message['to'].append(line.split(':', 1)[1].strip('<> '))
+                self._reply('250 OK')
+            elif command == 'DATA':
+                self._reply('354 Go ahead')
+                data = []
+                while True:
+                    line = self.rfile.readline().decode()
+                    if line == '.\r\n':
+                        break
+                    data.append(line)
+                message['data'] = ''.join(data)
+                server.messages.append(message)
+                self._reply('250 OK')
+            elif command == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('250 OK')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super(SMTPServer, self).__init__(('127.0.0.1', 0), SMTPHandler)
+        self.connections = 0
+        self.fail = 0
+        self.messages = []
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.server = SMTPServer()
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        self.config = configparser.ConfigParser()
+        self.config.add_section('email')
+        self.config.set('email', 'fromaddr', 'panel@example.com')
+        self.config.set('email', 'smtphost',
+                        '127.0.0.1:%i' % self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _outbox(self, **options):
+        for key, value in options.items():
+            self.config.set('email', key, str(value))
+        outbox = mail.Outbox(self.config)
+        outbox.BACKOFF = 0.01
+        return outbox
+
+    def test_reuse_connection(self):
+        outbox = self._outbox()
+        outbox.send('one', ['a@example.com'], 'body one')
+        outbox.send('two', ['b@example.com'], 'body two')
+        self.assertTrue(outbox.flush(5))
+        self.assertEqual(2, outbox.sent)
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual([['a@example.com'], ['b@example.com']],
+                         [m['to'] for m in self.server.messages])
+
+    def test_retry(self):
+        self.server.fail = 2
+        outbox = self._outbox()
+        outbox.send('one', ['a@example.com'], 'body')
+        self.assertTrue(outbox.flush(5))
+        self.assertEqual(1, outbox.sent)
+        self.assertEqual(3, self.server.connections)
+
+    def test_give_up(self):
+        self.server.fail = 10
+        outbox = self._outbox(smtp_retries=1)
+        outbox.send('one', ['a@example.com'], 'body')
+        self.assertTrue(outbox.flush(5))
+        self.assertEqual({'sent': 0, 'failed': 1, 'queued': 0, 'held': 0},
+                         outbox.stats())
+        self.assertEqual([], self.server.messages)
+
+    def test_digest(self):
+        outbox = self._outbox(digest_seconds=60)
+        outbox.send('status one', ['a@example.com'], 'first')
+        outbox.send('status two', ['a@example.com'], 'second')
+        outbox.send('alarm', ['a@example.com'], 'fire', urgent=True)
+        while not outbox.sent:
+            outbox._thread.join(0.01)
+        # The alarm went straight out, the rest waits for the digest
+        self.assertEqual(1, len(self.server.messages))
+        self.assertIn('Subject: alarm', self.server.messages[0]['data'])
+
+        self.assertEqual({'sent': 1, 'failed': 0, 'queued': 0, 'held': 2},
+                         outbox.stats())
+
+        self.assertTrue(outbox.flush(5))
+        self.assertEqual(2, len(self.server.messages))
+        data = self.server.messages[1]['data']
+        self.assertIn('digest (2 notifications)', data)
+        self.assertIn('first', data)
+        self.assertIn('second', data)
+
+    def test_log_event_without_config(self):
+        self.config.remove_option('email', 'smtphost')
+        self.config.set('email', 'events', 'a@example.com')
+        event = mock.MagicMock(event='Alarm')
+        outbox = self._outbox()
+        # Missing server settings must not raise into the controller
+        mail.send_log_event_mail(self.config, event, outbox=outbox)
+        self.assertTrue(outbox.flush(1))
+        self.assertEqual(0, outbox.sent)
+
+
+class TestRoutes(unittest.TestCase):
+    def test_routes(self):
+        config = configparser.ConfigParser()
+        config.read_string('''
+[email]
+system = sys@example.com
+events = log@example.com
+alarms = alarm@example.com, fire@example.com
+
+[partition_1]
+flags = p1@example.com
+ignore_flags = Chime mode on
+alarm_flags = Fire,Siren on
+alarms = p1alarm@example.com
+
+[partition_bad]
+flags = nobody@example.com
+''')
+        routes = mail.Routes(config)
+        self.assertEqual(('sys@example.com',), routes.system)
+        self.assertEqual(
+            (('alarm@example.com', 'fire@example.com', 'log@example.com'),
+             True),
+            routes.log_event('Alarm'))
+        self.assertEqual((('log@example.com',), False),
+                         routes.log_event('Bypass'))
+
+        route = routes.partition(1)
+        self.assertEqual(('p1@example.com',), route.flags)
+        self.assertEqual({'Chime mode on'}, route.ignore_flags)
+        self.assertEqual({'Fire', 'Siren on'}, route.alarm_flags)
+        self.assertEqual((), route.status)
+        self.assertIs(mail.NO_PARTITION_ROUTES, routes.partition(2))
+
+    def test_partition_email(self):
+        config = configparser.ConfigParser()
+        config.read_string('''
+[email]
+fromaddr = panel@example.com
+smtphost = localhost
+
+[partition_1]
+flags = p1@example.com
+ignore_flags = Chime mode on
+''')
+        routes = mail.Routes(config)
+        outbox = mock.MagicMock()
+        partition = mock.MagicMock(number=1)
+        mail.send_partition_email(config, partition, set(),
+                                  {'Chime mode on'}, outbox=outbox,
+                                  routes=routes)
+        outbox.send.assert_not_called()
+        mail.send_partition_email(config, partition, set(), {'Armed'},
+                                  outbox=outbox, routes=routes)
+        outbox.send.assert_called_once_with(
+            'Security System Partition 1 Alert', ('p1@example.com',),
+            mock.ANY, urgent=False)
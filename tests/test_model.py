@@ -0,0 +1,49 @@
+import unittest
+
+from nx584 import model
+
+
+class TestFlagTables(unittest.TestCase):
+    def test_flag_table(self):
+        table = model.flag_table(['a', 'b', 'c'])
+        self.assertEqual(256, len(table))
+        self.assertEqual((), table[0])
+        self.assertEqual(('a', 'c'), table[5])
+        self.assertEqual(('a', 'b', 'c'), table[0xFF])
+
+    def test_flag_field_names(self):
+        self.assertEqual(['Interior', 'Chime', 'Trouble'],
+                         model.Zone.type_flags.names(0x040840))
+        self.assertEqual([2, 8], list(model.PARTITION_TABLE[0x82]))
+
+
+class TestModel(unittest.TestCase):
+    def test_zone_flags(self):
+        zone = model.Zone(1)
+        self.assertFalse(hasattr(zone, '__dict__'))
+        self.assertFalse(zone.bypassed)
+        zone.condition = 0x09
+        self.assertEqual(['Faulted', 'Inhibit'], zone.condition_flags)
+        self.assertTrue(zone.bypassed)
+
+        zone.type_flags = ['Interior', 'Chime']
+        self.assertEqual(0x0840, zone.types)
+        self.assertEqual(['Interior', 'Chime'], zone.type_flags)
+
+    def test_partition_flags(self):
+        partition = model.Partition(1)
+        partition.condition_flags = ['Armed', 'Ready to arm']
+        self.assertTrue(partition.armed)
+        self.assertEqual(0x0400000040, partition.condition)
+        self.assertEqual(
+            ['Ready to arm'],
+            model.Partition.condition_flags.names(
+                partition.condition & ~partition.ARMED))
+
+    def test_user_flags(self):
+        user = model.User(2)
+        user.authority = 0x80 | 0x11
+        user.partitions = 0x03
+        self.assertEqual(['Output 1 enable', 'Arm / disarm'],
+                         user.authority_flags)
+        self.assertEqual([1, 2], user.authorized_partitions)
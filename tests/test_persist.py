@@ -0,0 +1,95 @@
+import os
+import tempfile
+import time
+import unittest
+
+from nx584 import persist
+
+
+class TestPersist(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'state.json')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_atomic_write(self):
+        persist.atomic_write(self.path, b'one')
+        persist.atomic_write(self.path, b'two')
+        with open(self.path, 'rb') as f:
+            self.assertEqual(b'two', f.read())
+        # No temporary files are left behind
+        self.assertEqual(['state.json'], os.listdir(self.dir.name))
+
+    def test_state_store(self):
+        store = persist.StateStore(self.path)
+        self.assertIsNone(store.load())
+        self.assertTrue(store.save({'zones': [{'number': 1}]}))
+        state = store.load()
+        self.assertEqual([{'number': 1}], state['zones'])
+        self.assertEqual(persist.StateStore.VERSION, state['version'])
+
+    def test_state_store_invalid(self):
+        store = persist.StateStore(self.path)
+        persist.atomic_write(self.path, b'{"zones": [')
+        self.assertIsNone(store.load())
+        persist.atomic_write(self.path, b'{"version": 0}')
+        self.assertIsNone(store.load())
+        for data in (b'[]', b'"x"', b'null'):
+            persist.atomic_write(self.path, data)
+            self.assertIsNone(store.load())
+        # No save time
+        persist.atomic_write(self.path, b'{"version": %i}' % store.VERSION)
+        self.assertIsNone(store.load())
+
+
+class TestDeferredWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'config.ini')
+        self.renders = 0
+        self.data = b'zones'
+        self.writer = persist.DeferredWriter(self.path, self._render,
+                                             delay=60)
+
+    def tearDown(self):
+        self.writer.flush()
+        self.dir.cleanup()
+
+    def _render(self):
+        self.renders += 1
+        return self.data
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_coalesce(self):
+        for i in range(10):
+            self.writer.schedule()
+        self.assertFalse(os.path.exists(self.path))
+        self.writer.flush()
+        self.assertEqual(1, self.renders)
+        self.assertEqual(b'zones', self._read())
+
+        # Nothing was scheduled since
+        self.writer.flush()
+        self.assertEqual(1, self.renders)
+
+    def test_delay(self):
+        self.writer.delay = 0.01
+        self.writer.schedule()
+        for i in range(100):
+            if os.path.exists(self.path):
+                break
+            time.sleep(0.01)
+        self.assertEqual(b'zones', self._read())
+
+    def test_unchanged(self):
+        persist.atomic_write(self.path, b'zones')
+        mtime = os.stat(self.path).st_mtime_ns
+        self.writer.schedule()
+        self.writer.flush()
+        self.assertEqual(1, self.renders)
+        self.assertEqual(mtime, os.stat(self.path).st_mtime_ns)
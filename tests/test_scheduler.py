@@ -0,0 +1,48 @@
+import unittest
+
+from nx584 import scheduler
+
+
+class Item(object):
+    def __init__(self, *msg):
+        self.msg = list(msg)
+
+
+class TestScheduler(unittest.TestCase):
+    def _drain(self, sched):
+        items = []
+        while sched:
+            items.append(sched.popleft())
+        return items
+
+    def test_priority(self):
+        sched = scheduler.Scheduler()
+        name = sched.add(Item(0x23, 0x00))
+        status = sched.add(Item(0x24, 0x00))
+        disarm = sched.add(Item(0x3D, 0x01, 0x01))
+        arm = sched.add(Item(0x3E, 0x00, 0x01))
+        self.assertEqual(4, len(sched))
+        self.assertEqual([disarm, arm, status, name], self._drain(sched))
+        self.assertRaises(IndexError, sched.popleft)
+
+    def test_program_and_user_requests(self):
+        for msgtype in (0x30, 0x32, 0x33):
+            self.assertEqual(scheduler.STATUS,
+                             scheduler.priority([msgtype, 0x00]))
+        self.assertEqual(scheduler.COMMAND, scheduler.priority([0x31, 0x00]))
+
+    def test_coalesce_polls(self):
+        sched = scheduler.Scheduler()
+        first = sched.add(Item(0x24, 0x04))
+        self.assertIs(first, sched.add(Item(0x24, 0x04)))
+        other = sched.add(Item(0x24, 0x05))
+        self.assertEqual([first, other], self._drain(sched))
+
+        # Once sent, the same request is queued again
+        self.assertIsNot(first, sched.add(Item(0x24, 0x04)))
+
+    def test_commands_not_coalesced(self):
+        sched = scheduler.Scheduler()
+        first = sched.add(Item(0x3F, 0x02))
+        second = sched.add(Item(0x3F, 0x02))
+        self.assertEqual([first, second], self._drain(sched))